@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.admin import ModelAdmin
 from reversion.admin import VersionAdmin
-from apimws.models import AnsibleConfiguration, PHPLib, Host, Cluster
+from apimws.models import AnsibleConfiguration, PHPLib, Host, Cluster, AnsibleRun, ProvisioningStage
 
 
 class AnsibleConfigurationAdmin(VersionAdmin):
@@ -10,8 +10,33 @@ class AnsibleConfigurationAdmin(VersionAdmin):
     list_display = ('key', 'value', 'service')
 
 
+class AnsibleRunAdmin(ModelAdmin):
+
+    model = AnsibleRun
+    list_display = ('service', 'generation', 'started', 'duration', 'outcome')
+    list_filter = ('outcome', )
+
+
+class ProvisioningStageAdmin(ModelAdmin):
+
+    model = ProvisioningStage
+    list_display = ('service', 'pipeline', 'stage', 'started', 'duration', 'outcome')
+    list_filter = ('pipeline', 'stage', 'outcome')
+
+
+class HostAdmin(ModelAdmin):
+
+    model = Host
+    list_display = ('hostname', 'cluster', 'enabled', 'requests', 'failures', 'consecutive_failures', 'latency',
+                    'circuit_open_until')
+    list_filter = ('cluster', 'enabled')
+    readonly_fields = ('requests', 'failures', 'consecutive_failures', 'latency')
+
+
 admin.site.register(AnsibleConfiguration, AnsibleConfigurationAdmin)
+admin.site.register(AnsibleRun, AnsibleRunAdmin)
+admin.site.register(ProvisioningStage, ProvisioningStageAdmin)
 # admin.site.register(ApacheModule, VersionAdmin)
 admin.site.register(PHPLib, VersionAdmin)
 admin.site.register(Cluster, ModelAdmin)
-admin.site.register(Host, ModelAdmin)
+admin.site.register(Host, HostAdmin)
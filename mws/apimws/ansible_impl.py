@@ -1,8 +1,15 @@
+import json
 import logging
 import subprocess
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 from celery import shared_task, Task
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 
+from apimws.inventory import inventory_vms, service_fingerprint
+from apimws.models import AnsibleFingerprint, AnsibleRunRequest, AnsibleRun
 from sitesmanagement.models import Site, Snapshot, Service, Vhost
 
 
@@ -13,46 +20,181 @@ class UnexpectedVMStatus(Exception):
     pass
 
 
+class AnsibleExecutionError(subprocess.CalledProcessError):
+    """
+    Raised by run_on_vms when the command failed on some of the VMs. failures holds the CalledProcessError of each
+    failed VM and outputs the output of each VM where it succeeded, both keyed by hostname. returncode and cmd are
+    those of the first failure and output is the output of all the failures.
+    """
+    def __init__(self, failures, outputs):
+        first = failures[sorted(failures)[0]]
+        output = "\n".join("%s (exit code %s):\n%s" % (hostname, failure.returncode, failure.output)
+                           for hostname, failure in sorted(failures.items()))
+        super(AnsibleExecutionError, self).__init__(first.returncode, first.cmd, output)
+        self.failures = failures
+        self.outputs = outputs
+
+    def __str__(self):
+        return "Command failed on %s" % ", ".join(sorted(self.failures))
+
+
 def refresh_object(obj):
     """ Reload an object from the database """
     return obj.__class__._default_manager.get(pk=obj.pk)
 
 
-def launch_ansible(service):
-    if service.status == 'ready':
-        service.status = 'ansible'
-        service.save()
-        launch_ansible_async.delay(service)
-    elif service.status == 'ansible':
-        service.status = 'ansible_queued'
-        service.save()
-    elif service.status == 'ansible_queued':
-        return
-    elif service.status in ['installing', 'postinstall']:
+def desired_state_changed(service):
+    """Whether the hostvars of the service have changed since the last successful Ansible run"""
+    recorded = AnsibleFingerprint.objects.filter(service=service).values_list('fingerprint', flat=True).first()
+    return recorded != service_fingerprint(service)
+
+
+def launch_ansible(service, force=False):
+    """
+    Run Ansible against the VMs of the service unless nothing has changed since the last successful run.
+    Use force=True to run it regardless, e.g. after changing the Ansible roles.
+    """
+    if service.status in ['installing', 'postinstall']:
         return
+    elif service.status in ['ready', 'ansible', 'ansible_queued']:
+        schedule_ansible_run(service, force)
     else:
         raise UnexpectedVMStatus()  # TODO pass the vm object?
 
 
-def launch_ansible_by_user(user):
+def stale_threshold():
+    """Runs claimed or queued before this time are assumed to have been lost, e.g. with a worker that died"""
+    return timezone.now() - timedelta(seconds=getattr(settings, 'ANSIBLE_RUN_TIMEOUT', 3*60*60))
+
+
+def schedule_ansible_run(service, force=False, countdown=None):
+    """
+    Request an Ansible run of the service. Requests are coalesced: a run task is only queued, countdown seconds
+    later (ANSIBLE_RUN_DEBOUNCE by default), if there is not one already queued or running. Requests made while a
+    run is in flight are picked up by a single follow-up run.
+    """
+    if countdown is None:
+        countdown = getattr(settings, 'ANSIBLE_RUN_DEBOUNCE', 10)
+    AnsibleRunRequest.objects.get_or_create(service=service)
+    with transaction.atomic():
+        run_request = AnsibleRunRequest.objects.select_for_update().get(service=service)
+        run_request.requested += 1
+        run_request.force = run_request.force or force
+        threshold = stale_threshold()
+        queued = run_request.scheduled_at is not None and run_request.scheduled_at > threshold
+        in_flight = run_request.running is not None and run_request.started_at > threshold
+        if not queued and not in_flight:
+            run_request.scheduled_at = timezone.now()
+        run_request.save()
+        Service.objects.filter(id=service.id, status='ready').update(status='ansible')
+    if not queued and not in_flight:
+        run_ansible.apply_async(args=(service.id, ), countdown=countdown)
+
+
+def claim_ansible_run(service_id):
+    """
+    Claim the pending Ansible run of a service.
+
+    :return: the generation and force flag to run, or (None, False) if a run is already in flight
+    """
+    AnsibleRunRequest.objects.get_or_create(service_id=service_id)
+    with transaction.atomic():
+        run_request = AnsibleRunRequest.objects.select_for_update().get(service_id=service_id)
+        if run_request.running is not None and run_request.started_at > stale_threshold():
+            # The run in flight will queue a new one when it finishes if needed
+            run_request.scheduled_at = None
+            run_request.save()
+            return None, False
+        generation, force = run_request.requested, run_request.force
+        run_request.running = generation
+        run_request.started_at = timezone.now()
+        run_request.scheduled_at = None
+        run_request.force = False
+        run_request.save()
+    return generation, force
+
+
+def release_ansible_run(service, generation, started, outcome, output='', retry_failures=True):
+    """
+    Record the outcome of a claimed Ansible run and queue a new one if more were requested while it ran or, unless
+    retry_failures is unset, if it failed less than ANSIBLE_RUN_MAX_RETRIES times in a row.
+    """
+    with transaction.atomic():
+        run_request = AnsibleRunRequest.objects.select_for_update().get(service=service)
+        if run_request.running == generation:
+            run_request.running = None
+            run_request.started_at = None
+        if outcome == 'failure':
+            run_request.failures += 1
+            retry = retry_failures and run_request.failures <= getattr(settings, 'ANSIBLE_RUN_MAX_RETRIES', 2)
+        else:
+            run_request.failures = 0
+            run_request.completed = max(run_request.completed, generation)
+            retry = False
+        follow_up = (retry or run_request.requested > generation) and run_request.scheduled_at is None
+        if follow_up:
+            run_request.scheduled_at = timezone.now()
+        run_request.save()
+        AnsibleRun.objects.create(service=service, generation=generation, started=started, outcome=outcome,
+                                  duration=(timezone.now() - started).total_seconds(), output=output or '')
+        if not follow_up and run_request.scheduled_at is None:
+            Service.objects.filter(id=service.id, status__in=('ansible', 'ansible_queued')).update(status='ready')
+    if follow_up:
+        run_ansible.apply_async(args=(service.id, ), countdown=120 if retry else
+                                getattr(settings, 'ANSIBLE_RUN_DEBOUNCE', 10))
+
+
+def launch_ansible_by_user(user, force=False):
     for site in Site.objects.all():
         if user in site.list_of_all_type_of_active_users() and not site.is_canceled():
-            launch_ansible_site(site)  # TODO: Change this to other thing more sensible
+            launch_ansible_site(site, force)  # TODO: Change this to other thing more sensible
 
 
-def launch_ansible_site(site):
+def launch_ansible_site(site, force=False):
     if site.production_service and site.production_service.active:
-        launch_ansible(site.production_service)
+        launch_ansible(site.production_service, force)
     if site.test_service and site.test_service.active:
-        launch_ansible(site.test_service)
+        launch_ansible(site.test_service, force)
+
+
+def run_on_vms(commands):
+    """
+    Run a userv command for each VM concurrently, at most ANSIBLE_MAX_CONCURRENT_RUNS at the same time.
+
+    :param commands: list of (hostname, command) tuples
+    :return: the dict of outputs keyed by hostname
+    :raises AnsibleExecutionError: if the command failed on any VM, once all of them have finished
+    """
+    def run(command):
+        hostname, cmd = command
+        try:
+            return hostname, subprocess.check_output(cmd, stderr=subprocess.STDOUT), None
+        except subprocess.CalledProcessError as e:
+            return hostname, None, e
+
+    if len(commands) > 1:
+        pool = ThreadPool(min(len(commands), getattr(settings, 'ANSIBLE_MAX_CONCURRENT_RUNS', 4)))
+        try:
+            results = pool.map(run, commands)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(run, commands)
+
+    outputs = dict((hostname, output) for hostname, output, error in results if error is None)
+    failures = dict((hostname, error) for hostname, output, error in results if error is not None)
+    if failures:
+        raise AnsibleExecutionError(failures, outputs)
+    return outputs
 
 
 class AnsibleTaskWithFailure(Task):
-    """If you want to use this task with failure be sure that the first argument is the Service"""
+    """The status of the Service is set back to ready if the task fails and its first argument is the Service"""
     abstract = True
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
-        if type(exc) is subprocess.CalledProcessError:
+        if type(exc) in (subprocess.CalledProcessError, AnsibleExecutionError):
             LOGGER.error("An error happened when trying to execute Ansible.\nThe task id is %s.\n\n"
                          "The parameters passed to the task were: \nargs: %s\nkwargs: %s\n\nThe traceback is:\n%s\n\n"
                          "The output from the command was: %s\n", task_id, args, kwargs, einfo, exc.output)
@@ -60,33 +202,177 @@ class AnsibleTaskWithFailure(Task):
             LOGGER.error("An error happened when trying to execute Ansible.\nThe task id is %s.\n\n"
                          "The parameters passed to the task were: \nargs: %s\nkwargs: %s\n\nThe traceback is:\n%s\n",
                          task_id, args, kwargs, einfo)
-        if args[0].__class__ == Service:
+        # Some tasks are only called with keyword arguments, e.g. ansible_rollout
+        if args and args[0].__class__ == Service:
             service = args[0]
             service.status = 'ready'
             service.save()
 
 
+def apply_ansible(service, ignore_host_key=False):
+    """
+    Run Ansible against all the VMs of the service and record the fingerprint of the state applied
+    """
+    # The fingerprint is taken before the run so that changes made while it is running trigger a new one
+    fingerprint = service_fingerprint(service)
+    AnsibleFingerprint.objects.filter(service=service).delete()
+    userv_cmd = ["userv"]
+    if ignore_host_key:
+        userv_cmd.extend(["--defvar", "ANSIBLE_HOST_KEY_CHECKING=False"])
+    userv_cmd.extend(["mws-admin", "mws_ansible_host"])
+    run_on_vms([(vm.network_configuration.name, userv_cmd + [vm.network_configuration.name])
+                for vm in service.virtual_machines.all()])
+    AnsibleFingerprint.objects.update_or_create(service=service, defaults={'fingerprint': fingerprint})
+    # Delete Unix Groups marked to be deleted after ansible has finished deleting them from the system
+    service.unix_groups.filter(to_be_deleted=True).delete()
+
+
+@shared_task(base=AnsibleTaskWithFailure)
+def run_ansible(service_id):
+    """Run the Ansible run of a service requested with schedule_ansible_run"""
+    generation, force = claim_ansible_run(service_id)
+    if generation is None:
+        return
+    service = Service.objects.get(id=service_id)
+    started = timezone.now()
+    outcome, output = 'failure', ''
+    try:
+        if not force and not desired_state_changed(service):
+            LOGGER.info("Ansible run for service %s skipped, its hostvars have not changed", service)
+            outcome = 'skipped'
+        else:
+            apply_ansible(service)
+            outcome = 'success'
+    except subprocess.CalledProcessError as e:
+        output = e.output
+        LOGGER.error("An error happened when trying to execute Ansible against service %s.\n\n"
+                     "The output from the command was: %s\n", service, e.output)
+    finally:
+        release_ansible_run(service, generation, started, outcome, output)
+
+
 @shared_task(base=AnsibleTaskWithFailure, default_retry_delay=120, max_retries=2)
 def launch_ansible_async(service, ignore_host_key=False):
-    while service.status != 'ready':
+    """
+    Run Ansible straight away against a service that is not ready yet, e.g. at the end of its installation
+    (post_installOS), bypassing the run scheduler
+    """
+    if service.status != 'ready':
         try:
-            for vm in service.virtual_machines.all():
-                userv_cmd = ["userv"]
-                if ignore_host_key:
-                    userv_cmd.extend(["--defvar", "ANSIBLE_HOST_KEY_CHECKING=False"])
-                userv_cmd.extend(["mws-admin", "mws_ansible_host", vm.network_configuration.name])
-                subprocess.check_output(userv_cmd, stderr=subprocess.STDOUT)
+            apply_ansible(service, ignore_host_key)
         except subprocess.CalledProcessError as e:
             raise launch_ansible_async.retry(exc=e)
         service = refresh_object(service)
-        if service.status == 'ansible_queued':
-            service.status = 'ansible'
-            service.save()
-        else:
-            service.status = 'ready'
-            service.save()
-        # Delete Unix Groups marked to be deleted after ansible has finished deleting them from the system
-        service.unix_groups.filter(to_be_deleted=True).delete()
+        service.status = 'ready'
+        service.save()
+
+
+def rollout_services(changed_only=False):
+    """
+    Returns the services of the Ansible inventory, only those whose hostvars have changed since their last
+    successful run if changed_only is set.
+    """
+    services = Service.objects.filter(status__in=('ready', 'ansible', 'ansible_queued'),
+                                      id__in=inventory_vms().values('service_id')).order_by('id')
+    if changed_only:
+        return [service for service in services if desired_state_changed(service)]
+    return list(services)
+
+
+def parse_ansible_stats(output):
+    """
+    Returns the per-host stats ({"ok": 1, "changed": 0, "unreachable": 0, "failures": 0, "skipped": 0}) keyed by
+    hostname from the output of ansible-playbook with the json stdout callback, ignoring anything printed before it
+    """
+    try:
+        return json.loads(output[output.index('{'):])['stats']
+    except (ValueError, KeyError):
+        LOGGER.error("Unable to parse the output of an Ansible batch run:\n%s", output)
+        return {}
+
+
+def run_ansible_batch(batch, forks):
+    """
+    Run the MWS playbook once against all the VMs of the services given and release their claimed runs.
+
+    :param batch: list of (service, generation) tuples of claimed runs
+    :return: the list of hostnames where the run failed
+    """
+    started = timezone.now()
+    released = set()
+    try:
+        hosts = dict((service.id, [vm.network_configuration.name for vm in service.virtual_machines.all()])
+                     for service, generation in batch)
+        fingerprints = dict((service.id, service_fingerprint(service)) for service, generation in batch)
+        AnsibleFingerprint.objects.filter(service__in=[service for service, generation in batch]).delete()
+
+        cmd = list(getattr(settings, 'ANSIBLE_BATCH_COMMAND', ["userv", "mws-admin", "mws_ansible_batch"]))
+        cmd.extend(["--limit", ",".join(sum(hosts.values(), [])), "--forks", str(forks)])
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        stats = parse_ansible_stats(output)
+
+        failed = []
+        for service, generation in batch:
+            service_failed = [hostname for hostname in hosts[service.id] if hostname not in stats or
+                              stats[hostname].get('failures') or stats[hostname].get('unreachable')]
+            if service_failed:
+                failed.extend(service_failed)
+                LOGGER.error("The Ansible batch run failed for service %s on %s.\nThe exit code was %s and the "
+                             "error output was:\n%s", service, ", ".join(service_failed), process.returncode, errors)
+                released.add(service.id)
+                # The rollout reports them instead of retrying them on their own
+                release_ansible_run(service, generation, started, 'failure', errors, retry_failures=False)
+            else:
+                AnsibleFingerprint.objects.create(service=service, fingerprint=fingerprints[service.id])
+                # Delete Unix Groups marked to be deleted after ansible has finished deleting them from the system
+                service.unix_groups.filter(to_be_deleted=True).delete()
+                released.add(service.id)
+                release_ansible_run(service, generation, started, 'success')
+        return failed
+    finally:
+        # Runs are not left claimed, nor services in the 'ansible' status, if the batch run raises an exception
+        for service, generation in batch:
+            if service.id not in released:
+                release_ansible_run(service, generation, started, 'failure', retry_failures=False)
+
+
+@shared_task(base=AnsibleTaskWithFailure)
+def ansible_rollout(batch_size=None, forks=None, changed_only=False):
+    """
+    Run the MWS playbook against the whole fleet, one ansible-playbook process per batch of batch_size hosts
+    running forks hosts in parallel, instead of one process per VM.
+
+    :return: a dict with the list of hostnames where the run succeeded ('ok') and where it failed ('failed')
+    """
+    batch_size = batch_size or getattr(settings, 'ANSIBLE_ROLLOUT_BATCH_SIZE', 50)
+    forks = forks or getattr(settings, 'ANSIBLE_ROLLOUT_FORKS', 20)
+    result = {'ok': [], 'failed': []}
+
+    batch, batch_hosts = [], 0
+    services = rollout_services(changed_only)
+    try:
+        for index, service in enumerate(services):
+            # Only take services nobody else is running Ansible against
+            generation, force = claim_ansible_run(service.id)
+            if generation is not None:
+                batch.append((service, generation))
+                Service.objects.filter(id=service.id, status='ready').update(status='ansible')
+                batch_hosts += service.virtual_machines.count()
+            if batch and (batch_hosts >= batch_size or index == len(services) - 1):
+                # run_ansible_batch releases the runs of the batch
+                run_batch, batch, batch_hosts = batch, [], 0
+                failed = run_ansible_batch(run_batch, forks)
+                result['failed'].extend(failed)
+                result['ok'].extend(vm.network_configuration.name for service, generation in run_batch
+                                    for vm in service.virtual_machines.all()
+                                    if vm.network_configuration.name not in failed)
+    finally:
+        # The runs claimed for a batch that was not run
+        started = timezone.now()
+        for service, generation in batch:
+            release_ansible_run(service, generation, started, 'failure', retry_failures=False)
+    return result
 
 
 @shared_task(base=AnsibleTaskWithFailure)
@@ -110,6 +396,8 @@ def ansible_create_custom_snapshot(service, snapshot):
 @shared_task(base=AnsibleTaskWithFailure)
 def restore_snapshot(service, snapshot_name):
     execute_playbook_on_vms(service, ["--tags", "restore_snapshot", "-e", 'restore_snapshot_name="%s"' % snapshot_name])
+    # The VMs are no longer in the state applied by the last Ansible run
+    AnsibleFingerprint.objects.filter(service=service).delete()
 
 
 @shared_task(base=AnsibleTaskWithFailure)
@@ -128,21 +416,19 @@ def execute_playbook_on_vms(service, playbook_args):
     :param service: the service of the target VMs
     :param playbook_args: ansible playbook arguments
     """
-    for vm in service.virtual_machines.all():
-        cmd = ["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name]
-        cmd.extend(playbook_args)
-        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    run_on_vms([(vm.network_configuration.name,
+                 ["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name] + playbook_args)
+                for vm in service.virtual_machines.all()])
     return
 
 
 @shared_task(base=AnsibleTaskWithFailure)
 def delete_vhost_ansible(service, vhost_name, vhost_webapp):
     """delete the vhost folder and all its contents"""
-    for vm in service.virtual_machines.all():
-        subprocess.check_output([
-            "userv", "mws-admin", "mws_delete_vhost", vm.network_configuration.name, "--tags", "delete_vhost",
-            "-e", "delete_vhost_name=%s delete_vhost_webapp=%s" % (vhost_name, vhost_webapp)
-        ], stderr=subprocess.STDOUT)
+    run_on_vms([(vm.network_configuration.name, [
+        "userv", "mws-admin", "mws_delete_vhost", vm.network_configuration.name, "--tags", "delete_vhost",
+        "-e", "delete_vhost_name=%s delete_vhost_webapp=%s" % (vhost_name, vhost_webapp)
+    ]) for vm in service.virtual_machines.all()])
     launch_ansible(service)
     return
 
@@ -151,9 +437,9 @@ def delete_vhost_ansible(service, vhost_name, vhost_webapp):
 def vhost_enable_apache_owned(vhost_id):
     """Changes ownership of the docroot folder to the user www-data"""
     vhost = Vhost.objects.get(id=vhost_id)
-    for vm in vhost.service.virtual_machines.all():
-        subprocess.check_output(["userv", "mws-admin", "mws_vhost_owner", vm.network_configuration.name,
-                                 vhost.name, "enable"], stderr=subprocess.STDOUT)
+    run_on_vms([(vm.network_configuration.name, ["userv", "mws-admin", "mws_vhost_owner",
+                                                 vm.network_configuration.name, vhost.name, "enable"])
+                for vm in vhost.service.virtual_machines.all()])
     vhost.apache_owned = True
     vhost.save()
     vhost_disable_apache_owned.apply_async(args=(vhost_id,), countdown=3600)  # Leave an hour to the user
@@ -163,8 +449,8 @@ def vhost_enable_apache_owned(vhost_id):
 def vhost_disable_apache_owned(vhost_id):
     """Revert the ownership of the docroot folder back to site-admin"""
     vhost = Vhost.objects.get(id=vhost_id)
-    for vm in vhost.service.virtual_machines.all():
-        subprocess.check_output(["userv", "mws-admin", "mws_vhost_owner", vm.network_configuration.name,
-                                 vhost.name, "disable"], stderr=subprocess.STDOUT)
+    run_on_vms([(vm.network_configuration.name, ["userv", "mws-admin", "mws_vhost_owner",
+                                                 vm.network_configuration.name, vhost.name, "disable"])
+                for vm in vhost.service.virtual_machines.all()])
     vhost.apache_owned = False
     vhost.save()
@@ -16,21 +16,27 @@ def refresh_object(obj):
     return obj.__class__._default_manager.get(pk=obj.pk)
 
 
-def launch_ansible(service):
+def launch_ansible(service, force=False):
     pass
 
 
-def launch_ansible_site(site):
+def schedule_ansible_run(service, force=False, countdown=None):
+    if service.status in ('ready', 'ansible', 'ansible_queued'):
+        service.status = 'ready'
+        service.save()
+
+
+def launch_ansible_site(site, force=False):
     if site.production_service and site.production_service.active:
-        launch_ansible(site.production_service)
+        launch_ansible(site.production_service, force)
     if site.test_service and site.test_service.active:
-        launch_ansible(site.test_service)
+        launch_ansible(site.test_service, force)
 
 
-def launch_ansible_by_user(user):
+def launch_ansible_by_user(user, force=False):
     for site in Site.objects.all():
         if user in site.list_of_all_type_of_active_users() and not site.is_canceled():
-            launch_ansible_site(site)  # TODO: Change this to other thing more sensible
+            launch_ansible_site(site, force)  # TODO: Change this to other thing more sensible
 
 
 class AnsibleTaskWithFailure(Task):
@@ -54,6 +60,11 @@ def launch_ansible_async(service, ignore_host_key=False):
         service.save()
 
 
+@shared_task(base=AnsibleTaskWithFailure)
+def ansible_rollout(batch_size=None, forks=None, changed_only=False):
+    return {'ok': [], 'failed': []}
+
+
 @shared_task(base=AnsibleTaskWithFailure)
 def ansible_change_mysql_root_pwd(service):
     pass
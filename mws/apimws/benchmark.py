@@ -0,0 +1,241 @@
+'''Synthetic MWS fleets and measurements used to benchmark the panel against large numbers of servers'''
+import json
+import os
+import resource
+import time
+import traceback
+import uuid
+from collections import deque
+from datetime import date
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection, connections, transaction
+from django.test import Client, RequestFactory
+from mock import patch
+from apimws.inventory import write_inventory, inventory_vms, cached_hostvars, hostid, sitegroup, group
+from apimws.models import Cluster, PHPLib, AnsibleConfiguration
+from mwsauth.models import MWSUser
+from sitesmanagement.models import (Site, Service, VirtualMachine, NetworkConfig, ServerType, Vhost, DomainName,
+                                    UnixGroup)
+from sitesmanagement.views.sites import SiteList
+
+
+# Number of sites created per round of bulk inserts
+CREATE_CHUNK = 500
+# Number of PHP libraries installed in every synthetic production service
+PHP_LIBS = 3
+
+
+def ipv4(number):
+    return '10.%d.%d.%d' % (number >> 16 & 255, number >> 8 & 255, number & 255)
+
+
+def ipv6(number):
+    return '2001:db8:%x::%x' % (number >> 16, number & 65535)
+
+
+def create_fleet(num_sites, prefix="bench", start=0, user=None):
+    """
+    Creates num_sites sites named <prefix><n>, numbered from start. Each site has a user, a ready production
+    service and a ready test service with one VM each, and a vhost with a domain name in every
+    DomainName.STATUS_CHOICES status (the global one being the main domain). Its production service has a unix
+    group and PHP_LIBS PHP libraries. If a user is given it is made an admin of all the sites.
+
+    Objects are bulk created, so no signals are sent and the lookup service is not queried.
+    """
+    server_type = ServerType.objects.order_by('id').first()
+    cluster = Cluster.objects.first() or Cluster.objects.create(name="%s-cluster" % prefix)
+    php_libs = [PHPLib.objects.get_or_create(name="%s-php%d" % (prefix, i), defaults={'description': "Benchmark"})[0]
+                for i in range(PHP_LIBS)]
+    for first in range(start, start + num_sites, CREATE_CHUNK):
+        with transaction.atomic():
+            create_sites(range(first, min(start + num_sites, first + CREATE_CHUNK)), prefix, server_type, cluster,
+                         php_libs, user)
+
+
+def create_sites(numbers, prefix, server_type, cluster, php_libs, user):
+    """Creates the sites of create_fleet numbered with the numbers given"""
+    def name(n, kind=''):
+        return "%s%s%d" % (prefix, kind, n)
+
+    Site.objects.bulk_create([Site(name=name(n), start_date=date.today(), type=server_type,
+                                   email="%s@example.com" % name(n)) for n in numbers])
+    sites = dict(Site.objects.filter(name__in=[name(n) for n in numbers]).values_list('name', 'id'))
+
+    User.objects.bulk_create([User(username=name(n, 'u'), is_active=True) for n in numbers])
+    MWSUser.objects.bulk_create([MWSUser(user_id=name(n, 'u'), uid=100000 + n,
+                                         ssh_public_key="ssh-rsa %s" % name(n, 'key')) for n in numbers])
+    users = dict(User.objects.filter(username__in=[name(n, 'u') for n in numbers]).values_list('username', 'id'))
+    Site.users.through.objects.bulk_create(
+        [Site.users.through(site_id=sites[name(n)], user_id=users[name(n, 'u')]) for n in numbers] +
+        ([Site.users.through(site_id=site_id, user_id=user.id) for site_id in sites.values()] if user else []))
+
+    NetworkConfig.objects.bulk_create(
+        [NetworkConfig(IPv4=ipv4(2 * n), type='ipvxpub', name="%s.example" % name(n, '-prod')) for n in numbers] +
+        [NetworkConfig(IPv4=ipv4(2 * n + 1), type='ipv4priv', name="%s.example" % name(n, '-test'))
+         for n in numbers] +
+        [NetworkConfig(IPv6=ipv6(2 * n), type='ipv6', name="%s.example" % name(n, '-vm')) for n in numbers] +
+        [NetworkConfig(IPv6=ipv6(2 * n + 1), type='ipv6', name="%s.example" % name(n, '-testvm'))
+         for n in numbers])
+    netconfigs = dict(NetworkConfig.objects.filter(
+        name__in=["%s.example" % name(n, kind) for n in numbers for kind in ('-prod', '-test', '-vm', '-testvm')])
+        .values_list('name', 'id'))
+
+    Service.objects.bulk_create([
+        Service(site_id=sites[name(n)], type=service_type, status='ready',
+                network_configuration_id=netconfigs["%s.example" % name(n, kind)])
+        for n in numbers for service_type, kind in (('production', '-prod'), ('test', '-test'))])
+    services = dict(((site_id, service_type), service_id) for service_id, site_id, service_type in
+                    Service.objects.filter(site_id__in=sites.values()).values_list('id', 'site_id', 'type'))
+
+    VirtualMachine.objects.bulk_create([
+        VirtualMachine(name=name(n, kind), token=uuid.uuid4(), numcpu=server_type.numcpu,
+                       sizeram=server_type.sizeram, cluster=cluster,
+                       service_id=services[(sites[name(n)], service_type)],
+                       network_configuration_id=netconfigs["%s.example" % name(n, kind)])
+        for n in numbers for service_type, kind in (('production', '-vm'), ('test', '-testvm'))])
+    AnsibleConfiguration.objects.bulk_create([AnsibleConfiguration(service_id=service_id, key='os', value='stretch')
+                                              for service_id in services.values()])
+    production_services = dict((name(n), services[(sites[name(n)], 'production')]) for n in numbers)
+    PHPLib.services.through.objects.bulk_create([
+        PHPLib.services.through(phplib_id=php_lib.name, service_id=service_id)
+        for service_id in production_services.values() for php_lib in php_libs])
+
+    UnixGroup.objects.bulk_create([UnixGroup(name=name(n, 'g'), service_id=production_services[name(n)])
+                                   for n in numbers])
+    unix_groups = dict(UnixGroup.objects.filter(service_id__in=production_services.values())
+                       .values_list('name', 'id'))
+    UnixGroup.users.through.objects.bulk_create([
+        UnixGroup.users.through(unixgroup_id=unix_groups[name(n, 'g')], user_id=users[name(n, 'u')])
+        for n in numbers])
+
+    Vhost.objects.bulk_create([Vhost(name="default", service_id=service_id)
+                               for service_id in production_services.values()])
+    vhosts = dict(Vhost.objects.filter(service_id__in=production_services.values())
+                  .values_list('service_id', 'id'))
+    DomainName.objects.bulk_create([
+        DomainName(name="%s.%s.example" % (name(n), status), status=status,
+                   vhost_id=vhosts[production_services[name(n)]])
+        for n in numbers for status, _ in DomainName.STATUS_CHOICES])
+    for domain_id, vhost_id in DomainName.objects.filter(vhost_id__in=vhosts.values(), status='global') \
+            .values_list('id', 'vhost_id'):
+        Vhost.objects.filter(id=vhost_id).update(main_domain_id=domain_id)
+
+
+def measure(function, *args, **kwargs):
+    """
+    Runs function in a forked child process so that its memory use can be told apart from that of this process.
+
+    :return: a dict with the time it took in seconds ('seconds') and how much the resident set size of the child
+             grew in KB while running it ('rss_growth_kb')
+    """
+    # The child must not share the database connections of the parent
+    connections.close_all()
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        try:
+            initial_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            started = time.time()
+            function(*args, **kwargs)
+            os.write(write_end, json.dumps({'seconds': time.time() - started, 'initial_rss': initial_rss}))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as pipe:
+        result = pipe.read()
+    rusage = os.wait4(pid, 0)[2]
+    if not result:
+        raise RuntimeError("The benchmarked function failed, see the traceback above")
+    result = json.loads(result)
+    return {'seconds': result['seconds'], 'rss_growth_kb': rusage.ru_maxrss - result['initial_rss']}
+
+
+def buffered_inventory(outfile):
+    """
+    Writes the --list inventory as ansible_inventory did before it was streamed: the whole result is built in
+    memory, every hostvars parsed back from the cache, and dumped at the end. Kept as the baseline of the benchmark.
+    """
+    vms = inventory_vms()
+    vm_list = vms.select_related('network_configuration', 'service')
+    entries = cached_hostvars(vms)
+    result = {'_meta': {'hostvars': {}}, group: []}
+    site_vms = {}
+    for vm in vm_list:
+        if vm.id in entries:
+            result[group].append(hostid(vm))
+            result['_meta']['hostvars'][hostid(vm)] = json.loads(entries[vm.id].hostvars)
+            site_vms.setdefault(vm.service.site_id, []).append(hostid(vm))
+    for site_id in Site.objects.filter(end_date__isnull=True).values_list('id', flat=True):
+        result[sitegroup(site_id)] = site_vms.get(site_id, [])
+    json.dump(result, outfile)
+    outfile.write("\n")
+
+
+def time_queries(function, *args, **kwargs):
+    """
+    Runs function in this process
+
+    :return: a dict with the time it took in seconds ('seconds') and the number of database queries it made
+             ('queries')
+    """
+    connection.ensure_connection()
+    # Unlike CaptureQueriesContext, do not stop counting after BaseDatabaseWrapper.queries_limit queries
+    saved = connection.force_debug_cursor, connection.queries_log
+    connection.force_debug_cursor, connection.queries_log = True, deque()
+    try:
+        started = time.time()
+        function(*args, **kwargs)
+        return {'seconds': time.time() - started, 'queries': len(connection.queries_log)}
+    finally:
+        connection.force_debug_cursor, connection.queries_log = saved
+
+
+class Scenarios(object):
+    """
+    The requests whose performance is tracked by the benchmark command, against the fleet as it is when the
+    object is created. The site list is requested as the user given.
+    """
+    NAMES = ['ansible_inventory --list', 'ansible_inventory --host', 'bes', 'statsdatainuse', 'statsdataactive',
+             'site list']
+
+    def __init__(self, user):
+        self.client = Client()
+        self.user = user
+        self.devnull = open(os.devnull, 'w')
+        self.host = hostid(inventory_vms().select_related('network_configuration').order_by('-id')[0])
+
+    def run(self, name):
+        getattr(self, name.replace('ansible_inventory --', 'inventory_').replace(' ', '_'))()
+
+    def get(self, url_name):
+        response = self.client.get(reverse(url_name))
+        if response.status_code != 200:
+            raise RuntimeError("GET %s returned %d" % (url_name, response.status_code))
+
+    def inventory_list(self):
+        write_inventory(self.devnull)
+
+    def inventory_host(self):
+        from apimws.management.commands.ansible_inventory import Command
+        Command().handle(host=self.host, outfile=self.devnull)
+
+    def bes(self):
+        self.get('apimws.bes.bes')
+
+    def statsdatainuse(self):
+        self.get('apimws.views.statsdatainuse')
+
+    def statsdataactive(self):
+        self.get('apimws.views.statsdataactive')
+
+    def site_list(self):
+        # The view is called directly as logging in saves the user, which queries the lookup service, as does
+        # get_user_lookupgroups
+        request = RequestFactory().get(reverse('listsites'))
+        request.user = self.user
+        with patch('sitesmanagement.views.sites.get_user_lookupgroups', return_value=[]):
+            SiteList.as_view()(request).render()
@@ -1,35 +1,163 @@
-'''API to output data to Bes++'''
+'''
+API to output data to Bes++
+
+The full JSON lists every site to back up. The backup system can then poll with ?since=<cursor>, where the cursor is
+the X-Bes-Cursor header of the full JSON or the cursor of the last change feed, to get only the sites changed since.
+'''
+import hashlib
 import json
-from datetime import date
-from django.db.models import Q
-from django.http import HttpResponse
+from collections import defaultdict
+from datetime import date, timedelta
+from django.conf import settings
+from django.db.models import Case, Max, Min, Q, When
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseGone, HttpResponseNotModified
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
 from stronghold.decorators import public
-from sitesmanagement.models import Site, VirtualMachine
+from apimws.models import BesChange
+from libs.lrucache import LRUCache
+from sitesmanagement.models import Site, SiteKey, VirtualMachine
+
+
+# The JSON served and its ETag, kept for BES_CACHE_TTL seconds by each process. Changes to the sites, their services,
+# VMs and keys made by the process forget it (see sitesmanagement.signals).
+CACHE = LRUCache(1)
+CACHE_KEY = 'bes'
+
+
+def invalidate():
+    """Forgets the cached JSON, which is built again with the data just changed the next time it is requested"""
+    CACHE.delete(CACHE_KEY)
+
+
+def backed_up_sites():
+    # Each site once, even if several of its services are ready
+    # Do not backup sites that have been cancelled or sites that are not ready
+    # Backups from sites that disappear from the bes API will still be kept during 14 days before getting deleted
+    return Site.objects.filter(
+        Q(deleted=False, services__status__in=('ansible', 'ansible_queued', 'ready'))
+        & (Q(end_date__isnull=True) | Q(end_date__gt=date.today()))).distinct()
+
+
+def json_vm(vm, site):
+    json_vm = {}
+    json_vm['name'] = vm.name
+    json_vm['disabled'] = site.disabled
+    json_vm['fqdn'] = vm.network_configuration.name
+    json_vm['service_fqdn'] = vm.service.network_configuration.name
+    json_vm['location'] = 'mws-cluster-1'  # TODO change it for a variable in the model
+    json_vm['backup'] = ['/replicated']  # TODO change it for a variable?
+    json_vm['backup-user'] = "dump"  # TODO change it for a variable in the model
+    return json_vm
+
+
+def json_site(site, keys, vms):
+    json_site = {}
+    json_site['id'] = "mwssite-%s" % site.id
+    for sitekey in keys:
+        json_site['ssh-public-key-%s' % sitekey.type.lower()] = sitekey.public_key
+    json_site['vms'] = [json_vm(vm, site) for vm in vms]
+    return json_site
+
+
+def bes_sites(sites):
+    """The sites of the queryset given, as served by the bes API, with three queries whatever their number"""
+    site_ids = sites.order_by().values('id')
+    keys = defaultdict(list)
+    for sitekey in SiteKey.objects.filter(site__in=site_ids):
+        keys[sitekey.site_id].append(sitekey)
+    vms = defaultdict(list)
+    for vm in VirtualMachine.objects.filter(service__site__in=site_ids).select_related(
+            'network_configuration', 'service__network_configuration').order_by('id'):
+        vms[vm.service.site_id].append(vm)
+    return [json_site(site, keys[site.id], vms[site.id]) for site in sites]
+
+
+def bes_content():
+    """
+    The JSON served by the bes API, its ETag, the SHA-256 hash of the JSON, and the cursor of the last change of the
+    journal it includes, cached for BES_CACHE_TTL seconds
+    """
+    content = CACHE.get(CACHE_KEY)
+    if content is None:
+        # Read first, so that the changes made while the JSON is built are in the change feed as well
+        cursor = journal_bounds()[1]
+        body = json.dumps(bes_sites(backed_up_sites()))
+        content = (body, quote_etag(hashlib.sha256(body).hexdigest()), cursor)
+        CACHE.set(CACHE_KEY, content, getattr(settings, 'BES_CACHE_TTL', 60))
+    return content
+
+
+def record_changes(site_ids):
+    """Writes an entry of the change journal for each of the sites given"""
+    BesChange.objects.bulk_create([BesChange(site_id=site_id) for site_id in sorted(set(site_ids) - {None})])
+
+
+def journal_bounds():
+    """
+    The first and last cursors of the change journal, 0 if it is empty. The last one is that of the last entry
+    older than BES_JOURNAL_SETTLE seconds: ids are taken when the entries are written, not when their transaction
+    is committed, so a newer entry could be read before an older one still being committed, which would then be
+    behind the cursor of the client.
+    """
+    settled = timezone.now() - timedelta(seconds=getattr(settings, 'BES_JOURNAL_SETTLE', 10))
+    bounds = BesChange.objects.aggregate(first=Min('id'), last=Max(Case(When(created__lte=settled, then='id'))))
+    return bounds['first'] or 0, bounds['last'] or 0
+
+
+def bes_changes(since):
+    """
+    The change feed of the bes API: the sites changed after the cursor given, as in the full JSON, the ids of those
+    changed that are not to be backed up any more (their tombstones) and the cursor of the last change included.
+    The changes of the last BES_JOURNAL_SETTLE seconds are left for the next poll.
+
+    :return: None if the journal no longer has all the changes made after the cursor
+    """
+    first, last = journal_bounds()
+    if since < first - 1:
+        return None
+    if since >= last:
+        return {'cursor': since, 'sites': [], 'removed': []}
+    changes = BesChange.objects.filter(id__gt=since, id__lte=last)
+    sites = bes_sites(backed_up_sites().filter(id__in=changes.values('site_id')))
+    served = set(json_site['id'] for json_site in sites)
+    removed = ["mwssite-%s" % site_id for site_id in sorted(set(changes.values_list('site_id', flat=True)))]
+    return {'cursor': last, 'sites': sites, 'removed': [site_id for site_id in removed if site_id not in served]}
+
+
+def record_cancellations(today=None):
+    """Writes to the change journal the sites that are no longer backed up from today, their end date"""
+    record_changes(Site.objects.filter(end_date=today or date.today()).values_list('id', flat=True))
+
+
+def prune_journal(now=None):
+    """Deletes the entries of the change journal older than BES_JOURNAL_DAYS days, but the last one"""
+    limit = (now or timezone.now()) - timedelta(days=getattr(settings, 'BES_JOURNAL_DAYS', 14))
+    last = BesChange.objects.aggregate(last=Max('id'))['last'] or 0
+    return BesChange.objects.filter(created__lt=limit, id__lt=last).delete()[0]
 
 
 @public
 def bes(request):
-    json_all = []
-    for site in Site.objects.filter(
-                    Q(deleted=False, services__status__in=('ansible', 'ansible_queued', 'ready'))
-                    & (Q(end_date__isnull=True) | Q(end_date__gt=date.today()))):
-        # Do not backup sites that have been cancelled or sites that are not ready
-        # Backups from sites that disappear from the bes API will still be kept during 14 days before getting deleted
-        json_site = {}
-        json_site['id'] = "mwssite-%s" % site.id
-        for sitekey in site.keys.all():
-            json_site['ssh-public-key-%s' % sitekey.type.lower()] = sitekey.public_key
-        json_vms = []
-        for vm in VirtualMachine.objects.filter(service__site = site):
-            json_vm = {}
-            json_vm['name'] = vm.name
-            json_vm['disabled'] = vm.service.site.disabled
-            json_vm['fqdn'] = vm.network_configuration.name
-            json_vm['service_fqdn'] = vm.service.network_configuration.name
-            json_vm['location'] = 'mws-cluster-1'  # TODO change it for a variable in the model
-            json_vm['backup'] = ['/replicated']  # TODO change it for a variable?
-            json_vm['backup-user'] = "dump"  # TODO change it for a variable in the model
-            json_vms.append(json_vm)
-        json_site['vms'] = json_vms
-        json_all.append(json_site)
-    return HttpResponse(json.dumps(json_all), content_type='application/json')
+    if 'since' in request.GET:
+        try:
+            since = int(request.GET['since'])
+        except ValueError:
+            return HttpResponseBadRequest("since is not a cursor")
+        changes = bes_changes(since)
+        if changes is None:
+            # The backup system has to download the full JSON again
+            return HttpResponseGone("The cursor has expired")
+        return HttpResponse(json.dumps(changes), content_type='application/json')
+    body, etag, cursor = bes_content()
+    # If-None-Match uses the weak comparison, W/ prefixes are ignored
+    etags = [tag[2:] if tag.startswith('W/') else tag for tag in
+             parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))]
+    if '*' in etags or etag in etags:
+        # The backup system already has this data
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    response['X-Bes-Cursor'] = cursor
+    return response
@@ -0,0 +1,401 @@
+'''Ansible inventory built from bulk-loaded MWS data'''
+import hashlib
+import json
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Prefetch, Q
+from django.utils import timezone
+from apimws.lv import update_lv_list
+from apimws.models import AnsibleConfiguration, PHPLib, PHPPackage, HostvarsCache
+from sitesmanagement.models import VirtualMachine, Site, Service, Vhost, DomainName, UnixGroup
+
+
+group = "mwsclients"
+# We start Unix Group IDs by the 2^16-2 which is the last one free in Debian
+# and assign them to groups in decrease order
+INITIAL_GID = 4294967293
+
+
+# At this moment we only support OV Quovadis
+CERT_CHAIN = '''-----BEGIN CERTIFICATE-----
+MIIFTDCCAzSgAwIBAgIUSJgt4qkssznhyPkzNYJ10+T4glUwDQYJKoZIhvcNAQEL
+BQAwRTELMAkGA1UEBhMCQk0xGTAXBgNVBAoTEFF1b1ZhZGlzIExpbWl0ZWQxGzAZ
+BgNVBAMTElF1b1ZhZGlzIFJvb3QgQ0EgMjAeFw0xMzA2MDExMzM1MDVaFw0yMzA2
+MDExMzM1MDVaME0xCzAJBgNVBAYTAkJNMRkwFwYDVQQKExBRdW9WYWRpcyBMaW1p
+dGVkMSMwIQYDVQQDExpRdW9WYWRpcyBHbG9iYWwgU1NMIElDQSBHMjCCASIwDQYJ
+KoZIhvcNAQEBBQADggEPADCCAQoCggEBAOHhhWmUwI9X+jT+wbho5JmQqYh6zle3
+0OS1VMIYfdDDGeipY4D3t9zSGaNasGDZdrQdMlY18WyjnEKhi4ojNZdBewVphCiO
+zh5Ni2Ak8bSI/sBQ9sKPrpd0+UCqbvaGs6Tpx190ZRT0Pdy+TqOYZF/jBmzBj7Yf
+XJmWxlfCy62UiQ6tvv+4C6W2OPu1R4HUD8oJ8Qo7Eg0cD+GFsBM2w8soffyl+Dc6
+pKtARmOClUC7EqyWP0V9953lA34kuJZlYxxdgghBTn9rWoaQw/Lr5Fn0Xgd7fYS3
+/zGhmXYvVsuAxIn8Gk+YaeoLZ8H9tUvnDD3lEHzvIsMPxqtd7IgcVaMCAwEAAaOC
+ASowggEmMBIGA1UdEwEB/wQIMAYBAf8CAQAwEQYDVR0gBAowCDAGBgRVHSAAMHIG
+CCsGAQUFBwEBBGYwZDAqBggrBgEFBQcwAYYeaHR0cDovL29jc3AucXVvdmFkaXNn
+bG9iYWwuY29tMDYGCCsGAQUFBzAChipodHRwOi8vdHJ1c3QucXVvdmFkaXNnbG9i
+YWwuY29tL3F2cmNhMi5jcnQwDgYDVR0PAQH/BAQDAgEGMB8GA1UdIwQYMBaAFBqE
+YrxITDMlBNTu0PYDxBlG0ZRrMDkGA1UdHwQyMDAwLqAsoCqGKGh0dHA6Ly9jcmwu
+cXVvdmFkaXNnbG9iYWwuY29tL3F2cmNhMi5jcmwwHQYDVR0OBBYEFJEZYq1bF6cw
++/DeOSWxvYy5uFEnMA0GCSqGSIb3DQEBCwUAA4ICAQB8CmCCAEG1Lcw55fTba84A
+ipwMieZydFO5bcIh5UyXWgWZ6OP4jb/6LaifEMLjRCC0mU14G6PrPU+iZQiIae7X
+5EavhmETEA8JbLICjiD4c9Y6+bgMt4szEPiZ2SALOQj10Br4HKQfy/OvbedRbLax
+p9qlDG4qJgSt3uikDIJSarx6mpgEQXu00UZNkiEYUfeO8hXGXrZbtDnkuaiVDtM6
+s9yYpcoyFxFOrORrEgViaI7P3EJaDYmI6IDUIPaSBM6GrVMiaINYEMBL1v2jZi8r
+XDY0yVsZ/0DAIQiCBNNvT1NjQ5Sn1E+O+ZBiqDD+rBvBoPsI6ydfdKtJur5YL+Oo
+kJK2eLrce8287awIcd8FMRDcZw/NX1bc8uKye5OCtwpQ0d4jL4emuXwFv8TqUbZh
+2xJShyy57cqw3qWoBOs/WWza29/Hun8PXkQoZepwY/xc+9nI1NaKM8NqhSqJNTJl
+vXj7zb3mdpbe3YR9BkSXProlN7l5KOx54gJ7kJ7r6qJYJux03HyPM11Kp4wfdn1R
+sC2UQ5awC6fg/3XE2HZVkyqJjKwqh4nFaiK5EMV7DHQ4oJx9ckmDw6pBvDaoPokX
+yzdfJ72n+1JfHGP+workciKNldgqYX6J4jPrCIEIBrtDta4QxP10Tyd9RFu13XmE
+8SYi/VXvrf3nriQfAZ/nSA==
+-----END CERTIFICATE-----'''
+
+
+# Maximum number of VMs whose hostvars are built and stored together when filling the cache
+CACHE_FILL_CHUNK = 500
+
+
+def inventory_vms():
+    """Returns the VMs that are part of the Ansible inventory"""
+    return VirtualMachine.objects.filter(
+        service__status__in=('ansible', 'ansible_queued', 'ready', 'postinstall'),
+        service__site__disabled=False, service__site__deleted=False, service__site__end_date__isnull=True)
+
+
+def sitegroup(site_id):
+    return "mwssite-%d" % (site_id,)
+
+
+def servicegroup(service_id):
+    return "mwsservice-%d" % (service_id,)
+
+
+def hostid(vm):
+    return vm.network_configuration.name
+
+
+class Inventory(object):
+    """
+    Loads everything needed to build the hostvars of a set of VMs in a fixed number of queries and keeps it
+    in memory indexed by site and service id. The number of queries does not depend on the number of VMs or
+    sites in the queryset, only the expansion of lookup groups into users calls the lookup service per group.
+    """
+
+    def __init__(self, vms):
+        self.vms = list(vms.select_related('network_configuration', 'service__network_configuration'))
+        site_ids = vms.values('service__site_id')
+
+        user_queryset = User.objects.select_related('mws_user')
+        self.sites = Site.objects.filter(id__in=site_ids).prefetch_related(
+            Prefetch('users', queryset=user_queryset), Prefetch('ssh_users', queryset=user_queryset),
+            Prefetch('supporters', queryset=user_queryset), 'groups', 'ssh_groups').in_bulk()
+
+        self.services = {}
+        self.production_service = {}
+        self.test_service = {}
+        for service in Service.objects.filter(site_id__in=site_ids).select_related(
+                'network_configuration').order_by('pk'):
+            self.services[service.id] = service
+            # Same as Site.production_service and Site.test_service, the first one wins
+            if service.type == 'production':
+                self.production_service.setdefault(service.site_id, service)
+            elif service.type == 'test':
+                self.test_service.setdefault(service.site_id, service)
+
+        self.num_vms = dict(VirtualMachine.objects.filter(service__site_id__in=site_ids).values_list(
+            'service_id').annotate(num=Count('id')).order_by())
+
+        self.vhosts = defaultdict(list)
+        for vhost in Vhost.objects.filter(service__site_id__in=site_ids).select_related(
+                'main_domain').order_by('pk'):
+            self.vhosts[vhost.service_id].append(vhost)
+
+        self.domain_names = defaultdict(list)
+        for vhost_id, name, status in DomainName.objects.filter(vhost__service__site_id__in=site_ids).order_by(
+                'pk').values_list('vhost_id', 'name', 'status'):
+            self.domain_names[vhost_id].append((name, status))
+
+        self.operating_system = dict(AnsibleConfiguration.objects.filter(
+            service__site_id__in=site_ids, key='os').values_list('service_id', 'value'))
+
+        self.php_packages = defaultdict(list)
+        for name, library_id, os in PHPPackage.objects.order_by('pk').values_list('name', 'library_id', 'os'):
+            self.php_packages[os].append((name, library_id))
+
+        self.php_libs = defaultdict(set)
+        for service_id, phplib_id in PHPLib.services.through.objects.filter(
+                service__site_id__in=site_ids).values_list('service_id', 'phplib_id'):
+            self.php_libs[service_id].add(phplib_id)
+
+        self.unix_groups = defaultdict(list)
+        for unix_group in UnixGroup.objects.filter(service__site_id__in=site_ids).select_related(
+                'service').order_by('pk'):
+            self.unix_groups[unix_group.service.site_id].append(unix_group)
+
+        self.unix_groups_of_user = defaultdict(list)
+        for site_id, user_id, name in UnixGroup.users.through.objects.filter(
+                unixgroup__service__site_id__in=site_ids, unixgroup__to_be_deleted=False).order_by(
+                'unixgroup_id').values_list('unixgroup__service__site_id', 'user_id', 'unixgroup__name'):
+            self.unix_groups_of_user[(site_id, user_id)].append(name)
+
+        self.update_lv_list_url = "%s%s" % (settings.MAIN_DOMAIN, reverse(update_lv_list))
+
+    def site_vms(self):
+        """Returns a dict of the list of VMs of each site"""
+        result = defaultdict(list)
+        for vm in self.vms:
+            result[vm.service.site_id].append(vm)
+        return result
+
+    def user_vars(self, user, site):
+        uv = {}
+        uv['username'] = user.username
+        uv['groups'] = self.unix_groups_of_user.get((site.id, user.id), [])
+        if hasattr(user, "mws_user") and user.mws_user.uid is not None:
+            uv['uid'] = user.mws_user.uid
+            if user.mws_user.ssh_public_key:
+                uv['ssh_key'] = user.mws_user.ssh_public_key
+        return uv
+
+    def domains(self, vhost, subset=Vhost.ALL_NAMES):
+        """Same as Vhost.domains but using the domain names already loaded"""
+        names = self.domain_names[vhost.id]
+        if subset is Vhost.ALL_NAMES:
+            return [name for name, status in names if status not in Vhost.ALL_NAMES]
+        elif subset is Vhost.GLOBAL_NAMES:
+            service_hostname = self.services[vhost.service_id].network_configuration.name
+            return [name for name, status in names if status in Vhost.GLOBAL_NAMES and name != service_hostname]
+        elif subset is Vhost.PRIVATE_AND_GLOBAL_NAMES:
+            return [name for name, status in names if status in Vhost.PRIVATE_AND_GLOBAL_NAMES]
+        raise ValueError('Unknown subset type: %r' % (subset,))
+
+    def vhost_vars(self, vh):
+        # List of variables for each vhost
+        vhv = {}
+        vhv['id'] = vh.id
+        vhv['name'] = vh.name
+        # List of all hostnames accepted at least once.
+        vhv['domains'] = self.domains(vh)
+        # Dict of lists of hostnames that certain certificate providers can support, keyed by provider
+        vhv['cert_domains'] = {
+            # ACME (Let's Encrypt) can only certify hostnames it can resolve
+            'acme': self.domains(vh, subset=Vhost.GLOBAL_NAMES),
+            # QuoVadis will certify tentative and private hostnames as well
+            'qv': self.domains(vh, subset=Vhost.PRIVATE_AND_GLOBAL_NAMES),
+        }
+        # The main domain where all the domain names associated will redirect to
+        if vh.main_domain:
+            vhv['main_domain'] = vh.main_domain.name
+        # The TLS certificate if already uploaded
+        if vh.certificate:
+            vhv['certificate'] = vh.certificate
+            vhv['certificatechain'] = vh.certificate_chain or CERT_CHAIN
+        if vh.tls_key_hash:
+            vhv['tls_key_hash'] = vh.tls_key_hash
+        # If is TLS enabled whether the certificate has been yet uploaded or not
+        vhv['tls_enabled'] = vh.tls_enabled
+        # Generate csr if there is a request from the web panel
+        vhv['generate_csr'] = 'tls_key_hash' in vhv and vh.tls_key_hash == "requested"
+        vhv['generate_csr_renewal'] = 'tls_key_hash' in vhv and vh.tls_key_hash == "renewal"
+        vhv['generate_csr_renewal_cert'] = 'tls_key_hash' in vhv and vh.tls_key_hash == "renewal_waiting_cert"
+        vhv['generate_renewal_cert'] = 'tls_key_hash' in vhv and vh.tls_key_hash == "renewal_cert"
+        # Type of webapp: wordpress, drupal, etc.
+        vhv['webapp'] = vh.webapp
+        return vhv
+
+    def hostvars(self, vm):
+        service = self.services[vm.service_id]
+        site = self.sites[service.site_id]
+        production_service = self.production_service.get(site.id)
+        test_service = self.test_service.get(site.id)
+
+        v = {}
+        v['ansible_host'] = (vm.network_configuration.name or
+                             vm.network_configuration.IPv4 or
+                             vm.network_configuration.IPv6)
+        v['mws_name'] = site.name
+        v['mws_webmaster_email'] = site.email
+
+        # List of active users (admin and ssh only) together with the list of supporters
+        v['mws_users'] = [self.user_vars(u, site) for u in
+                          site.list_of_all_type_of_active_users() + list(site.supporters.all())]
+
+        # List of Vhosts of the production service (the test service uses the production one)
+        if service.primary:
+            v['mws_vhosts'] = [self.vhost_vars(vh) for vh in self.vhosts[service.id]]
+        else:
+            v['mws_vhosts'] = [self.vhost_vars(vh) for vh in self.vhosts[production_service.id]]
+
+        # Is the VM the production or the test one?
+        v['mws_is_primary'] = service.primary
+
+        # Has this an active test Service?
+        v['mws_test_active'] = self.num_vms.get(test_service.id, 0) > 0 if test_service else False
+        v['mws_test_name'] = test_service.network_configuration.name if test_service else ""
+
+        # Network configuration of the VM
+        if vm.network_configuration.IPv4:
+            v['mws_ipv4'] = vm.network_configuration.IPv4
+            v['mws_ipv4_netmask'] = vm.network_configuration.IPv4_netmask
+            v['mws_ipv4_gateway'] = vm.network_configuration.IPv4_gateway
+        if vm.network_configuration.IPv6:
+            v['mws_ipv6'] = vm.network_configuration.IPv6
+
+        # is there any vhost TLS enabled? That is used later on to use http or https for
+        # redirections that do not match any vhost
+        v['mws_tls_enabled'] = any(['certificate' in vhv for vhv in v['mws_vhosts']])
+
+        # version of the operating system
+        v['mws_os'] = self.operating_system.get(service.id)
+
+        # mws_site_group refers to the Ansible host group representing
+        # this host's site.
+        v['mws_site_group'] = sitegroup(site.id)
+        # mws_site_id is a convenient string identifying the site for use
+        # in filenames etc.
+        v['mws_site_id'] = v['mws_site_group']
+
+        # mws_service_group refers to the Ansible host group representing
+        # this host's service.
+        v['mws_service_group'] = servicegroup(service.id)
+        v['mws_service_fqdn'] = service.network_configuration.name
+        v['mws_service_ipv4'] = service.network_configuration.IPv4
+        v['mws_service_ipv4_netmask'] = service.network_configuration.IPv4_netmask
+        v['mws_service_ipv4_gateway'] = service.network_configuration.IPv4_gateway
+        v['mws_service_ipv6'] = service.network_configuration.IPv6
+
+        pkgs = self.php_packages[v['mws_os']]
+        libs = self.php_libs[service.id]
+
+        # List of PHP libraries to be installed
+        v['mws_php_libs_enabled'] = [name for name, library_id in pkgs if library_id in libs]
+
+        # List of PHP libraries to be deleted
+        v['mws_php_libs_disabled'] = [name for name, library_id in pkgs if library_id not in libs]
+
+        # List of Unix groups and their associated gids
+        v['mws_unix_groups'] = [{'name': unix_group.name, 'gid': INITIAL_GID-unix_group.id}
+                                for unix_group in self.unix_groups[site.id] if not unix_group.to_be_deleted]
+
+        # List of Unix Groups to be deleted
+        v['mws_delete_unix_groups'] = [{'name': unix_group.name}
+                                       for unix_group in self.unix_groups[site.id] if unix_group.to_be_deleted]
+
+        # Let ansible know if the VM should be quarantined (apache and exim services disabled)
+        v['mws_quarantined'] = service.quarantined
+
+        # URL to the panel to inform about the deletion of LVs
+        v['mws_update_lv_list_url'] = self.update_lv_list_url
+
+        # has this site been migrated to Openstack
+        v['mws_migrated'] = site.migrated
+
+        return v
+
+
+def cache_threshold():
+    """Cache entries updated before this time are considered stale"""
+    return timezone.now() - timedelta(seconds=getattr(settings, 'MWS_HOSTVARS_CACHE_MAX_AGE', 3600))
+
+
+def cached_hostvars(vms):
+    """
+    Returns a dict of HostvarsCache entries keyed by VM id for the VMs of the queryset. Entries missing from the
+    cache or older than MWS_HOSTVARS_CACHE_MAX_AGE seconds (lookup group membership changes are not signalled)
+    are built and stored first.
+    """
+    entries = HostvarsCache.objects.filter(vm__in=vms, updated__gte=cache_threshold()).in_bulk()
+    missing = [vm_id for vm_id in vms.values_list('pk', flat=True) if vm_id not in entries]
+    for i in range(0, len(missing), CACHE_FILL_CHUNK):
+        chunk = missing[i:i+CACHE_FILL_CHUNK]
+        inventory = Inventory(VirtualMachine.objects.filter(pk__in=chunk))
+        new_entries = []
+        for vm in inventory.vms:
+            hostvars = json.dumps(inventory.hostvars(vm), sort_keys=True)
+            new_entries.append(HostvarsCache(vm=vm, hostname=hostid(vm), hostvars=hostvars,
+                                             digest=hashlib.sha256(hostvars).hexdigest()))
+        hostnames = [entry.hostname for entry in new_entries]
+        try:
+            with transaction.atomic():
+                # Entries of VMs that had the hostname of one of these before are stale as well
+                HostvarsCache.objects.filter(Q(vm__in=chunk) | Q(hostname__in=hostnames)).delete()
+                HostvarsCache.objects.bulk_create(new_entries)
+        except IntegrityError:
+            # Another process filled the cache at the same time, our entries are as good as theirs
+            pass
+        entries.update((entry.vm_id, entry) for entry in new_entries)
+    return entries
+
+
+def host_hostvars(hostname):
+    """
+    Returns the hostvars of the VM with the hostname given serialised as JSON, or None if there is no such VM in
+    the inventory. Fresh cache entries are read with a single lookup of the hostname index.
+    """
+    entry = HostvarsCache.objects.filter(hostname=hostname, updated__gte=cache_threshold()).first()
+    if entry is None:
+        entries = cached_hostvars(VirtualMachine.objects.filter(network_configuration__name=hostname))
+        entry = entries.values()[0] if entries else None
+    return entry.hostvars if entry else None
+
+
+def write_inventory(outfile, chunk_size=CACHE_FILL_CHUNK):
+    """
+    Writes the --list inventory to outfile as JSON with sorted keys. The VMs are read with a server-side cursor and
+    only their hostnames, which make up the groups, are kept in memory. Their hostvars, which make up most of the
+    output, are written as they are fetched from the cache, chunk_size VMs at a time. The content is that of the
+    inventory built in memory before, but its keys are no longer in the order of the dicts it was dumped from.
+    """
+    groups = {group: []}
+    for site_id in Site.objects.filter(end_date__isnull=True).values_list('id', flat=True).iterator():
+        groups[sitegroup(site_id)] = []
+    hosts = []
+    vms = inventory_vms().values_list('id', 'network_configuration__name', 'service__site_id')
+    for vm_id, hostname, site_id in vms.iterator():
+        hosts.append((hostname, vm_id))
+        groups[group].append(hostname)
+        if sitegroup(site_id) in groups:
+            groups[sitegroup(site_id)].append(hostname)
+    # hostvars are written in the same order as json.dump(..., sort_keys=True) would
+    hosts.sort()
+
+    outfile.write("{")
+    for index, key in enumerate(sorted(groups.keys() + ['_meta'])):
+        if index:
+            outfile.write(", ")
+        outfile.write(json.dumps(key) + ": ")
+        if key != '_meta':
+            outfile.write(json.dumps(groups[key]))
+            continue
+        outfile.write('{"hostvars": {')
+        separator = ""
+        for i in range(0, len(hosts), chunk_size):
+            chunk = hosts[i:i+chunk_size]
+            entries = cached_hostvars(VirtualMachine.objects.filter(pk__in=[vm_id for hostname, vm_id in chunk]))
+            for hostname, vm_id in chunk:
+                if vm_id not in entries:  # deleted since the list of VMs was read
+                    continue
+                outfile.write("%s%s: %s" % (separator, json.dumps(hostname), entries[vm_id].hostvars))
+                separator = ", "
+        outfile.write("}}")
+    outfile.write("}\n")
+
+
+def service_fingerprint(service):
+    """
+    Returns the SHA-256 of the hostvars of all the VMs of the service, i.e. of the state that Ansible would
+    apply to them
+    """
+    entries = cached_hostvars(service.virtual_machines.all())
+    return hashlib.sha256("\n".join(entries[vm_id].digest for vm_id in sorted(entries))).hexdigest()
+
+
+def invalidate_hostvars(*args, **kwargs):
+    """
+    Deletes the cached hostvars matching the filter given, e.g. invalidate_hostvars(vm__service__site=site),
+    or all of them if no filter is given
+    """
+    HostvarsCache.objects.filter(*args, **kwargs).delete()
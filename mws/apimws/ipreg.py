@@ -1,14 +1,41 @@
+import copy
 import json
 import logging
 import subprocess
 from celery import shared_task
 from django.conf import settings
 from apimws.jackdaw import SSHTaskWithFailure
+from libs.lrucache import LRUCache
 
 LOGGER = logging.getLogger('mws')
 
+# Responses to the get calls, keyed by (hostname, record type), kept for IP_REG_CACHE_TTL seconds
+READ_CACHE = LRUCache(getattr(settings, 'IP_REG_CACHE_SIZE', 1000))
+RECORD_TYPES = ('nameinfo', 'cname', 'sshfp')
+
+
+def invalidate_cached_reads(hostname):
+    """Forgets the cached responses to the get calls about hostname, which has just been changed"""
+    for record_type in RECORD_TYPES:
+        READ_CACHE.delete((hostname, record_type))
+
+
+def read_cache_stats():
+    """The number of get calls answered from the cache (hits) and made to the endpoint (misses)"""
+    return READ_CACHE.stats()
+
 
 def ip_reg_call(call):
+    """
+    Makes the ip-register API call given. The responses to get calls are cached, and put and delete calls forget
+    the cached responses about the hostname they change.
+    """
+    if call[0] == 'get':
+        cached = READ_CACHE.get((call[2], call[1]))
+        if cached is not None:
+            return copy.deepcopy(cached)
+    else:
+        invalidate_cached_reads(call[2])
     try:
         response = subprocess.check_output(settings.IP_REG_API_END_POINT + call)
     except subprocess.CalledProcessError as excp:
@@ -21,9 +48,122 @@ def ip_reg_call(call):
     except ValueError as e:
         LOGGER.error("IPREG API response to call (%s) is not properly formatted: %s", call, response)
         raise e
+    if call[0] == 'get':
+        READ_CACHE.set((call[2], call[1]), copy.deepcopy(result), getattr(settings, 'IP_REG_CACHE_TTL', 60))
     return result
 
 
+def ip_reg_batch_call(calls):
+    """
+    Makes all the ip-register API calls given with a single invocation of the 'batch' call of the endpoint, which
+    reads the list of calls as JSON from its standard input and writes a list with the response to each one of
+    them, including their own status, in the same order. Only used if IP_REG_API_BATCH is set, as the endpoint
+    needs to support the batch call.
+
+    :return: the list of responses, with a CalledProcessError in place of those with a status other than 0
+    """
+    for call in calls:
+        if call[0] != 'get':
+            invalidate_cached_reads(call[2])
+    command = settings.IP_REG_API_END_POINT + ['batch']
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    response, stderr = process.communicate(json.dumps(calls))
+    if process.returncode != 0:
+        LOGGER.error("IPREG API Call: %s\n\nFAILED with exit code %i:\n%s%s"
+                     % (command, process.returncode, response, stderr))
+        raise subprocess.CalledProcessError(process.returncode, command, response)
+    try:
+        responses = json.loads(response)
+    except ValueError as e:
+        LOGGER.error("IPREG API response to batch call (%s) is not properly formatted: %s", calls, response)
+        raise e
+    if not isinstance(responses, list) or len(responses) != len(calls):
+        LOGGER.error("IPREG API response to batch call (%s) does not answer every call: %s", calls, response)
+        raise ValueError("IPREG API response to batch call does not answer every call")
+    results = []
+    for call, result in zip(calls, responses):
+        if result.get('status', 0) != 0:
+            LOGGER.error("IPREG API Call: %s\n\nFAILED with status %i:\n%s"
+                         % (call, result['status'], result.get('message')))
+            result = subprocess.CalledProcessError(result['status'], settings.IP_REG_API_END_POINT + call,
+                                                   json.dumps(result))
+        results.append(result)
+    return results
+
+
+class IPRegBatch(object):
+    """
+    Collects ip-register API calls to make them all at once when run, or when leaving the with block it is used
+    in, with a single invocation of the endpoint if IP_REG_API_BATCH is set or one after the other otherwise.
+
+    with IPRegBatch() as batch:
+        batch.set_sshfp(hostname, algorithm, fptype, fingerprint)
+        batch.delete_cname(hostname)
+    batch.raise_for_errors()
+
+    results holds the response to each call, or the CalledProcessError it failed with, in the order they were
+    added.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+    def add(self, call):
+        self.calls.append([str(argument) for argument in call])
+
+    def get_nameinfo(self, hostname):
+        self.add(['get', 'nameinfo', hostname])
+
+    def get_cname(self, hostname):
+        self.add(['get', 'cname', hostname])
+
+    def set_cname(self, hostname, target):
+        self.add(['put', 'cname', hostname, target])
+
+    def delete_cname(self, hostname):
+        self.add(['delete', 'cname', hostname])
+
+    def get_sshfp(self, hostname):
+        self.add(['get', 'sshfp', hostname])
+
+    def set_sshfp(self, hostname, algorithm, fptype, fingerprint):
+        self.add(['put', 'sshfp', hostname, algorithm, fptype, fingerprint])
+
+    def delete_sshfp(self, hostname, algorithm, fptype):
+        self.add(['delete', 'sshfp', hostname, algorithm, fptype])
+
+    def run(self):
+        if not self.calls:
+            self.results = []
+        elif getattr(settings, 'IP_REG_API_BATCH', False):
+            self.results = ip_reg_batch_call(self.calls)
+        else:
+            self.results = []
+            for call in self.calls:
+                try:
+                    self.results.append(ip_reg_call(call))
+                except subprocess.CalledProcessError as excp:
+                    self.results.append(excp)
+        return self.results
+
+    def errors(self):
+        """The calls that failed, with the CalledProcessError each one of them failed with"""
+        return [(call, result) for call, result in zip(self.calls, self.results)
+                if isinstance(result, subprocess.CalledProcessError)]
+
+    def raise_for_errors(self):
+        for call, excp in self.errors():
+            raise excp
+
+
 def get_nameinfo(hostname):
     try:
         result = ip_reg_call(['get', 'nameinfo', str(hostname)])
@@ -0,0 +1,56 @@
+'''
+Locks shared by all the workers, kept in the database, that tasks take so that only one of them works on the same
+thing at a time. A lock expires after TASK_LOCK_TTL seconds, in case its owner died without releasing it.
+
+with task_lock("vm-%d-power" % vm.id) as acquired:
+    if acquired:
+        ...
+
+'''
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from apimws.models import TaskLock
+
+
+def acquire(key, ttl=None):
+    """
+    Acquires the lock with the key given for ttl seconds (TASK_LOCK_TTL by default) if it is free or has expired,
+    with a single query in most cases.
+
+    :return: the owner token needed to release it, None if it is held by someone else
+    """
+    if ttl is None:
+        ttl = getattr(settings, 'TASK_LOCK_TTL', 10*60)
+    owner = uuid.uuid4().hex
+    now = timezone.now()
+    expires = now + timedelta(seconds=ttl)
+    try:
+        with transaction.atomic():
+            TaskLock.objects.create(key=key, owner=owner, expires=expires)
+        return owner
+    except IntegrityError:
+        pass
+    # It is held, or it was and it has expired, in which case it is taken over
+    if TaskLock.objects.filter(key=key, expires__lte=now).update(owner=owner, expires=expires):
+        return owner
+    return None
+
+
+def release(key, owner):
+    """Releases the lock with the key given if it is still held by the owner, returns whether it was"""
+    return TaskLock.objects.filter(key=key, owner=owner).delete()[0] > 0
+
+
+@contextmanager
+def task_lock(key, ttl=None):
+    """Acquires the lock with the key given for the duration of the with block, yields whether it was acquired"""
+    owner = acquire(key, ttl)
+    try:
+        yield owner is not None
+    finally:
+        if owner is not None:
+            release(key, owner)
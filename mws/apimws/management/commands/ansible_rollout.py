@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from apimws.ansible import ansible_rollout
+
+
+class Command(BaseCommand):
+    help = "Runs Ansible against every ready MWS server in batches of hosts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, dest="batch_size",
+                            help="number of hosts per ansible-playbook run (default ANSIBLE_ROLLOUT_BATCH_SIZE)")
+        parser.add_argument("--forks", type=int,
+                            help="number of hosts of a batch configured in parallel (default ANSIBLE_ROLLOUT_FORKS)")
+        parser.add_argument("--changed-only", action='store_true', dest="changed_only",
+                            help="only include the servers whose configuration has changed since their last run")
+        parser.add_argument("--queue", action='store_true',
+                            help="run the rollout in a Celery worker instead of in this process")
+
+    def handle(self, *args, **options):
+        kwargs = {
+            'batch_size': options['batch_size'],
+            'forks': options['forks'],
+            'changed_only': options['changed_only'],
+        }
+        if options['queue']:
+            ansible_rollout.delay(**kwargs)
+            self.stdout.write("Rollout queued")
+            return
+        result = ansible_rollout(**kwargs)
+        self.stdout.write("%d hosts configured, %d failed" % (len(result['ok']), len(result['failed'])))
+        for hostname in result['failed']:
+            self.stdout.write("Failed: %s" % hostname)
@@ -0,0 +1,81 @@
+import json
+import os
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test.runner import DiscoverRunner
+from apimws.benchmark import create_fleet, time_queries, Scenarios
+from mwsauth.models import MWSUser
+
+BASELINE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                        'benchmark_baseline.json')
+# A scenario is reported as a regression when it takes this many times longer than in the baseline
+SLOWDOWN_THRESHOLD = 1.5
+
+
+class Command(BaseCommand):
+    help = "Times and counts the queries of ansible_inventory, bes, the stats data views and the site list with " \
+           "synthetic fleets of increasing size, and compares them with a stored baseline. The fleets are created " \
+           "in a test database, the configured one is not modified."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sites", type=int, nargs='+', default=[100, 1000, 10000],
+                            help="fleet sizes to measure, in number of sites (default 100 1000 10000)")
+        parser.add_argument("--repeat", type=int, default=3,
+                            help="number of times each scenario is run, the fastest one is reported (default 3)")
+        parser.add_argument("--baseline", default=BASELINE,
+                            help="JSON file with the baseline results (default %s)" % BASELINE)
+        parser.add_argument("--save-baseline", action='store_true', dest="save_baseline",
+                            help="store the results as the new baseline")
+
+    def handle(self, *args, **options):
+        baseline = {}
+        if os.path.exists(options['baseline']):
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+        results = {}
+        regressions = 0
+
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        runner.setup_test_environment()
+        old_config = runner.setup_databases()
+        try:
+            User.objects.bulk_create([User(username="benchadmin", is_active=True)])
+            MWSUser.objects.bulk_create([MWSUser(user_id="benchadmin", uid=99999)])
+            user = User.objects.get(username="benchadmin")
+            self.stdout.write("%-26s %6s %9s %8s %9s %8s" % ("scenario", "sites", "seconds", "queries",
+                                                             "baseline", "queries"))
+            fleet_size = 0
+            for num_sites in sorted(options['sites']):
+                create_fleet(num_sites - fleet_size, start=fleet_size, user=user)
+                fleet_size = num_sites
+                scenarios = Scenarios(user)
+                for name in Scenarios.NAMES:
+                    runs = [time_queries(scenarios.run, name) for _ in range(options['repeat'])]
+                    # The first run fills the caches, the number of queries is that of the last one
+                    result = {'seconds': round(min(run['seconds'] for run in runs), 4),
+                              'queries': runs[-1]['queries']}
+                    results.setdefault(name, {})[str(num_sites)] = result
+                    expected = baseline.get(name, {}).get(str(num_sites))
+                    if expected is None:
+                        self.stdout.write("%-26s %6d %9.3f %8d %9s %8s" % (name, num_sites, result['seconds'],
+                                                                           result['queries'], "-", "-"))
+                        continue
+                    regression = result['seconds'] > expected['seconds'] * SLOWDOWN_THRESHOLD or \
+                        result['queries'] > expected['queries']
+                    regressions += regression
+                    self.stdout.write("%-26s %6d %9.3f %8d %9.3f %8d%s" % (
+                        name, num_sites, result['seconds'], result['queries'], expected['seconds'],
+                        expected['queries'], "  REGRESSION" if regression else ""))
+        finally:
+            runner.teardown_databases(old_config)
+            runner.teardown_test_environment()
+
+        if options['save_baseline']:
+            for name, sizes in results.items():
+                baseline.setdefault(name, {}).update(sizes)
+            with open(options['baseline'], 'w') as baseline_file:
+                json.dump(baseline, baseline_file, indent=2, sort_keys=True, separators=(',', ': '))
+                baseline_file.write("\n")
+            self.stdout.write("Baseline saved to %s" % options['baseline'])
+        elif regressions:
+            self.stdout.write("%d regressions against the baseline" % regressions)
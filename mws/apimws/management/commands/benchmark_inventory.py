@@ -0,0 +1,33 @@
+import os
+from django.core.management.base import BaseCommand
+from django.test.runner import DiscoverRunner
+from apimws.benchmark import buffered_inventory, create_fleet, measure
+from apimws.inventory import write_inventory
+
+
+class Command(BaseCommand):
+    help = "Measures the time and memory used by ansible_inventory --list with synthetic fleets of increasing size. " \
+           "The fleets are created in a test database, the configured one is not modified."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--vms", type=int, nargs='+', default=[100, 1000, 10000],
+                            help="fleet sizes to measure, in number of VMs, two per site (default 100 1000 10000)")
+
+    def handle(self, *args, **options):
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            self.stdout.write("%8s %10s %10s %14s" % ("VMs", "writer", "seconds", "RSS growth KB"))
+            fleet_size = 0
+            with open(os.devnull, 'w') as devnull:
+                for num_vms in sorted(options['vms']):
+                    create_fleet(num_vms / 2 - fleet_size, start=fleet_size)
+                    fleet_size = num_vms / 2
+                    # Fill the hostvars cache, as it would be in production
+                    write_inventory(devnull)
+                    for name, writer in (('streamed', write_inventory), ('buffered', buffered_inventory)):
+                        result = measure(writer, devnull)
+                        self.stdout.write("%8d %10s %10.2f %14d" % (num_vms, name, result['seconds'],
+                                                                    result['rss_growth_kb']))
+        finally:
+            runner.teardown_databases(old_config)
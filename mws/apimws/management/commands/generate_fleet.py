@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from apimws.benchmark import create_fleet
+from sitesmanagement.models import Site
+
+
+class Command(BaseCommand):
+    help = "Adds a synthetic fleet of MWS sites to the database, to try the panel against large numbers of servers. " \
+           "Do not use it against the production database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("sites", type=int, help="number of sites to create")
+        parser.add_argument("--prefix", default="bench",
+                            help="prefix of the names of the sites and of every other object created (default bench)")
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        if Site.objects.filter(name__startswith=prefix).exists():
+            raise CommandError("There are sites named %s* already, choose another prefix" % prefix)
+        create_fleet(options['sites'], prefix=prefix)
+        self.stdout.write("%d sites created" % options['sites'])
@@ -1,12 +1,19 @@
 import uuid
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.db import connection
+from django.core.urlresolvers import reverse
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.core.management.base import CommandError
 import json
 from StringIO import StringIO
 from datetime import datetime
-from apimws.models import Cluster, Host, PHPLib, AnsibleConfiguration
+from apimws.benchmark import buffered_inventory, create_fleet
+from apimws.inventory import write_inventory
+from apimws.models import Cluster, Host, PHPLib, AnsibleConfiguration, HostvarsCache
 from apimws.xen import which_cluster
-from sitesmanagement.models import (Site, VirtualMachine, NetworkConfig, Service, ServerType)
+from mwsauth.models import MWSUser
+from sitesmanagement.models import (Site, VirtualMachine, NetworkConfig, Service, ServerType, UnixGroup)
 from .commands.ansible_inventory import Command
 
 
@@ -120,3 +127,159 @@ class TestsWithData(TestCase):
 
         self.assertEqual(v['mws_php_libs_enabled'], ['libphp-adodb'])
         self.assertEqual(len(v['mws_php_libs_disabled']), PHPLib.objects.filter(name_next_os__isnull=False).count() - 1)
+
+    def add_site(self, number):
+        prod_netconf = NetworkConfig.objects.create(IPv4='198.51.100.%d' % number, type='ipvxpub',
+                                                    IPv6='2001:db8:212:8::8c:%d' % number,
+                                                    name="mws-prod-%d.mws3.example" % number)
+        test_netconf = NetworkConfig.objects.create(IPv4='192.0.2.%d' % number, type='ipv4priv',
+                                                    name="mws-test-%d.mws3.private.example" % number)
+        site = Site.objects.create(name="testSite%d" % number, start_date=datetime.today(),
+                                   type=ServerType.objects.get(id=1))
+        # bulk_create skips the post_save signal that would ask lookup for the user's name
+        User.objects.bulk_create([User(username="user%d" % number)])
+        user = User.objects.get(username="user%d" % number)
+        MWSUser.objects.create(user=user, uid=1000 + number, ssh_public_key="ssh-rsa key%d" % number)
+        site.users.add(user)
+        for service_type, netconf in (('production', prod_netconf), ('test', test_netconf)):
+            service = Service.objects.create(type=service_type, site=site, status="ready",
+                                             network_configuration=netconf)
+            VirtualMachine.objects.create(
+                name="%s_vm%d" % (service_type, number), token=uuid.uuid4(), service=service,
+                network_configuration=NetworkConfig.objects.create(
+                    IPv6='2001:db8:212:9::%s:%d' % ('a' if service.primary else 'b', number), type='ipv6',
+                    name="mws-%s-vm%d.example" % (service_type, number)),
+                cluster=which_cluster())
+            AnsibleConfiguration.objects.create(service=service, key='os', value='stretch')
+            PHPLib.objects.first().services.add(service)
+            unix_group = UnixGroup.objects.create(name="group%d" % number, service=service)
+            unix_group.users.add(user)
+        vhost = site.production_service.vhosts.create(name="vhost%d" % number)
+        vhost.main_domain = vhost.domain_names.create(name="site%d.example" % number, status='global')
+        vhost.save()
+        vhost.domain_names.create(name="site%d.private.example" % number, status='private')
+        return site
+
+    def test_list_num_queries(self):
+        """tests that the number of queries used by --list does not depend on the number of sites"""
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                Command().handle(list=True, outfile=StringIO())
+            return len(queries)
+
+        self.add_site(1)
+        num_queries = count_queries()
+        for number in range(2, 7):
+            self.add_site(number)
+        self.assertEqual(count_queries(), num_queries)
+
+    def test_list_same_as_host(self):
+        """tests that --list and --host emit the same hostvars"""
+        self.add_site(1)
+        s = StringIO()
+        Command().handle(list=True, outfile=s)
+        r = json.loads(s.getvalue())
+        self.assertEqual(len(r['mwsclients']), 3)
+        for hostname in r['mwsclients']:
+            s = StringIO()
+            Command().handle(host=hostname, outfile=s)
+            self.assertEqual(json.loads(s.getvalue()), r['_meta']['hostvars'][hostname])
+        v = r['_meta']['hostvars']['mws-test-vm1.example']
+        self.assertFalse(v['mws_is_primary'])
+        self.assertTrue(v['mws_test_active'])
+        self.assertEqual(v['mws_users'], [{'username': 'user1', 'groups': ['group1', 'group1'],
+                                           'uid': 1001, 'ssh_key': 'ssh-rsa key1'}])
+        self.assertEqual(v['mws_vhosts'][0]['domains'], ['site1.example', 'site1.private.example'])
+        self.assertEqual(v['mws_vhosts'][0]['cert_domains'], {'acme': ['site1.example'],
+                                                              'qv': ['site1.example', 'site1.private.example']})
+        self.assertEqual(v['mws_vhosts'][0]['main_domain'], 'site1.example')
+        self.assertEqual(r['mwssite-%d' % Site.objects.get(name="testSite1").id],
+                         ['mws-production-vm1.example', 'mws-test-vm1.example'])
+
+    def test_list_streamed(self):
+        """tests that --list emits the same JSON as json.dump with sorted keys whatever the chunk size, and the same
+        inventory as when it was built in memory"""
+        self.add_site(1)
+        create_fleet(5)
+        s = StringIO()
+        Command().handle(list=True, outfile=s)
+        r = json.loads(s.getvalue())
+        self.assertEqual(len(r['mwsclients']), 13)
+        self.assertEqual(len(r['_meta']['hostvars']), 13)
+        self.assertEqual(s.getvalue(), json.dumps(r, sort_keys=True) + "\n")
+        chunked = StringIO()
+        write_inventory(chunked, chunk_size=2)
+        self.assertEqual(chunked.getvalue(), s.getvalue())
+        buffered = StringIO()
+        buffered_inventory(buffered)
+        self.assertEqual(json.loads(buffered.getvalue()), r)
+
+    def test_hostvars_cache(self):
+        """tests that hostvars are cached and that the cache is invalidated when the data they depend on changes"""
+        site = self.add_site(1)
+        Command().handle(list=True, outfile=StringIO())
+        self.assertEqual(HostvarsCache.objects.count(), 3)
+
+        # --host reads the hostname index
+        with self.assertNumQueries(1):
+            s = StringIO()
+            Command().handle(host="mws-test-vm1.example", outfile=s)
+        self.assertEqual(json.loads(s.getvalue())['mws_name'], "testSite1")
+
+        # Status changes around Ansible runs keep the cache
+        service = site.production_service
+        service.status = 'ansible'
+        service.save()
+        self.assertEqual(HostvarsCache.objects.count(), 3)
+
+        # Changes to the site's vhosts and domain names invalidate it
+        vhost = service.vhosts.first()
+        vhost.domain_names.create(name="new.site1.example", status='accepted')
+        self.assertEqual(HostvarsCache.objects.count(), 1)
+        s = StringIO()
+        Command().handle(host="mws-test-vm1.example", outfile=s)
+        self.assertIn("new.site1.example", json.loads(s.getvalue())['mws_vhosts'][0]['domains'])
+
+        # as do changes to the users of the site
+        Command().handle(list=True, outfile=StringIO())
+        self.assertEqual(HostvarsCache.objects.count(), 3)
+        site.users.remove(User.objects.get(username="user1"))
+        self.assertEqual(HostvarsCache.objects.count(), 1)
+        s = StringIO()
+        Command().handle(host="mws-test-vm1.example", outfile=s)
+        self.assertEqual(json.loads(s.getvalue())['mws_users'], [])
+
+    def test_hostname_change(self):
+        """tests that the hostvars index follows hostname changes"""
+        self.add_site(1)
+        Command().handle(list=True, outfile=StringIO())
+        network_configuration = NetworkConfig.objects.get(name="mws-test-vm1.example")
+        network_configuration.name = "mws-renamed-vm1.example"
+        network_configuration.save()
+        s = StringIO()
+        Command().handle(host="mws-renamed-vm1.example", outfile=s)
+        self.assertEqual(json.loads(s.getvalue())['mws_name'], "testSite1")
+        self.assertTrue(HostvarsCache.objects.filter(hostname="mws-renamed-vm1.example").exists())
+        with self.assertRaises(VirtualMachine.DoesNotExist):
+            Command().handle(host="mws-test-vm1.example", outfile=StringIO())
+
+    @override_settings(ANSIBLE_INVENTORY_TOKEN="secret")
+    def test_inventory_host_endpoint(self):
+        self.add_site(1)
+        url = reverse('apimws.views.inventory_host', kwargs={'hostname': "mws-test-vm1.example"})
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_X_MWS_INVENTORY_TOKEN="wrong").status_code, 403)
+        self.assertEqual(self.client.post(url, HTTP_X_MWS_INVENTORY_TOKEN="secret").status_code, 403)
+        # Not as a query parameter, which is logged
+        self.assertEqual(self.client.get(url, {'token': "secret"}).status_code, 403)
+        response = self.client.get(url, HTTP_X_MWS_INVENTORY_TOKEN="secret")
+        self.assertEqual(response.status_code, 200)
+        s = StringIO()
+        Command().handle(host="mws-test-vm1.example", outfile=s)
+        self.assertEqual(response.content + "\n", s.getvalue())
+        self.assertEqual(self.client.get(
+            reverse('apimws.views.inventory_host', kwargs={'hostname': "unknown.example"}),
+            HTTP_X_MWS_INVENTORY_TOKEN="secret").status_code, 404)
+        with self.settings(ANSIBLE_INVENTORY_TOKEN=None):
+            self.assertEqual(self.client.get(url, HTTP_X_MWS_INVENTORY_TOKEN="").status_code, 403)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0082_site_migrated'),
+        ('apimws', '0017_hostvarscache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnsibleFingerprint',
+            fields=[
+                ('service', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ansible_fingerprint', serialize=False, to='sitesmanagement.Service')),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0082_site_migrated'),
+        ('apimws', '0018_ansiblefingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnsibleRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.PositiveIntegerField()),
+                ('started', models.DateTimeField(db_index=True)),
+                ('duration', models.FloatField()),
+                ('outcome', models.CharField(choices=[(b'success', b'Success'), (b'failure', b'Failure'), (b'skipped', b'Skipped, nothing had changed')], max_length=20)),
+                ('output', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ['-started'],
+            },
+        ),
+        migrations.CreateModel(
+            name='AnsibleRunRequest',
+            fields=[
+                ('service', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ansible_run_request', serialize=False, to='sitesmanagement.Service')),
+                ('requested', models.PositiveIntegerField(default=0)),
+                ('completed', models.PositiveIntegerField(default=0)),
+                ('running', models.PositiveIntegerField(blank=True, null=True)),
+                ('force', models.BooleanField(default=False)),
+                ('scheduled_at', models.DateTimeField(blank=True, null=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('failures', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ansiblerun',
+            name='service',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ansible_runs', to='sitesmanagement.Service'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def clear_hostvars_cache(apps, schema_editor):
+    # Entries are rebuilt on demand, so drop them rather than working out their hostnames
+    apps.get_model('apimws', 'HostvarsCache').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apimws', '0019_ansible_run_scheduler'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_hostvars_cache, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='hostvarscache',
+            name='hostname',
+            field=models.CharField(default='', max_length=250, unique=True),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0083_domainname_next_check'),
+        ('apimws', '0022_host_health'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProvisioningStage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pipeline', models.CharField(choices=[(b'new', b'New site'), (b'recreate', b'Recreate VM'), (b'clone', b'Clone to test')], max_length=20)),
+                ('stage', models.CharField(max_length=50)),
+                ('started', models.DateTimeField(db_index=True)),
+                ('duration', models.FloatField()),
+                ('outcome', models.CharField(choices=[(b'success', b'Success'), (b'failure', b'Failure')], max_length=20)),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='provisioning_stages', to='sitesmanagement.Service')),
+            ],
+            options={
+                'ordering': ['-started'],
+            },
+        ),
+    ]
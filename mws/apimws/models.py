@@ -3,16 +3,47 @@ from django.db import models
 from sitesmanagement.models import Service, Site
 
 
-class Cluster(models.Model):
+class Capacity(models.Model):
+    """
+    Limits on the VMs placed in a Cluster by apimws.placement: their number, and their summed CPU cores, RAM and
+    disk (in GB). No limit if null.
+    """
+    max_vms = models.PositiveIntegerField(blank=True, null=True)
+    max_cpu = models.PositiveIntegerField(blank=True, null=True)
+    max_ram = models.PositiveIntegerField(blank=True, null=True)
+    max_disk = models.PositiveIntegerField(blank=True, null=True)
+
+    class Meta:
+        abstract = True
+
+
+class Cluster(Capacity):
+    """The capacity of a Cluster not set is the sum of that of its Hosts, if set for all of them"""
     name = models.CharField(max_length=100, primary_key=True)
 
     def __unicode__(self):
         return self.name
 
 
-class Host(models.Model):
+class Host(Capacity):
+    """
+    VM API requests are only sent to the enabled Hosts of a Cluster, and VMs only placed in Clusters with one.
+    The outcome of the VM API requests sent to each Host is tracked by apimws.placement.record_request: after
+    VM_API_CIRCUIT_THRESHOLD consecutive failures no more requests are sent to it until circuit_open_until.
+    """
     hostname = models.CharField(max_length=250, primary_key=True)
     cluster = models.ForeignKey(Cluster, related_name='hosts')
+    enabled = models.BooleanField(default=True)
+    requests = models.PositiveIntegerField(default=0)
+    failures = models.PositiveIntegerField(default=0)
+    consecutive_failures = models.PositiveIntegerField(default=0)
+    circuit_open_until = models.DateTimeField(blank=True, null=True)
+    # Exponentially weighted moving average of the duration of its VM API requests, in seconds
+    latency = models.FloatField(blank=True, null=True)
+
+    def available(self, now):
+        """Whether VM API requests can be sent to it: it is enabled and its circuit is closed"""
+        return self.enabled and (self.circuit_open_until is None or self.circuit_open_until <= now)
 
     def __unicode__(self):
         return self.hostname
@@ -70,3 +101,139 @@ class QueueEntry(models.Model):
 
     def __unicode__(self):
         return self.site.name
+
+
+class HostvarsCache(models.Model):
+    """
+    The Ansible hostvars of a VM as emitted by the ansible_inventory command, serialised as JSON, together
+    with their SHA-256 hash, indexed by the hostname of the VM. Entries are deleted by the handlers in
+    sitesmanagement.signals whenever the data they are built from changes and rebuilt the next time they are
+    requested.
+    """
+    vm = models.OneToOneField('sitesmanagement.VirtualMachine', on_delete=models.CASCADE, primary_key=True,
+                              related_name='hostvars_cache')
+    hostname = models.CharField(max_length=250, unique=True)
+    hostvars = models.TextField()
+    digest = models.CharField(max_length=64)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return self.vm.name
+
+
+class AnsibleFingerprint(models.Model):
+    """
+    The fingerprint of the hostvars (see apimws.inventory.service_fingerprint) that the last successful Ansible run
+    applied to the VMs of a service. launch_ansible does not run Ansible again while the fingerprint is unchanged.
+    """
+    service = models.OneToOneField(Service, on_delete=models.CASCADE, primary_key=True,
+                                   related_name='ansible_fingerprint')
+    fingerprint = models.CharField(max_length=64)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return self.fingerprint
+
+
+class AnsibleRunRequest(models.Model):
+    """
+    Pending and in-flight Ansible runs of a service, see apimws.ansible_impl.launch_ansible. Every request to run
+    Ansible increments requested; a run applies the state as of the generation it claimed (running) and, once
+    finished, sets completed to it. Requests made while a run is queued are coalesced into it and requests made
+    while it runs trigger a single follow-up run.
+    """
+    service = models.OneToOneField(Service, on_delete=models.CASCADE, primary_key=True,
+                                   related_name='ansible_run_request')
+    requested = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    running = models.PositiveIntegerField(null=True, blank=True)
+    force = models.BooleanField(default=False)
+    # When the run task was queued, null if there is no task queued
+    scheduled_at = models.DateTimeField(null=True, blank=True)
+    # When the in-flight run was claimed, null if there is no run in flight
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Number of consecutive failed runs
+    failures = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return "%s: requested %d, completed %d" % (self.service, self.requested, self.completed)
+
+
+class AnsibleRun(models.Model):
+    """
+    The outcome and duration of an Ansible run against the VMs of a service
+    """
+    OUTCOME_CHOICES = (
+        ('success', 'Success'),
+        ('failure', 'Failure'),
+        ('skipped', 'Skipped, nothing had changed'),
+    )
+    service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='ansible_runs')
+    generation = models.PositiveIntegerField()
+    started = models.DateTimeField(db_index=True)
+    duration = models.FloatField()  # In seconds
+    outcome = models.CharField(max_length=20, choices=OUTCOME_CHOICES)
+    output = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-started']
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.service, self.started, self.outcome)
+
+
+class ProvisioningStage(models.Model):
+    """
+    The outcome and duration of a stage of the provisioning of a VM of a service by apimws.xen.Provisioning. The
+    'total' stage is the time from the start of the provisioning to the end of its last stage.
+    """
+    PIPELINE_CHOICES = (
+        ('new', 'New site'),
+        ('recreate', 'Recreate VM'),
+        ('clone', 'Clone to test'),
+    )
+    OUTCOME_CHOICES = (
+        ('success', 'Success'),
+        ('failure', 'Failure'),
+    )
+    service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='provisioning_stages')
+    pipeline = models.CharField(max_length=20, choices=PIPELINE_CHOICES)
+    stage = models.CharField(max_length=50)
+    started = models.DateTimeField(db_index=True)
+    duration = models.FloatField()  # In seconds
+    outcome = models.CharField(max_length=20, choices=OUTCOME_CHOICES)
+
+    class Meta:
+        ordering = ['-started']
+
+    def __unicode__(self):
+        return "%s %s %s %s" % (self.service, self.pipeline, self.stage, self.outcome)
+
+
+class TaskLock(models.Model):
+    """
+    A lock held by a task until it releases it or until expires, see apimws.locks. Only the owner that acquired it
+    can release it.
+    """
+    key = models.CharField(max_length=250, primary_key=True)
+    owner = models.CharField(max_length=32)
+    expires = models.DateTimeField()
+
+    def __unicode__(self):
+        return self.key
+
+
+class BesChange(models.Model):
+    """
+    The change journal of the bes API: an entry for every change to the data of a site served by the API, written by
+    the handlers in sitesmanagement.signals. Its ids are the cursors of the change feed, see apimws.bes.bes_changes.
+    The site is not a foreign key, the entries of the sites deleted being their tombstones.
+    """
+    site_id = models.PositiveIntegerField()
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __unicode__(self):
+        return "%d: site %d" % (self.id, self.site_id)
@@ -0,0 +1,182 @@
+'''Placement of new VMs in the Xen Clusters, and of VM API requests in the Hosts of a Cluster'''
+import itertools
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from apimws.models import Cluster, Host
+from sitesmanagement.models import VirtualMachine
+
+
+LOGGER = logging.getLogger('mws')
+
+# The resources whose use is limited by the max_<resource> fields of Cluster and Host
+RESOURCES = ('vms', 'cpu', 'ram', 'disk')
+
+
+class NoCapacityException(Exception):
+    pass
+
+
+def cluster_usage():
+    """The resources used by the VMs of each cluster, keyed by cluster name, with a single query"""
+    usage = defaultdict(lambda: dict((resource, 0) for resource in RESOURCES))
+    for row in VirtualMachine.objects.order_by().values('cluster_id').annotate(
+            vms=Count('id'), cpu=Sum('numcpu'), ram=Sum('sizeram'), disk=Sum('service__site__type__sizedisk')):
+        usage[row['cluster_id']] = dict((resource, row[resource] or 0) for resource in RESOURCES)
+    return usage
+
+
+def cluster_capacity(cluster, hosts):
+    """The limit of each resource of the cluster, None if unlimited"""
+    capacity = {}
+    for resource in RESOURCES:
+        field = 'max_%s' % resource
+        capacity[resource] = getattr(cluster, field)
+        if capacity[resource] is None and hosts and all(getattr(host, field) is not None for host in hosts):
+            capacity[resource] = sum(getattr(host, field) for host in hosts)
+    return capacity
+
+
+def vm_needs(service=None):
+    """The resources a new VM of the service given would use"""
+    if service is None:
+        return {'vms': 1, 'cpu': 0, 'ram': 0, 'disk': 0}
+    server_type = service.site.type
+    return {'vms': 1, 'cpu': server_type.numcpu, 'ram': server_type.sizeram, 'disk': server_type.sizedisk}
+
+
+class Candidate(object):
+    """A cluster where a VM could be placed, with its usage and capacity"""
+
+    def __init__(self, cluster, usage, capacity):
+        self.cluster = cluster
+        self.usage = usage
+        self.capacity = capacity
+
+    def fits(self, needs):
+        return all(self.capacity[resource] is None or self.usage[resource] + needs[resource] <= self.capacity[resource]
+                   for resource in RESOURCES)
+
+    def load(self, needs):
+        """The highest fraction of its capacity of the resources limited that would be used with the VM placed"""
+        return max([float(self.usage[resource] + needs[resource]) / self.capacity[resource]
+                    for resource in RESOURCES if self.capacity[resource]] or [0])
+
+
+def spread(candidates, needs):
+    """Places the VM in the least loaded cluster, or the one with the fewest VMs if none is limited"""
+    return min(candidates, key=lambda candidate: (candidate.load(needs), candidate.usage['vms'],
+                                                  candidate.cluster.name))
+
+
+def binpack(candidates, needs):
+    """Places the VM in the most loaded cluster where it fits, filling each cluster before using the next one"""
+    return min(candidates, key=lambda candidate: (-candidate.load(needs), -candidate.usage['vms'],
+                                                  candidate.cluster.name))
+
+
+STRATEGIES = {
+    'spread': spread,
+    'binpack': binpack,
+}
+
+
+def strategy():
+    """The placement strategy of the VM_PLACEMENT_STRATEGY setting: a name in STRATEGIES or an import path"""
+    name = getattr(settings, 'VM_PLACEMENT_STRATEGY', 'spread')
+    return STRATEGIES[name] if name in STRATEGIES else import_string(name)
+
+
+def candidates():
+    """The clusters new VMs can be placed in, those with enabled hosts or with no hosts at all"""
+    usage = cluster_usage()
+    result = []
+    for cluster in Cluster.objects.prefetch_related('hosts').order_by('name'):
+        hosts = list(cluster.hosts.all())
+        enabled = [host for host in hosts if host.enabled]
+        if hosts and not enabled:
+            continue
+        result.append(Candidate(cluster, usage[cluster.name], cluster_capacity(cluster, enabled)))
+    return result
+
+
+def place(clusters, needs, choose):
+    """Returns the Candidate the strategy choose picks among the clusters where a VM with the needs given fits"""
+    fitting = [candidate for candidate in clusters if candidate.fits(needs)]
+    if not fitting:
+        raise NoCapacityException("No cluster has capacity left for a VM needing %s" % needs)
+    return choose(fitting, needs)
+
+
+def which_cluster(service=None):
+    """
+    Returns the Cluster where a new VM of the service given should be created according to the
+    VM_PLACEMENT_STRATEGY, or None if there are no clusters.
+    """
+    clusters = candidates()
+    if not clusters and not Cluster.objects.exists():
+        return None
+    return place(clusters, vm_needs(service), strategy()).cluster
+
+
+# Per process round robin position in the hosts of each cluster
+_host_counters = defaultdict(itertools.count)
+
+
+def host_order(cluster):
+    """
+    Returns the Hosts of the cluster in the order VM API requests should be tried on them: its available hosts,
+    starting with the next one in turns, followed by the enabled hosts whose circuit is open, the soonest to
+    close first. If no host is enabled all of them are returned.
+    """
+    hosts = list(cluster.hosts.order_by('hostname'))
+    if not hosts:
+        raise Host.DoesNotExist("The cluster %s has no hosts" % cluster.name)
+    now = timezone.now()
+    available = [host for host in hosts if host.available(now)]
+    if available:
+        start = next(_host_counters[cluster.name]) % len(available)
+        available = available[start:] + available[:start]
+    enabled = [host for host in hosts if host.enabled]
+    if not enabled:
+        LOGGER.warning("No enabled host in the cluster %s", cluster.name)
+        return hosts
+    return available + sorted((host for host in enabled if host not in available),
+                              key=lambda host: host.circuit_open_until)
+
+
+def pick_host(cluster):
+    """Returns the Host of the cluster the next VM API request should be sent to"""
+    return host_order(cluster)[0]
+
+
+def record_request(host, seconds, success):
+    """
+    Records the outcome and duration of a VM API request sent to the host. VM_API_CIRCUIT_THRESHOLD consecutive
+    failures open its circuit for VM_API_CIRCUIT_COOLDOWN seconds, after which requests are sent to it again:
+    the circuit is closed by the first one that succeeds and opened again by the first one that fails.
+    """
+    alpha = getattr(settings, 'VM_API_LATENCY_ALPHA', 0.3)
+    latency = seconds if host.latency is None else alpha * seconds + (1 - alpha) * host.latency
+    hosts = Host.objects.filter(hostname=host.hostname)
+    if success:
+        hosts.update(requests=F('requests') + 1, consecutive_failures=0, circuit_open_until=None, latency=latency)
+        return
+    hosts.update(requests=F('requests') + 1, failures=F('failures') + 1,
+                 consecutive_failures=F('consecutive_failures') + 1, latency=latency)
+    opened = hosts.filter(consecutive_failures__gte=getattr(settings, 'VM_API_CIRCUIT_THRESHOLD', 3)).update(
+        circuit_open_until=timezone.now() + timedelta(seconds=getattr(settings, 'VM_API_CIRCUIT_COOLDOWN', 300)))
+    if opened:
+        LOGGER.error("Circuit of the host %s opened after %d consecutive failed VM API requests", host.hostname,
+                     Host.objects.get(hostname=host.hostname).consecutive_failures)
+
+
+def host_metrics():
+    """The VM API request metrics of every Host, as dicts"""
+    return list(Host.objects.order_by('cluster', 'hostname').values(
+        'hostname', 'cluster', 'enabled', 'requests', 'failures', 'consecutive_failures', 'circuit_open_until',
+        'latency'))
@@ -0,0 +1,99 @@
+'''Keeps the SSHFP records in the DNS of the hostnames of a site in line with its SiteKeys'''
+import logging
+from celery import shared_task
+from apimws.ipreg import IPRegBatch
+from apimws.jackdaw import SSHTaskWithFailure
+from libs.sshpubkey import SSHPubKey, InvalidKeyException
+from sitesmanagement.models import Site, SiteKey, VirtualMachine
+
+
+LOGGER = logging.getLogger('mws')
+
+# Fingerprint types published for every key, with the SSHPubKey method that computes them
+PUBLISHED_FP_TYPES = {
+    'SHA256': 'sshfp_sha256',
+}
+
+
+def site_hostnames(site):
+    """The hostnames of the services of the site and of their VMs"""
+    hostnames = [service.network_configuration.name for service in site.services.all()
+                 if service.network_configuration]
+    hostnames += [vm.network_configuration.name for vm in VirtualMachine.objects.filter(service__site=site)
+                  .select_related('network_configuration') if vm.network_configuration]
+    return sorted(set(hostnames))
+
+
+def expected_records(keys):
+    """The set of (algorithm, fptype, fingerprint) SSHFP records of the SiteKeys given"""
+    records = set()
+    for key in keys:
+        try:
+            pubkey = SSHPubKey(key.public_key)
+        except InvalidKeyException as e:
+            LOGGER.error("The %s key of the site %s is not valid, no SSHFP record published for it: %s"
+                         % (key.type, key.site_id, e))
+            continue
+        for fptype, method in PUBLISHED_FP_TYPES.items():
+            records.add((SiteKey.ALGORITHMS[key.type], SiteKey.FP_TYPES[fptype], getattr(pubkey, method)().lower()))
+    return records
+
+
+def current_records(hostnames):
+    """
+    Reads the SSHFP records of the hostnames given from ip-register, with an IPRegBatch. The response to a get
+    sshfp call lists the records of the hostname in its 'sshfp' key as [algorithm, fptype, fingerprint].
+
+    :return: a dict with the set of (algorithm, fptype, fingerprint) records of each hostname
+    """
+    with IPRegBatch() as batch:
+        for hostname in hostnames:
+            batch.get_sshfp(hostname)
+    batch.raise_for_errors()
+    return dict((hostname, set((int(algorithm), int(fptype), fingerprint.lower())
+                               for algorithm, fptype, fingerprint in result.get('sshfp') or []))
+                for hostname, result in zip(hostnames, batch.results))
+
+
+def sync_records(hostnames, expected):
+    """
+    Publishes the (algorithm, fptype, fingerprint) SSHFP records expected for all the hostnames given, deleting the
+    others and adding those missing with an IPRegBatch. Nothing is changed for the hostnames whose records are
+    already right.
+
+    :return: the IPRegBatch with the changes made, whose errors() are those that failed
+    """
+    batch = IPRegBatch()
+    for hostname, records in sorted(current_records(hostnames).items()):
+        # A stale record is deleted by algorithm and fptype before the new one is added
+        stale = set((algorithm, fptype) for algorithm, fptype, fingerprint in records - expected)
+        for algorithm, fptype in sorted(stale):
+            batch.delete_sshfp(hostname, algorithm, fptype)
+        kept = set(record for record in records if record[:2] not in stale)
+        for algorithm, fptype, fingerprint in sorted(expected - kept):
+            batch.set_sshfp(hostname, algorithm, fptype, fingerprint)
+    batch.run()
+    return batch
+
+
+def reconcile_sshfp(site, keys=None):
+    """
+    Publishes the SSHFP records of the keys given (all the SiteKeys of the site by default) for all the hostnames
+    of the site, see sync_records.
+    """
+    return sync_records(site_hostnames(site), expected_records(site.keys.all() if keys is None else keys))
+
+
+@shared_task(base=SSHTaskWithFailure)
+def reconcile_site_sshfp(site_id):
+    """Reconciles the SSHFP records of the site once some of its SiteKeys have been deleted"""
+    site = Site.objects.filter(id=site_id).first()
+    # The records of a site deleted with its keys are deleted by delete_sshfp_records
+    if site is not None:
+        reconcile_sshfp(site).raise_for_errors()
+
+
+@shared_task(base=SSHTaskWithFailure)
+def delete_sshfp_records(hostnames):
+    """Deletes all the SSHFP records of the hostnames of a site that has been deleted"""
+    sync_records(hostnames, set()).raise_for_errors()
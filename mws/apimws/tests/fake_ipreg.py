@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the ip-register API endpoint (IP_REG_API_END_POINT) used by the tests:
+
+    fake_ipreg.py <state file> get|put|delete cname|sshfp|nameinfo <hostname> [<arguments>]
+    fake_ipreg.py <state file> batch < [[<call>], ...]
+
+The records are kept in the JSON state file given, along with the number of times the endpoint was invoked.
+Hostnames under a domain listed in the 'delegated' key of the state are rejected with exit code 7, as the real
+endpoint does.
+"""
+import json
+import sys
+
+
+def call(state, arguments):
+    """Returns the status and the response to the call given"""
+    action, record_type, hostname = arguments[:3]
+    records = state['records'].setdefault(hostname, {})
+    response = {'hostname': hostname, 'status': 0, 'message': ''}
+    if any(hostname.endswith('.' + domain) for domain in state.get('delegated', [])):
+        response.update(status=7, message="%s is in a delegated domain" % hostname)
+    elif action == 'get' and record_type == 'nameinfo':
+        response.update(exists=[{'cname': 'C', 'sshfp': 'S'}[key] for key in sorted(records) if records[key]],
+                        delegated='N', emails=[], crsids=[], domain=hostname.split('.', 1)[-1])
+    elif action == 'get':
+        response[record_type] = records.get(record_type)
+    elif action == 'put' and record_type == 'cname':
+        records['cname'] = arguments[3]
+    elif action == 'put' and record_type == 'sshfp':
+        records.setdefault('sshfp', []).append(arguments[3:6])
+    elif action == 'delete' and record_type == 'cname':
+        records.pop('cname', None)
+    elif action == 'delete' and record_type == 'sshfp':
+        records['sshfp'] = [sshfp for sshfp in records.get('sshfp', []) if sshfp[:2] != arguments[3:5]]
+    else:
+        response.update(status=2, message="Unknown call %s" % " ".join(arguments))
+    return response
+
+
+def main(state_file, arguments):
+    with open(state_file) as state_fd:
+        state = json.load(state_fd)
+    state.setdefault('records', {})
+    state['invocations'] = state.get('invocations', 0) + 1
+    if arguments[0] == 'batch':
+        response = [call(state, batch_call) for batch_call in json.load(sys.stdin)]
+        status = 0
+    else:
+        response = call(state, arguments)
+        status = response['status']
+    with open(state_file, 'w') as state_fd:
+        json.dump(state, state_fd)
+    sys.stdout.write(json.dumps(response))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1], sys.argv[2:]))
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the VM API endpoint (VM_END_POINT_COMMAND) used by the tests:
+
+    fake_vm_api.py <state file> <host> <command> '<JSON parameters>'
+
+The JSON state file lists the hosts that are down in its 'down' key, for which it fails with exit code 255 as
+ssh would, and the requests received in its 'requests' key, to which the requests are appended as
+[host, command, parameters].
+"""
+import json
+import sys
+
+
+def main(state_file, host, command, parameters):
+    with open(state_file) as state_fd:
+        state = json.load(state_fd)
+    state.setdefault('requests', []).append([host, command, json.loads(parameters.strip("'"))])
+    with open(state_file, 'w') as state_fd:
+        json.dump(state, state_fd)
+    if host in state.get('down', []):
+        sys.stdout.write("ssh: connect to host %s port 22: Connection refused\n" % host)
+        return 255
+    sys.stdout.write(json.dumps({'vmid': 'mws-client-%s' % command}))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,249 @@
+import json
+import subprocess
+import threading
+import time
+import uuid
+from datetime import datetime
+from django.test import override_settings, TestCase
+from mock import mock
+from apimws.ansible_impl import launch_ansible, run_on_vms, AnsibleExecutionError, ansible_rollout, run_ansible
+from apimws.models import Cluster, Host, AnsibleFingerprint, AnsibleRunRequest, AnsibleRun
+from apimws.xen import which_cluster
+from sitesmanagement.models import Site, VirtualMachine, NetworkConfig, Service, ServerType
+
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory')
+class AnsibleFingerprintTests(TestCase):
+
+    def setUp(self):
+        cluster = Cluster.objects.create(name="mws-test-1")
+        Host.objects.create(hostname="mws-test-1.dev.mws3.cam.ac.uk", cluster=cluster)
+        site = Site.objects.create(name="testSite", start_date=datetime.today(), type=ServerType.objects.get(id=1))
+        self.service = Service.objects.create(
+            type="production", site=site, status="ready",
+            network_configuration=NetworkConfig.objects.create(IPv4='198.51.100.255', type='ipvxpub',
+                                                               name="mws-12940.mws3.example"))
+        VirtualMachine.objects.create(
+            name="test_vm", token=uuid.uuid4(), service=self.service, cluster=which_cluster(),
+            network_configuration=NetworkConfig.objects.create(IPv6='2001:db8:212:8::8c:254', type='ipv6',
+                                                               name='mws-client1.example'))
+        self.vhost = self.service.vhosts.create(name="vhost1")
+
+    def launch_ansible(self, **kwargs):
+        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
+            launch_ansible(Service.objects.get(id=self.service.id), **kwargs)
+        return mock_subprocess.check_output.call_count
+
+    def test_unchanged_runs_skipped(self):
+        self.assertEqual(self.launch_ansible(), 1)
+        self.assertTrue(AnsibleFingerprint.objects.filter(service=self.service).exists())
+        self.assertEqual(Service.objects.get(id=self.service.id).status, 'ready')
+
+        # Nothing has changed since the last run
+        self.assertEqual(self.launch_ansible(), 0)
+
+        # A domain name that is not configured yet in the vhost does not change anything either
+        self.vhost.domain_names.create(name="foo.example", status='requested')
+        self.assertEqual(self.launch_ansible(), 0)
+
+        self.vhost.domain_names.create(name="bar.example", status='external')
+        self.assertEqual(self.launch_ansible(), 1)
+        self.assertEqual(self.launch_ansible(), 0)
+
+        # Admins can force a run
+        self.assertEqual(self.launch_ansible(force=True), 1)
+
+    def test_failed_run_not_recorded(self):
+        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
+            mock_subprocess.CalledProcessError = subprocess.CalledProcessError
+            mock_subprocess.check_output.side_effect = subprocess.CalledProcessError(4, "userv", "unreachable")
+            launch_ansible(self.service)
+        # The first run and its two retries
+        self.assertEqual(mock_subprocess.check_output.call_count, 3)
+        self.assertEqual(list(AnsibleRun.objects.filter(service=self.service).values_list('outcome', flat=True)),
+                         ['failure'] * 3)
+        self.assertFalse(AnsibleFingerprint.objects.filter(service=self.service).exists())
+        self.assertEqual(Service.objects.get(id=self.service.id).status, 'ready')
+        self.assertEqual(self.launch_ansible(), 1)
+        self.assertEqual(AnsibleRunRequest.objects.get(service=self.service).failures, 0)
+
+
+class AnsibleRunSchedulerTests(TestCase):
+
+    def setUp(self):
+        cluster = Cluster.objects.create(name="mws-test-1")
+        Host.objects.create(hostname="mws-test-1.dev.mws3.cam.ac.uk", cluster=cluster)
+        site = Site.objects.create(name="testSite", start_date=datetime.today(), type=ServerType.objects.get(id=1))
+        self.service = Service.objects.create(
+            type="production", site=site, status="ready",
+            network_configuration=NetworkConfig.objects.create(IPv4='198.51.100.255', type='ipvxpub',
+                                                               name="mws-12940.mws3.example"))
+        VirtualMachine.objects.create(
+            name="test_vm", token=uuid.uuid4(), service=self.service, cluster=which_cluster(),
+            network_configuration=NetworkConfig.objects.create(IPv6='2001:db8:212:8::8c:254', type='ipv6',
+                                                               name='mws-client1.example'))
+
+    def test_requests_coalesced(self):
+        with mock.patch("apimws.ansible_impl.run_ansible.apply_async") as mock_apply_async:
+            for i in range(3):
+                launch_ansible(Service.objects.get(id=self.service.id))
+        # Only one run is queued for the three requests
+        self.assertEqual(mock_apply_async.call_count, 1)
+        self.assertEqual(mock_apply_async.call_args[1]['args'], (self.service.id, ))
+        self.assertEqual(Service.objects.get(id=self.service.id).status, 'ansible')
+
+        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess, \
+                mock.patch("apimws.ansible_impl.run_ansible.apply_async") as mock_apply_async:
+            run_ansible(self.service.id)
+        self.assertEqual(mock_subprocess.check_output.call_count, 1)
+        self.assertEqual(mock_apply_async.call_count, 0)
+        run_request = AnsibleRunRequest.objects.get(service=self.service)
+        self.assertEqual((run_request.requested, run_request.completed, run_request.running), (3, 3, None))
+        run = AnsibleRun.objects.get(service=self.service)
+        self.assertEqual((run.generation, run.outcome), (3, 'success'))
+        self.assertEqual(Service.objects.get(id=self.service.id).status, 'ready')
+
+    def test_request_while_running(self):
+        def check_output(cmd, stderr):
+            # Requests made while Ansible is running do not start a concurrent run...
+            launch_ansible(Service.objects.get(id=self.service.id))
+            launch_ansible(Service.objects.get(id=self.service.id))
+            self.assertEqual(mock_apply_async.call_count, 1)
+            return "ok"
+
+        with mock.patch("apimws.ansible_impl.run_ansible.apply_async") as mock_apply_async:
+            launch_ansible(Service.objects.get(id=self.service.id))
+            with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
+                mock_subprocess.check_output.side_effect = check_output
+                run_ansible(self.service.id)
+            # ... but a single follow-up one once it has finished
+            self.assertEqual(mock_apply_async.call_count, 2)
+        self.assertEqual(AnsibleRunRequest.objects.get(service=self.service).completed, 1)
+        self.assertEqual(Service.objects.get(id=self.service.id).status, 'ansible')
+
+        # The follow-up run is skipped as nothing has changed since the first one
+        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
+            run_ansible(self.service.id)
+        self.assertEqual(mock_subprocess.check_output.call_count, 0)
+        self.assertEqual(list(AnsibleRun.objects.order_by('started').values_list('generation', 'outcome')),
+                         [(1, 'success'), (3, 'skipped')])
+        self.assertEqual(Service.objects.get(id=self.service.id).status, 'ready')
+
+
+class RunOnVMsTests(TestCase):
+
+    def run_on_vms(self, commands, check_output):
+        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
+            mock_subprocess.CalledProcessError = subprocess.CalledProcessError
+            mock_subprocess.check_output.side_effect = check_output
+            return run_on_vms(commands)
+
+    def test_outputs(self):
+        commands = [("host%d.example" % i, ["userv", "mws-admin", "mws_ansible_host", "host%d.example" % i])
+                    for i in range(3)]
+        outputs = self.run_on_vms(commands, lambda cmd, stderr: "ok %s" % cmd[-1])
+        self.assertEqual(outputs, dict(("host%d.example" % i, "ok host%d.example" % i) for i in range(3)))
+
+    def test_partial_failure(self):
+        def check_output(cmd, stderr):
+            if cmd[-1] == "host1.example":
+                raise subprocess.CalledProcessError(2, cmd, "unreachable")
+            return "ok"
+
+        commands = [("host%d.example" % i, ["userv", "mws-admin", "mws_ansible_host", "host%d.example" % i])
+                    for i in range(3)]
+        with self.assertRaises(AnsibleExecutionError) as cm:
+            self.run_on_vms(commands, check_output)
+        self.assertEqual(cm.exception.failures.keys(), ["host1.example"])
+        self.assertEqual(cm.exception.failures["host1.example"].returncode, 2)
+        self.assertEqual(sorted(cm.exception.outputs), ["host0.example", "host2.example"])
+        self.assertEqual(cm.exception.returncode, 2)
+        self.assertIn("unreachable", cm.exception.output)
+        # It is still a CalledProcessError for callers that retry on those
+        self.assertIsInstance(cm.exception, subprocess.CalledProcessError)
+
+    @override_settings(ANSIBLE_MAX_CONCURRENT_RUNS=2)
+    def test_concurrency_limit(self):
+        lock = threading.Lock()
+        running = [0, 0]  # current, maximum
+
+        def check_output(cmd, stderr):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return "ok"
+
+        self.run_on_vms([("host%d.example" % i, ["true"]) for i in range(6)], check_output)
+        self.assertEqual(running[1], 2)
+
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory',
+                   ANSIBLE_BATCH_COMMAND=["userv", "mws-admin", "mws_ansible_batch"])
+class AnsibleRolloutTests(TestCase):
+
+    def setUp(self):
+        cluster = Cluster.objects.create(name="mws-test-1")
+        Host.objects.create(hostname="mws-test-1.dev.mws3.cam.ac.uk", cluster=cluster)
+        self.services = []
+        for i in range(3):
+            site = Site.objects.create(name="testSite%d" % i, start_date=datetime.today(),
+                                       type=ServerType.objects.get(id=1))
+            service = Service.objects.create(
+                type="production", site=site, status="ready",
+                network_configuration=NetworkConfig.objects.create(IPv4='198.51.100.%d' % i, type='ipvxpub',
+                                                                   name="mws-service%d.example" % i))
+            VirtualMachine.objects.create(
+                name="test_vm%d" % i, token=uuid.uuid4(), service=service, cluster=which_cluster(),
+                network_configuration=NetworkConfig.objects.create(IPv6='2001:db8:212:8::8c:%d' % i, type='ipv6',
+                                                                   name='mws-client%d.example' % i))
+            self.services.append(service)
+        self.services[2].status = 'installing'
+        self.services[2].save()
+
+    def test_rollout(self):
+        def popen(cmd, stdout, stderr):
+            hosts = cmd[cmd.index("--limit") + 1].split(",")
+            stats = dict((host, {"ok": 10, "changed": 1, "unreachable": int(host == "mws-client1.example"),
+                                 "failures": 0, "skipped": 0}) for host in hosts)
+            process = mock.Mock(returncode=4 if "mws-client1.example" in hosts else 0)
+            process.communicate.return_value = ("WARNING: something\n" + json.dumps({"plays": [], "stats": stats}),
+                                                "")
+            return process
+
+        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
+            mock_subprocess.Popen.side_effect = popen
+            result = ansible_rollout(batch_size=1, forks=5)
+
+        self.assertEqual(result, {'ok': ["mws-client0.example"], 'failed': ["mws-client1.example"]})
+        self.assertEqual(mock_subprocess.Popen.call_count, 2)
+        self.assertEqual(mock_subprocess.Popen.call_args_list[0][0][0], [
+            "userv", "mws-admin", "mws_ansible_batch", "--limit", "mws-client0.example", "--forks", "5"])
+        self.assertEqual([Service.objects.get(id=service.id).status for service in self.services],
+                         ['ready', 'ready', 'installing'])
+        self.assertTrue(AnsibleFingerprint.objects.filter(service=self.services[0]).exists())
+        self.assertFalse(AnsibleFingerprint.objects.filter(service=self.services[1]).exists())
+
+        # Only the failed one is run again when asking for the changed ones only
+        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
+            mock_subprocess.Popen.side_effect = popen
+            result = ansible_rollout(changed_only=True)
+        self.assertEqual(result, {'ok': [], 'failed': ["mws-client1.example"]})
+
+    def test_rollout_error(self):
+        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
+            mock_subprocess.Popen.side_effect = OSError("userv not found")
+            with self.assertRaises(OSError):
+                ansible_rollout(batch_size=1, forks=5)
+        # The claimed runs are released
+        self.assertEqual([Service.objects.get(id=service.id).status for service in self.services],
+                         ['ready', 'ready', 'installing'])
+        self.assertFalse(AnsibleRunRequest.objects.exclude(running=None).exists())
+        self.assertEqual(list(AnsibleRun.objects.values_list('service_id', 'outcome')),
+                         [(self.services[0].id, 'failure')])
+        # The failure of a task called with keyword arguments only is logged
+        with mock.patch("apimws.ansible_impl.LOGGER") as mock_logger:
+            ansible_rollout.on_failure(OSError("userv not found"), "task", (), {'batch_size': 1}, None)
+        self.assertTrue(mock_logger.error.called)
@@ -0,0 +1,36 @@
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from apimws.benchmark import create_fleet, time_queries, Scenarios
+from apimws.inventory import inventory_vms
+from mwsauth.models import MWSUser
+from sitesmanagement.models import Site, DomainName, Vhost
+
+
+class SyntheticFleetTests(TestCase):
+
+    def test_create_fleet(self):
+        User.objects.bulk_create([User(username="admin1", is_active=True)])
+        MWSUser.objects.bulk_create([MWSUser(user_id="admin1", uid=99999)])
+        admin = User.objects.get(username="admin1")
+        create_fleet(3, user=admin)
+        create_fleet(2, start=3)
+        self.assertEqual(Site.objects.filter(name__startswith="bench").count(), 5)
+        self.assertEqual(inventory_vms().count(), 10)
+        self.assertEqual(admin.sites.count(), 3)
+        site = Site.objects.get(name="bench4")
+        self.assertEqual(site.users.get().mws_user.uid, 100004)
+        self.assertTrue(site.production_service.unix_groups.get().users.exists())
+        self.assertEqual(sorted(site.production_service.vhosts.get().domain_names.values_list('status', flat=True)),
+                         sorted(status for status, _ in DomainName.STATUS_CHOICES))
+        self.assertEqual(Vhost.objects.filter(main_domain__status='global').count(), 5)
+
+        for name in Scenarios.NAMES:
+            self.assertGreater(time_queries(Scenarios(admin).run, name)['queries'], 0)
+
+    def test_generate_fleet_command(self):
+        call_command('generate_fleet', 2, prefix="fleet")
+        self.assertEqual(Site.objects.filter(name__startswith="fleet").count(), 2)
+        with self.assertRaises(CommandError):
+            call_command('generate_fleet', 2, prefix="fleet")
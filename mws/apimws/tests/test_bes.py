@@ -1,10 +1,15 @@
 import json
 import os
+from datetime import date, timedelta
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.test import override_settings, TestCase
+from django.utils import timezone
+from apimws import bes
+from apimws.models import BesChange
+from apimws.benchmark import create_fleet
 from mwsauth.tests import do_test_login
-from sitesmanagement.models import Site, VirtualMachine
+from sitesmanagement.models import Site, SiteKey, VirtualMachine
 from sitesmanagement.tests.tests import assign_a_site
 
 
@@ -12,6 +17,7 @@ from sitesmanagement.tests.tests import assign_a_site
 class BesTests(TestCase):
     fixtures = [os.path.join(settings.BASE_DIR, 'sitesmanagement/fixtures/network_configuration_dev.yaml'), ]
     def setUp(self):
+        bes.invalidate()
         do_test_login(self, user="test0001")
         assign_a_site(self)
 
@@ -35,3 +41,130 @@ class BesTests(TestCase):
             json_vms.append(json_vm)
         json_site['vms'] = json_vms
         self.assertContains(response, json.dumps([json_site]))
+
+
+class BesCacheTests(TestCase):
+
+    def setUp(self):
+        # The fleet is bulk created, so the JSON cached by other tests is not forgotten
+        bes.invalidate()
+
+    def test_queries(self):
+        create_fleet(2)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse("apimws.bes.bes"))
+        bes.invalidate()
+        create_fleet(5, start=2)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse("apimws.bes.bes"))
+        sites = json.loads(response.content)
+        # Each site is listed once, with the VMs of its production and test services
+        self.assertEqual(len(sites), 7)
+        self.assertEqual(sorted(vm['name'] for vm in sites[0]['vms']), ["bench-testvm6", "bench-vm6"])
+        self.assertEqual(sites[0]['vms'][0]['service_fqdn'], "bench-prod6.example")
+        # Until something changes the JSON is served from the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(reverse("apimws.bes.bes")).content, response.content)
+
+    def test_site_listed_once(self):
+        # Sites were listed once per ready service, so twice if both their production and test services were ready
+        create_fleet(1)
+        site = Site.objects.get()
+        self.assertEqual(site.services.filter(status='ready').count(), 2)
+        sites = json.loads(self.client.get(reverse("apimws.bes.bes")).content)
+        self.assertEqual([json_site['id'] for json_site in sites], ["mwssite-%d" % site.id])
+        self.assertEqual(len(sites[0]['vms']), 2)
+        # And once if only one of them is
+        site.services.filter(type='test').update(status='installing')
+        bes.invalidate()
+        sites = json.loads(self.client.get(reverse("apimws.bes.bes")).content)
+        self.assertEqual([json_site['id'] for json_site in sites], ["mwssite-%d" % site.id])
+
+    def test_etag(self):
+        create_fleet(2)
+        response = self.client.get(reverse("apimws.bes.bes"))
+        etag = response['ETag']
+        response = self.client.get(reverse("apimws.bes.bes"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, "")
+        response = self.client.get(reverse("apimws.bes.bes"), HTTP_IF_NONE_MATCH='"other", W/%s' % etag)
+        self.assertEqual(response.status_code, 304)
+        # A new key changes the JSON and its ETag
+        site = Site.objects.get(name="bench1")
+        SiteKey.objects.create(site=site, type="ED25519", public_key="ssh-ed25519 key")
+        response = self.client.get(reverse("apimws.bes.bes"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.content)[0]['ssh-public-key-ed25519'], "ssh-ed25519 key")
+        # So does disabling a site
+        etag = response['ETag']
+        site.disabled = True
+        site.save()
+        response = self.client.get(reverse("apimws.bes.bes"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(response.content)[0]['vms'][0]['disabled'])
+
+
+@override_settings(BES_JOURNAL_SETTLE=0)
+class BesChangeFeedTests(TestCase):
+
+    def setUp(self):
+        bes.invalidate()
+        create_fleet(3)
+
+    def changes(self, since):
+        response = self.client.get(reverse("apimws.bes.bes"), {'since': since})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_changes(self):
+        cursor = self.client.get(reverse("apimws.bes.bes"))['X-Bes-Cursor']
+        self.assertEqual(self.changes(cursor), {'cursor': int(cursor), 'sites': [], 'removed': []})
+        bench0, bench1, bench2 = Site.objects.filter(name__startswith="bench").order_by('name')
+        SiteKey.objects.create(site=bench1, type="ED25519", public_key="ssh-ed25519 key")
+        bench2.disabled = True
+        bench2.save()
+        # Saves that do not change the JSON are not in the journal
+        bench0.email = "other@example.com"
+        bench0.save()
+        with self.assertNumQueries(5):
+            changes = self.changes(cursor)
+        self.assertEqual([(site['id'], site['vms'][0]['disabled']) for site in changes['sites']],
+                         [("mwssite-%d" % bench2.id, True), ("mwssite-%d" % bench1.id, False)])
+        self.assertEqual(changes['sites'][1]['ssh-public-key-ed25519'], "ssh-ed25519 key")
+        self.assertEqual(changes['removed'], [])
+        # Removed sites are listed as tombstones
+        cursor = changes['cursor']
+        bench1.deleted = True
+        bench1.save()
+        Site.objects.filter(id=bench2.id).update(end_date=date.today())
+        bes.record_cancellations()
+        changes = self.changes(cursor)
+        self.assertEqual(changes['sites'], [])
+        self.assertEqual(changes['removed'], ["mwssite-%d" % bench1.id, "mwssite-%d" % bench2.id])
+        self.assertEqual(self.changes(changes['cursor'])['sites'], [])
+        self.assertEqual(len(json.loads(self.client.get(reverse("apimws.bes.bes")).content)), 1)
+
+    def test_expired_cursor(self):
+        SiteKey.objects.create(site=Site.objects.first(), type="ED25519", public_key="ssh-ed25519 key")
+        SiteKey.objects.create(site=Site.objects.last(), type="ED25519", public_key="ssh-ed25519 key")
+        last = BesChange.objects.last().id
+        self.assertEqual(len(self.changes(0)['sites']), 2)
+        # The last entry is kept so that its cursor can still be used
+        self.assertEqual(bes.prune_journal(timezone.now() + timedelta(days=15)), 1)
+        self.assertEqual(self.client.get(reverse("apimws.bes.bes"), {'since': 0}).status_code, 410)
+        self.assertEqual(len(self.changes(last - 1)['sites']), 1)
+        self.assertEqual(self.changes(last)['sites'], [])
+        self.assertEqual(self.client.get(reverse("apimws.bes.bes"), {'since': "last"}).status_code, 400)
+
+    @override_settings(BES_JOURNAL_SETTLE=10)
+    def test_settle(self):
+        site = Site.objects.first()
+        SiteKey.objects.create(site=site, type="ED25519", public_key="ssh-ed25519 key")
+        # The change may be behind others not committed yet
+        self.assertEqual(self.changes(0), {'cursor': 0, 'sites': [], 'removed': []})
+        self.assertEqual(self.client.get(reverse("apimws.bes.bes"))['X-Bes-Cursor'], "0")
+        BesChange.objects.update(created=timezone.now() - timedelta(seconds=10))
+        changes = self.changes(0)
+        self.assertEqual(changes['cursor'], BesChange.objects.get().id)
+        self.assertEqual([json_site['id'] for json_site in changes['sites']], ["mwssite-%d" % site.id])
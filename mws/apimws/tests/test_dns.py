@@ -5,6 +5,7 @@ from django.conf import settings
 from django.core import mail
 from django.core.urlresolvers import reverse
 from django.test import override_settings, TestCase
+from apimws.ansible import launch_ansible
 from mwsauth.tests import do_test_login
 from sitesmanagement.cronjobs import reject_or_accepted_old_domain_names_requests
 from sitesmanagement.models import Vhost, DomainName
@@ -48,7 +49,8 @@ class DNSTests(TestCase):
                 mock_set_cname.return_value = True
                 self.client.post(reverse('sitesmanagement.views.add_domain', kwargs={'vhost_id': vhost.id}),
                                  {'name': test_internal_mws3_domain})
-                assert_host_ansible_call(mock_subprocess, vhost)
+                # The domain name is denied, so the hostvars have not changed and Ansible is not run
+                mock_subprocess.check_output.assert_not_called()
                 mock_set_cname.check_output.assert_not_called()
         domain_name_created = DomainName.objects.get(name=test_internal_mws3_domain)
         vhost = Vhost.objects.get(id=vhost.id)
@@ -310,6 +312,7 @@ class DNSTests(TestCase):
         # Get should not work
         self.client.get(reverse('deletedomain', kwargs={'domain_id': dn.id}))
         DomainName.objects.get(pk=dn.pk)
+        apply_ansible_state(dn.vhost)
         # Test deletion of accepted domain
         with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
             mock_subprocess.check_output.return_value.returncode = 0
@@ -327,6 +330,7 @@ class DNSTests(TestCase):
         # Get should not work
         self.client.get(reverse('deletedomain', kwargs={'domain_id': dn.id}))
         DomainName.objects.get(pk=dn.pk)
+        apply_ansible_state(dn.vhost)
         # Test deletion of external domain
         with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
             mock_subprocess.check_output.return_value.returncode = 0
@@ -351,10 +355,19 @@ class DNSTests(TestCase):
                 mock_ip_reg_call.return_value = {}
                 self.client.post(reverse('deletedomain', kwargs={'domain_id': dn.id}))
                 assert not mock_ip_reg_call.called
-            assert_host_ansible_call(mock_subprocess, Vhost.objects.first())
+            # The domain name was never on the server, so the hostvars have not changed and Ansible is not run
+            mock_subprocess.check_output.assert_not_called()
         with self.assertRaises(DomainName.DoesNotExist):
             DomainName.objects.get(pk=dn.pk)
 
+
+def apply_ansible_state(vhost):
+    """Runs Ansible against the service of the vhost, as adding its domain names from the panel would have done"""
+    with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
+        mock_subprocess.check_output.return_value.returncode = 0
+        launch_ansible(vhost.service)
+
+
 def assert_host_ansible_call(mock_subprocess, vhost):
     mock_subprocess.check_output.assert_called_once_with([
         "userv", "mws-admin", "mws_ansible_host",
@@ -0,0 +1,202 @@
+import base64
+import hashlib
+import json
+import os
+import subprocess
+import struct
+import sys
+import tempfile
+import mock
+from django.test import TestCase, TransactionTestCase, override_settings
+from apimws.benchmark import create_fleet
+from apimws.ipreg import (IPRegBatch, get_nameinfo, get_cname, set_cname, delete_cname, DomainNameDelegatedException,
+                          READ_CACHE, read_cache_stats)
+from apimws.sshfp import reconcile_sshfp, site_hostnames
+from apimws.xen import secrets_prealocation_vm
+from sitesmanagement.models import DomainName, Site, SiteKey, VirtualMachine
+
+
+FAKE_IPREG = os.path.join(os.path.dirname(__file__), 'fake_ipreg.py')
+
+
+class FakeIPRegMixin(object):
+    """Points IP_REG_API_END_POINT to fake_ipreg.py, with a new state for every test"""
+
+    def setUp(self):
+        state_fd, self.state_file = tempfile.mkstemp()
+        with os.fdopen(state_fd, 'w') as state:
+            json.dump({'records': {}, 'delegated': ['delegated.example']}, state)
+        self.settings = override_settings(IP_REG_API_END_POINT=[sys.executable, FAKE_IPREG, self.state_file])
+        self.settings.enable()
+        READ_CACHE.clear()
+
+    def tearDown(self):
+        self.settings.disable()
+        os.remove(self.state_file)
+
+    def state(self):
+        with open(self.state_file) as state:
+            return json.load(state)
+
+
+class IPRegTests(FakeIPRegMixin, TestCase):
+
+    def run_batch(self):
+        with IPRegBatch() as batch:
+            batch.set_sshfp("host.example", 1, 2, "abcd")
+            batch.set_cname("www.delegated.example", "host.example")
+            batch.set_cname("www.example", "host.example")
+            batch.get_nameinfo("www.example")
+        return batch
+
+    def test_single_call(self):
+        set_cname("www.example", "host.example")
+        self.assertEqual(get_nameinfo("www.example")['exists'], ['C'])
+        with self.assertRaises(DomainNameDelegatedException):
+            set_cname("www.delegated.example", "host.example")
+
+    def test_read_cache(self):
+        set_cname("www.example", "host.example")
+        for i in range(3):
+            self.assertEqual(get_nameinfo("www.example")['exists'], ['C'])
+            self.assertEqual(get_cname("www.example")['cname'], "host.example")
+        self.assertEqual(self.state()['invocations'], 3)
+        self.assertEqual(read_cache_stats()['hits'], 4)
+        # Changes forget the cached responses
+        delete_cname("www.example")
+        self.assertEqual(get_nameinfo("www.example")['exists'], [])
+        with override_settings(IP_REG_API_BATCH=True):
+            with IPRegBatch() as batch:
+                batch.set_cname("www.example", "other.example")
+        self.assertEqual(get_cname("www.example")['cname'], "other.example")
+        self.assertEqual(self.state()['invocations'], 7)
+
+    @override_settings(IP_REG_API_BATCH=True)
+    def test_batch(self):
+        batch = self.run_batch()
+        self.assertEqual(self.state()['invocations'], 1)
+        self.assertEqual(len(batch.results), 4)
+        self.assertEqual(batch.results[0]['status'], 0)
+        self.assertEqual([(call, excp.returncode) for call, excp in batch.errors()],
+                         [(['put', 'cname', 'www.delegated.example', 'host.example'], 7)])
+        # The calls are made in order
+        self.assertEqual(batch.results[3]['exists'], ['C'])
+        with self.assertRaises(subprocess.CalledProcessError):
+            batch.raise_for_errors()
+
+    @override_settings(IP_REG_API_BATCH=False)
+    def test_sequential(self):
+        batch = self.run_batch()
+        self.assertEqual(self.state()['invocations'], 4)
+        self.assertEqual([(call, excp.returncode) for call, excp in batch.errors()],
+                         [(['put', 'cname', 'www.delegated.example', 'host.example'], 7)])
+        self.assertEqual(batch.results[3]['exists'], ['C'])
+
+
+def ed25519_key(seed):
+    """An ssh-ed25519 public key made up from seed"""
+    blob = ''.join(struct.pack('>I', len(data)) + data for data in ('ssh-ed25519', hashlib.sha256(seed).digest()))
+    return "ssh-ed25519 %s" % base64.b64encode(blob)
+
+
+class SSHFPMixin(FakeIPRegMixin):
+
+    def setUp(self):
+        super(SSHFPMixin, self).setUp()
+        create_fleet(1)
+        self.site = Site.objects.get()
+        self.hostnames = site_hostnames(self.site)
+        self.key = SiteKey.objects.create(site=self.site, type='ED25519', public_key=ed25519_key("key"))
+        self.fingerprint = hashlib.sha256(base64.b64decode(ed25519_key("key").split()[1])).hexdigest()
+
+    def sshfp_records(self):
+        return dict((hostname, sorted(records.get('sshfp') or []))
+                    for hostname, records in self.state()['records'].items())
+
+
+@override_settings(IP_REG_API_BATCH=True)
+class SSHFPReconcilerTests(SSHFPMixin, TestCase):
+
+    def test_reconcile(self):
+        self.assertEqual(len(self.hostnames), 4)
+        self.assertEqual(reconcile_sshfp(self.site).errors(), [])
+        expected = [['4', '2', self.fingerprint]]
+        self.assertEqual(self.sshfp_records(), dict((hostname, expected) for hostname in self.hostnames))
+        # One call to read the records and one to add them
+        self.assertEqual(self.state()['invocations'], 2)
+        # Nothing is changed the second time
+        self.assertEqual(reconcile_sshfp(self.site).calls, [])
+        self.assertEqual(self.state()['invocations'], 3)
+
+    def test_stale_records(self):
+        with IPRegBatch() as batch:
+            batch.set_sshfp(self.hostnames[0], 4, 2, "0123")
+            batch.set_sshfp(self.hostnames[1], 4, 1, "4567")
+            batch.set_sshfp(self.hostnames[2], 4, 2, self.fingerprint)
+        self.assertEqual(reconcile_sshfp(self.site).calls, [
+            ['delete', 'sshfp', self.hostnames[0], '4', '2'],
+            ['put', 'sshfp', self.hostnames[0], '4', '2', self.fingerprint],
+            ['delete', 'sshfp', self.hostnames[1], '4', '1'],
+            ['put', 'sshfp', self.hostnames[1], '4', '2', self.fingerprint],
+            ['put', 'sshfp', self.hostnames[3], '4', '2', self.fingerprint]])
+        self.assertEqual(self.sshfp_records(), dict((hostname, [['4', '2', self.fingerprint]])
+                                                    for hostname in self.hostnames))
+
+    def test_secrets_prealocation_vm(self):
+        def mws_pubkey(*args, **kwargs):
+            process = mock.Mock()
+            process.communicate.side_effect = lambda request: (json.dumps({
+                'pubkey': ed25519_key(json.loads(request)['keytype'])}), '')
+            return process
+
+        self.key.delete()
+        vm = VirtualMachine.objects.filter(service__site=self.site).first()
+        with mock.patch("apimws.xen.subprocess") as mock_subprocess:
+            mock_subprocess.Popen.side_effect = mws_pubkey
+            secrets_prealocation_vm(vm)
+            self.assertEqual(mock_subprocess.Popen.call_count, len(SiteKey.ALGORITHMS))
+            self.assertEqual(sorted(self.site.keys.values_list('type', flat=True)), sorted(SiteKey.ALGORITHMS))
+            self.assertEqual(set(len(records) for records in self.sshfp_records().values()),
+                             set([len(SiteKey.ALGORITHMS)]))
+            invocations = self.state()['invocations']
+            # Running it again for another VM of the site only reads the SSHFP records
+            secrets_prealocation_vm(vm)
+            self.assertEqual(self.site.keys.count(), len(SiteKey.ALGORITHMS))
+            self.assertEqual(self.state()['invocations'], invocations + 1)
+
+
+@override_settings(IP_REG_API_BATCH=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory')
+class SSHFPDeletionTests(SSHFPMixin, TransactionTestCase):
+    # The records are deleted once the deletion is committed
+    serialized_rollback = True
+
+    def test_delete_sshfp_from_dns(self):
+        other = SiteKey.objects.create(site=self.site, type='RSA', public_key="ssh-rsa invalid")
+        reconcile_sshfp(self.site)
+        other.delete()
+        # The records of the other key are left alone
+        self.assertEqual(self.state()['invocations'], 3)
+        self.key.delete()
+        self.assertEqual(self.sshfp_records(), dict((hostname, []) for hostname in self.hostnames))
+        self.assertEqual(self.state()['invocations'], 5)
+
+    @mock.patch("apimws.xen.vm_api_request")
+    def test_delete_site(self, mock_vm_api_request):
+        for key_type in ('RSA', 'ECDSA'):
+            SiteKey.objects.create(site=self.site, type=key_type, public_key=ed25519_key(key_type))
+        reconcile_sshfp(self.site)
+        self.assertEqual(set(len(records) for records in self.sshfp_records().values()), set([3]))
+        self.site.delete()
+        self.assertEqual([self.sshfp_records()[hostname] for hostname in self.hostnames], [[]] * 4)
+
+    @mock.patch("apimws.xen.vm_api_request")
+    @mock.patch("apimws.jackdaw.LOGGER")
+    def test_dns_failure(self, mock_logger, mock_vm_api_request):
+        reconcile_sshfp(self.site)
+        # Not deleted from the DNS
+        DomainName.objects.update(status='requested')
+        # A failure of the DNS API is logged and does not prevent the deletion
+        with override_settings(IP_REG_API_END_POINT=['false'], CELERY_EAGER_PROPAGATES_EXCEPTIONS=False):
+            self.site.delete()
+        self.assertFalse(Site.objects.exists())
+        self.assertTrue(mock_logger.error.called)
@@ -0,0 +1,87 @@
+from datetime import timedelta
+from django.test import TestCase
+from django.utils import timezone
+from mock import patch
+from apimws.benchmark import create_fleet
+from apimws.locks import acquire, release, task_lock
+from apimws.models import TaskLock
+from apimws.xen import change_vm_power_state, reset_vm, VMAPIFailure
+from sitesmanagement.models import VirtualMachine
+
+
+class TaskLockTests(TestCase):
+
+    def test_acquire_release(self):
+        owner = acquire("key")
+        self.assertIsNotNone(owner)
+        self.assertIsNone(acquire("key"))
+        # Other keys are independent
+        self.assertIsNotNone(acquire("other"))
+        # Only its owner can release it
+        self.assertFalse(release("key", "someone else"))
+        self.assertIsNone(acquire("key"))
+        self.assertTrue(release("key", owner))
+        self.assertFalse(release("key", owner))
+        self.assertIsNotNone(acquire("key"))
+
+    def test_expiry(self):
+        owner = acquire("key", ttl=60)
+        self.assertIsNone(acquire("key"))
+        TaskLock.objects.filter(key="key").update(expires=timezone.now() - timedelta(seconds=1))
+        new_owner = acquire("key")
+        self.assertIsNotNone(new_owner)
+        # The previous owner cannot release it any more
+        self.assertFalse(release("key", owner))
+        self.assertEqual(TaskLock.objects.get(key="key").owner, new_owner)
+
+    def test_task_lock(self):
+        with task_lock("key") as acquired:
+            self.assertTrue(acquired)
+            with task_lock("key") as acquired_again:
+                self.assertFalse(acquired_again)
+            # Not acquiring it does not release it
+            self.assertTrue(TaskLock.objects.filter(key="key").exists())
+        self.assertFalse(TaskLock.objects.exists())
+        with self.assertRaises(ValueError):
+            with task_lock("key"):
+                raise ValueError()
+        self.assertFalse(TaskLock.objects.exists())
+
+
+@patch("apimws.xen.vm_api_request")
+class PowerLockTests(TestCase):
+
+    def setUp(self):
+        create_fleet(1)
+        self.vm = VirtualMachine.objects.first()
+
+    def test_duplicate_submissions(self, mock_vm_api_request):
+        duplicates = []
+
+        def press_again(*args, **kwargs):
+            # Submitted while the first one is still being processed
+            duplicates.append(change_vm_power_state(self.vm.id, 'off'))
+            duplicates.append(change_vm_power_state(self.vm.id, 'on'))
+            duplicates.append(reset_vm(self.vm.id))
+            return "{}"
+
+        mock_vm_api_request.side_effect = press_again
+        self.assertTrue(change_vm_power_state(self.vm.id, 'off'))
+        self.assertEqual(duplicates, [False, False, False])
+        self.assertEqual(mock_vm_api_request.call_count, 1)
+        self.assertFalse(TaskLock.objects.exists())
+
+        # Once done the VM buttons can be pressed again, and those of other VMs at any time
+        mock_vm_api_request.side_effect = None
+        mock_vm_api_request.return_value = "{}"
+        self.assertTrue(reset_vm(self.vm.id))
+        with task_lock("vm-%d-power" % self.vm.id):
+            other_vm = VirtualMachine.objects.exclude(id=self.vm.id).first()
+            self.assertTrue(change_vm_power_state(other_vm.id, 'on'))
+            self.assertFalse(change_vm_power_state(self.vm.id, 'on'))
+
+    def test_failure_releases_lock(self, mock_vm_api_request):
+        mock_vm_api_request.side_effect = VMAPIFailure
+        with self.assertRaises(VMAPIFailure):
+            change_vm_power_state(self.vm.id, 'off')
+        self.assertFalse(TaskLock.objects.exists())
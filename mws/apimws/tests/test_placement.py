@@ -0,0 +1,182 @@
+import json
+import os
+import random
+import sys
+import tempfile
+from datetime import timedelta
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from apimws.benchmark import create_fleet
+from apimws.models import Cluster, Host
+from apimws.placement import (Candidate, NoCapacityException, RESOURCES, binpack, cluster_usage, pick_host, place,
+                              spread, which_cluster, host_order, host_metrics, _host_counters)
+from apimws.xen import vm_api_request, VMAPIFailure
+from sitesmanagement.models import Service, VirtualMachine
+
+
+FAKE_VM_API = os.path.join(os.path.dirname(__file__), 'fake_vm_api.py')
+
+
+class PlacementSimulationTests(TestCase):
+    """Places a synthetic fleet of VMs of random sizes in clusters of different capacities, without a database"""
+
+    def setUp(self):
+        self.random = random.Random(0)
+        self.clusters = [
+            Candidate(Cluster(name="small"), dict((resource, 0) for resource in RESOURCES),
+                      {'vms': 50, 'cpu': 100, 'ram': 200, 'disk': None}),
+            Candidate(Cluster(name="medium"), dict((resource, 0) for resource in RESOURCES),
+                      {'vms': None, 'cpu': 200, 'ram': 400, 'disk': 5000}),
+            Candidate(Cluster(name="large"), dict((resource, 0) for resource in RESOURCES),
+                      {'vms': None, 'cpu': 400, 'ram': 800, 'disk': 10000}),
+        ]
+
+    def simulate(self, strategy):
+        """Places VMs until no cluster has capacity left, returns the order in which the clusters got their first VM"""
+        first_used = []
+        while True:
+            numcpu = self.random.choice([1, 2, 4])
+            needs = {'vms': 1, 'cpu': numcpu, 'ram': numcpu * 2, 'disk': 20 * numcpu}
+            try:
+                candidate = place(self.clusters, needs, strategy)
+            except NoCapacityException:
+                return first_used
+            if candidate.usage['vms'] == 0:
+                first_used.append(candidate.cluster.name)
+            for resource in RESOURCES:
+                candidate.usage[resource] += needs[resource]
+
+    def assertWithinCapacity(self):
+        for candidate in self.clusters:
+            for resource in RESOURCES:
+                if candidate.capacity[resource] is not None:
+                    self.assertLessEqual(candidate.usage[resource], candidate.capacity[resource])
+            # All of them are (nearly) full at the end
+            self.assertGreater(candidate.load({'vms': 0, 'cpu': 0, 'ram': 0, 'disk': 0}), 0.95)
+
+    def test_spread(self):
+        loads = []
+        for i in range(200):
+            numcpu = self.random.choice([1, 2, 4])
+            needs = {'vms': 1, 'cpu': numcpu, 'ram': numcpu * 2, 'disk': 20 * numcpu}
+            candidate = place(self.clusters, needs, spread)
+            for resource in RESOURCES:
+                candidate.usage[resource] += needs[resource]
+            loads.append([c.load({'vms': 0, 'cpu': 0, 'ram': 0, 'disk': 0}) for c in self.clusters])
+        # The clusters are kept equally loaded, relative to their capacity
+        self.assertLess(max(loads[-1]) - min(loads[-1]), 0.05)
+        self.simulate(spread)
+        self.assertWithinCapacity()
+
+    def test_binpack(self):
+        # Best fit: a cluster is only used once those that would be more loaded are full
+        self.assertEqual(self.simulate(binpack), ["small", "medium", "large"])
+        self.assertWithinCapacity()
+
+
+class PlacementTests(TestCase):
+
+    def setUp(self):
+        self.full = Cluster.objects.create(name="a-full")
+        self.empty = Cluster.objects.create(name="b-empty")
+        # The fleet VMs are created in the first cluster
+        create_fleet(3)
+        self.service = Service.objects.filter(type='production').first()
+
+    def test_which_cluster(self):
+        self.assertEqual(cluster_usage()[self.full.name]['vms'], 6)
+        with override_settings(VM_PLACEMENT_STRATEGY='spread'):
+            self.assertEqual(which_cluster(self.service), self.empty)
+        with override_settings(VM_PLACEMENT_STRATEGY='binpack'):
+            self.assertEqual(which_cluster(self.service), self.full)
+            # Unless it is full
+            Cluster.objects.filter(name=self.full.name).update(max_vms=6)
+            self.assertEqual(which_cluster(self.service), self.empty)
+            Cluster.objects.filter(name=self.empty.name).update(max_vms=0)
+            with self.assertRaises(NoCapacityException):
+                which_cluster(self.service)
+            # The capacity of the cluster is that of its hosts if not set
+            Cluster.objects.filter(name=self.full.name).update(max_vms=None)
+            Host.objects.create(hostname="a1", cluster=self.full, max_vms=3)
+            Host.objects.create(hostname="a2", cluster=self.full, max_vms=3)
+            with self.assertRaises(NoCapacityException):
+                which_cluster(self.service)
+            Host.objects.filter(hostname="a2").update(max_vms=4)
+            self.assertEqual(which_cluster(self.service), self.full)
+            # Clusters whose hosts are all disabled are left alone
+            Host.objects.update(enabled=False)
+            Cluster.objects.filter(name=self.empty.name).update(max_vms=None)
+            self.assertEqual(which_cluster(self.service), self.empty)
+
+    def test_pick_host(self):
+        _host_counters.clear()
+        for hostname in ("h1", "h2", "h3"):
+            Host.objects.create(hostname=hostname, cluster=self.full)
+        Host.objects.filter(hostname="h2").update(enabled=False)
+        picked = [pick_host(self.full).hostname for i in range(4)]
+        self.assertEqual(sorted(picked), ["h1", "h1", "h3", "h3"])
+        self.assertNotEqual(picked[0], picked[1])
+
+
+class HostFailoverTests(TestCase):
+
+    def setUp(self):
+        _host_counters.clear()
+        self.cluster = Cluster.objects.create(name="cluster")
+        for hostname in ("h1", "h2", "h3"):
+            Host.objects.create(hostname=hostname, cluster=self.cluster)
+        create_fleet(1)
+        self.vm = VirtualMachine.objects.first()
+        state_fd, self.state_file = tempfile.mkstemp()
+        self.write_state({'down': ["h1"]})
+        self.settings = override_settings(VM_END_POINT_COMMAND=[sys.executable, FAKE_VM_API, self.state_file])
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        os.remove(self.state_file)
+
+    def write_state(self, state):
+        with open(self.state_file, 'w') as state_fd:
+            json.dump(state, state_fd)
+
+    def requests(self):
+        with open(self.state_file) as state_fd:
+            return [(host, command) for host, command, parameters in json.load(state_fd).get('requests', [])]
+
+    def test_failover(self):
+        # Idempotent requests are tried on the next host
+        vm_api_request('button', {'action': 'poweroff', 'vmid': self.vm.name}, self.vm)
+        self.assertEqual(self.requests(), [("h1", 'button'), ("h2", 'button')])
+        # Others are not, and each request starts with the next host in turn
+        vm_api_request('create', {}, self.vm)
+        vm_api_request('create', {}, self.vm)
+        with self.assertRaises(VMAPIFailure):
+            vm_api_request('create', {}, self.vm)
+        self.assertEqual(self.requests()[2:], [("h2", 'create'), ("h3", 'create'), ("h1", 'create')])
+
+        metrics = dict((host['hostname'], host) for host in host_metrics())
+        self.assertEqual((metrics["h1"]['requests'], metrics["h1"]['failures']), (2, 2))
+        self.assertEqual((metrics["h2"]['requests'], metrics["h2"]['failures']), (2, 0))
+        self.assertIsNotNone(metrics["h2"]['latency'])
+
+    @override_settings(VM_API_CIRCUIT_THRESHOLD=2)
+    def test_circuit_breaker(self):
+        for i in range(2):
+            vm_api_request('delete', {'vmid': self.vm.name}, self.vm)
+            _host_counters.clear()
+        self.assertGreater(Host.objects.get(hostname="h1").circuit_open_until, timezone.now())
+        # No more requests are sent to h1 while its circuit is open
+        for i in range(3):
+            vm_api_request('delete', {'vmid': self.vm.name}, self.vm)
+        self.assertEqual([host for host, command in self.requests()], ["h1", "h2", "h1", "h2", "h2", "h3", "h2"])
+        self.assertEqual([host.hostname for host in host_order(self.cluster)][-1], "h1")
+
+        # It is tried again after the cooldown, and closed by the first request that succeeds
+        self.write_state({'down': []})
+        Host.objects.filter(hostname="h1").update(circuit_open_until=timezone.now() - timedelta(seconds=1))
+        _host_counters.clear()
+        vm_api_request('create', {}, self.vm)
+        self.assertEqual(self.requests(), [("h1", 'create')])
+        h1 = Host.objects.get(hostname="h1")
+        self.assertEqual((h1.circuit_open_until, h1.consecutive_failures, h1.failures), (None, 0, 2))
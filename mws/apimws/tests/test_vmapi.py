@@ -3,11 +3,12 @@ import os
 from django.conf import settings
 from django.test import TestCase, override_settings
 from mock import patch, call
+from apimws.models import ProvisioningStage
 
 from mwsauth.tests import do_test_login
 from sitesmanagement.models import VirtualMachine
 from sitesmanagement.tests.tests import assign_a_site
-from apimws.xen import change_vm_power_state, reset_vm, destroy_vm, clone_vm_api_call
+from apimws.xen import change_vm_power_state, reset_vm, destroy_vm, clone_vm_api_call, provisioning_metrics
 
 
 @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory')
@@ -20,13 +21,12 @@ class XenAPITests(TestCase):
 
     @staticmethod
     @patch("apimws.xen.launch_ansible")
-    @patch("apimws.xen.secrets_prealocation_vm")
-    @patch("apimws.xen.app")
+    @patch("apimws.xen.publish_keys")
+    @patch("apimws.xen.fetch_pubkeys")
     @patch("apimws.xen.vm_api_request")
-    def test_xen_api(mock_vm_api_request, mock_xen_app, secrets_prealocation_vm, launch_ansible):
+    def test_xen_api(mock_vm_api_request, fetch_pubkeys, publish_keys, launch_ansible):
         # We retrieve the VM created by the create Xen API call
         vm = VirtualMachine.objects.first()
-        mock_xen_app.control.inspect.active.values.return_value = []
         mock_vm_api_request.return_value = "{}"
         # We try that the switch off change of state works
         change_vm_power_state(vm.id, "off")
@@ -38,9 +38,44 @@ class XenAPITests(TestCase):
         site = vm.site
         clone_vm_api_call(site)
 
-        secrets_prealocation_vm.assert_called_once_with(site.secondary_vm)
+        fetch_pubkeys.assert_called_once_with(site)
+        publish_keys.assert_called_once_with(site, fetch_pubkeys.return_value)
         launch_ansible.assert_has_calls([call(site.production_service), call(site.test_service)])
 
         # We try the deletion of both VMs through a Xen API call
         destroy_vm(site.secondary_vm.id)
         destroy_vm(site.primary_vm.id)
+
+    @patch("apimws.xen.launch_ansible")
+    @patch("apimws.xen.publish_keys")
+    @patch("apimws.xen.fetch_pubkeys")
+    @patch("apimws.xen.vm_api_request")
+    def test_provisioning_stages(self, mock_vm_api_request, fetch_pubkeys, publish_keys, launch_ansible):
+        site = VirtualMachine.objects.first().site
+        # The creation of the site VM was recorded
+        self.assertEqual(set(ProvisioningStage.objects.filter(pipeline='new').values_list('stage', 'outcome')),
+                         set([('network', 'success'), ('keys', 'success'), ('create', 'success'),
+                              ('default vhost', 'success'), ('sshfp', 'success'), ('total', 'success')]))
+
+        mock_vm_api_request.return_value = '{"vmid": "mws-client2"}'
+        clone_vm_api_call(site)
+        self.assertEqual(site.secondary_vm.name, "mws-client2")
+        stages = ProvisioningStage.objects.filter(pipeline='clone', service=site.test_service)
+        self.assertEqual(sorted(stages.values_list('stage', flat=True)),
+                         ['ansible', 'create', 'keys', 'network', 'php libs', 'sshfp', 'total'])
+        total = stages.get(stage='total')
+        self.assertTrue(all(stage.started >= total.started and stage.duration <= total.duration
+                            for stage in stages))
+
+        # The stages that ran before a failure and the failure are recorded too
+        mock_vm_api_request.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            clone_vm_api_call(site)
+        failed = ProvisioningStage.objects.filter(pipeline='clone').order_by('-started')[:4]
+        self.assertEqual(set(failed.values_list('stage', 'outcome')),
+                         set([('network', 'success'), ('keys', 'success'), ('create', 'failure'),
+                              ('total', 'failure')]))
+
+        metrics = dict((metric['stage'], metric) for metric in provisioning_metrics() if metric['pipeline'] == 'clone')
+        self.assertEqual((metrics['create']['runs'], metrics['create']['failures']), (2, 1))
+        self.assertEqual((metrics['ansible']['runs'], metrics['ansible']['failures']), (1, 0))
@@ -0,0 +1,94 @@
+from datetime import timedelta
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from mock import patch
+from apimws import warmpool
+from apimws.models import Cluster, Host, ProvisioningStage
+from sitesmanagement.models import NetworkConfig, ServerType, Site, VirtualMachine
+
+
+def create_network_configurations(number):
+    """Creates the network configurations of number sites"""
+    for n in range(number):
+        NetworkConfig.objects.create(IPv4='131.111.58.%d' % n, IPv6='2001:630:212:8::8c:%x' % n, type='ipvxpub',
+                                     name="mws-%d.mws3.csx.cam.ac.uk" % n)
+        NetworkConfig.objects.create(IPv4='172.28.18.%d' % n, type='ipv4priv',
+                                     name='mws-%d.mws3.csx.private.cam.ac.uk' % n)
+        NetworkConfig.objects.create(IPv6='2001:630:212:8::8d:%x' % n, name='mws-client%d' % n, type='ipv6')
+
+
+@override_settings(WARM_POOL_CONCURRENCY=3)
+@patch("apimws.warmpool.new_site_primary_vm")
+class WarmPoolTests(TestCase):
+
+    def setUp(self):
+        cluster = Cluster.objects.create(name='cluster')
+        Host.objects.create(hostname='host', cluster=cluster)
+        self.servertype = ServerType.objects.get(id=1)
+        self.servertype.preallocated = 5
+        self.servertype.preallocated_low = 2
+        self.servertype.save()
+
+    def finish_installations(self):
+        Site.objects.filter(preallocated=True).update(disabled=True)
+
+    def claim(self, number):
+        for site in Site.objects.filter(preallocated=True, disabled=True)[:number]:
+            Site.objects.filter(id=site.id).update(preallocated=False, disabled=False)
+
+    def test_refill(self, new_site_primary_vm):
+        create_network_configurations(8)
+        # The pool is refilled WARM_POOL_CONCURRENCY sites at a time, each of them installed by a task of its own
+        self.assertEqual(warmpool.refill(), {1: 3})
+        self.assertEqual(new_site_primary_vm.delay.call_count, 3)
+        vms = [kwargs['vm'] for args, kwargs in new_site_primary_vm.delay.call_args_list]
+        self.assertEqual(len(set(vm.network_configuration_id for vm in vms)), 3)
+        self.assertEqual(set(VirtualMachine.objects.values_list('service__site__preallocated', 'service__status')),
+                         set([(True, 'installing')]))
+        self.assertEqual(warmpool.refill(), {})
+        # Once they are installed the refill goes on up to the high watermark
+        self.finish_installations()
+        self.assertEqual(warmpool.refill(), {1: 2})
+        self.finish_installations()
+        self.assertEqual(warmpool.refill(), {})
+        self.assertFalse(ServerType.objects.get(id=1).pool_refilling)
+
+        # It is only refilled again once it falls below its low watermark
+        self.claim(3)
+        self.assertEqual(warmpool.refill(), {})
+        self.claim(1)
+        self.assertEqual(warmpool.refill(), {1: 3})
+        self.assertEqual(warmpool.pool_metrics(), [{
+            'servertype': 1, 'ready': 1, 'building': 3, 'stuck': 0, 'low': 2, 'high': 5, 'refilling': True,
+            'hits': 0, 'misses': 0}])
+
+    def test_stuck_installations(self, new_site_primary_vm):
+        create_network_configurations(8)
+        self.assertEqual(warmpool.refill(), {1: 3})
+        self.assertEqual(warmpool.refill(), {})
+        # An installation that failed and one that hangs no longer take up the slots of the refill
+        failed, hung, building = Site.objects.order_by('id')
+        ProvisioningStage.objects.create(service=failed.production_service, pipeline='new', stage='total',
+                                         started=timezone.now(), duration=1, outcome='failure')
+        Site.objects.filter(id=hung.id).update(preallocated_at=timezone.now() - timedelta(hours=3))
+        self.assertEqual(warmpool.pool_depths()[1], {'ready': 0, 'building': 1, 'stuck': 2})
+        self.assertEqual(warmpool.refill(), {1: 2})
+        self.assertEqual(Site.objects.count(), 5)
+
+    def test_priority(self, new_site_primary_vm):
+        create_network_configurations(3)
+        other = ServerType.objects.create(numcpu=2, sizeram=2, sizedisk=40, preallocated=2, price=200, order=2)
+        self.assertEqual(warmpool.refill(), {1: 2, other.id: 1})
+
+    def test_no_network_configurations(self, new_site_primary_vm):
+        create_network_configurations(1)
+        self.assertEqual(warmpool.refill(), {1: 1})
+        # The site that could not be given a network configuration is not left behind
+        self.assertEqual(Site.objects.count(), 1)
+        self.assertEqual(new_site_primary_vm.delay.call_count, 1)
+
+    def test_record_request(self, new_site_primary_vm):
+        warmpool.record_request(self.servertype, True)
+        warmpool.record_request(self.servertype, True)
+        warmpool.record_request(self.servertype, False)
+        self.assertEqual(ServerType.objects.filter(id=1).values_list('pool_hits', 'pool_misses').get(), (2, 1))
@@ -6,6 +6,7 @@ from celery import shared_task, Task
 from django.core.mail import EmailMessage
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.utils import timezone
 from apimws.vm import new_site_primary_vm
 from sitesmanagement.models import EmailConfirmation, NetworkConfig, Site, Service, ServerType
 from sitesmanagement.utils import is_camacuk_subdomain
@@ -98,19 +99,21 @@ def finished_installation_email_confirmation(site):
     ).send()
 
 
-def preallocate_new_site(servertype=None):
+def reserve_new_site(servertype=None):
     """
-    Create a new :py:class:`~sitesmanagement.models.Site` object with a unique
-    uuid4 as name. The new Site has two
-    :py:class:`~sitesmanagement.models.Service` instances associated with it,
-    "production" and "test".
+    Create a new preallocated :py:class:`~sitesmanagement.models.Site` with a
+    unique uuid4 as name and its "production" and "test"
+    :py:class:`~sitesmanagement.models.Service` instances, without installing
+    its VM. Returns the production service and the host network
+    configuration its VM is to be created with.
 
     """
     if servertype:
-        site = Site.objects.create(name=uuid.uuid4(), disabled=False, preallocated=True, type=servertype)
+        site = Site.objects.create(name=uuid.uuid4(), disabled=False, preallocated=True, type=servertype,
+                                   preallocated_at=timezone.now())
     else:
         site = Site.objects.create(name=uuid.uuid4(), disabled=False, preallocated=True,
-                                   type=ServerType.objects.get(id=1))
+                                   type=ServerType.objects.get(id=1), preallocated_at=timezone.now())
     prod_service_netconf = NetworkConfig.get_free_prod_service_config()
     test_service_netconf = NetworkConfig.get_free_test_service_config()
     host_netconf = NetworkConfig.get_free_host_config()
@@ -118,8 +121,20 @@ def preallocate_new_site(servertype=None):
         raise Exception('A MWS server cannot be created at this moment because there are no network addresses available')
     prod_service = Service.objects.create(site=site, type='production', network_configuration=prod_service_netconf)
     Service.objects.create(site=site, type='test', network_configuration=test_service_netconf)
-    new_site_primary_vm(prod_service, host_netconf)
     LOGGER.info("Preallocated MWS server created '" + str(site.name) + "' with id " + str(site.id))
+    return prod_service, host_netconf
+
+
+def preallocate_new_site(servertype=None):
+    """
+    Create a new :py:class:`~sitesmanagement.models.Site` object with a unique
+    uuid4 as name. The new Site has two
+    :py:class:`~sitesmanagement.models.Service` instances associated with it,
+    "production" and "test".
+
+    """
+    prod_service, host_netconf = reserve_new_site(servertype)
+    new_site_primary_vm(prod_service, host_netconf)
 
 
 @shared_task(base=EmailTaskWithFailure, default_retry_delay=15*60, max_retries=6)  # Retry each 15 minutes for 6 times
@@ -1,4 +1,5 @@
 import calendar
+import hmac
 import logging
 import subprocess
 from datetime import date, datetime, timedelta
@@ -8,11 +9,12 @@ from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.mail import EmailMessage
 from django.db.models import Q
-from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound, JsonResponse
 from django.shortcuts import get_object_or_404, render, redirect
 from django.views.decorators.csrf import csrf_exempt
 from stronghold.decorators import public
 from apimws.ansible import launch_ansible_async, AnsibleTaskWithFailure, ansible_change_mysql_root_pwd
+from apimws.inventory import host_hostvars
 from apimws.ipreg import get_nameinfo
 from mwsauth.utils import privileges_check
 from sitesmanagement.models import DomainName, EmailConfirmation, VirtualMachine, Billing, Site, Vhost
@@ -146,6 +148,26 @@ def post_installation(request):
     return HttpResponseForbidden()
 
 
+@public
+def inventory_host(request, hostname):
+    """Endpoint used by the Ansible controller to fetch the hostvars of a VM, as emitted by
+    ``ansible_inventory --host``, in a single request. The token passed in the X-MWS-Inventory-Token header must be
+    the one in the ANSIBLE_INVENTORY_TOKEN setting. It is not accepted as a query parameter, which would end up in
+    the access logs of the web server and of any proxy.
+
+    """
+    expected_token = getattr(settings, 'ANSIBLE_INVENTORY_TOKEN', None)
+    token = request.META.get('HTTP_X_MWS_INVENTORY_TOKEN', '')
+    if request.method != 'GET' or not expected_token or \
+            not hmac.compare_digest(token.encode('utf-8'), expected_token.encode('utf-8')):
+        return HttpResponseForbidden()
+
+    hostvars = host_hostvars(hostname)
+    if hostvars is None:
+        return HttpResponseNotFound()
+    return HttpResponse(hostvars, content_type='application/json')
+
+
 @public
 @csrf_exempt
 def post_recreate(request):
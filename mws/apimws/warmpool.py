@@ -0,0 +1,113 @@
+'''
+The warm pool of preallocated sites of every ServerType, from which SiteCreate serves new sites without waiting for
+their installation. A pool is refilled up to ServerType.preallocated sites (its high watermark) once it has fewer
+than ServerType.preallocated_low (its low watermark), installing up to WARM_POOL_CONCURRENCY VMs at the same time.
+The sites whose installation failed or takes longer than WARM_POOL_BUILD_TIMEOUT seconds are not counted in the
+pool, and are left for an administrator to look into. refill() is called by
+sitesmanagement.cronjobs.check_num_preallocated_sites, which also runs whenever a site is requested.
+'''
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Q, Value, When
+from django.utils import timezone
+from apimws.models import ProvisioningStage
+from apimws.utils import reserve_new_site
+from apimws.vm import allocate_vm, new_site_primary_vm
+from sitesmanagement.models import ServerType, Site
+
+
+LOGGER = logging.getLogger('mws')
+
+
+def pool_depths():
+    """
+    The number of preallocated sites of each ServerType id, with a single query: those 'ready', installed and
+    disabled until a user claims them, those 'building', whose VM is being installed, and those 'stuck', whose
+    installation failed or started more than WARM_POOL_BUILD_TIMEOUT seconds ago.
+    """
+    timeout = timezone.now() - timedelta(seconds=getattr(settings, 'WARM_POOL_BUILD_TIMEOUT', 2*60*60))
+    failed = ProvisioningStage.objects.filter(pipeline='new', stage='total', outcome='failure').values('service__site')
+    depths = defaultdict(lambda: {'ready': 0, 'building': 0, 'stuck': 0})
+    for row in Site.objects.filter(preallocated=True).order_by().annotate(state=Case(
+            When(disabled=True, then=Value('ready')),
+            When(Q(preallocated_at__gt=timeout) & ~Q(id__in=failed), then=Value('building')),
+            default=Value('stuck'), output_field=models.CharField())).values('type_id', 'state').annotate(
+            sites=Count('id')):
+        depths[row['type_id']][row['state']] += row['sites']
+    return depths
+
+
+def low_watermark(servertype):
+    if servertype.preallocated_low is None:
+        return servertype.preallocated
+    return min(servertype.preallocated_low, servertype.preallocated)
+
+
+def refill():
+    """
+    Reserves the sites needed to refill the pools of all the ServerTypes, with their VMs allocated, and starts the
+    installation of those VMs as separate tasks so that they are installed in parallel. A refill starts once a pool
+    has fewer sites than its low watermark and goes on, over several calls if needed, until it reaches its high
+    watermark. No more than WARM_POOL_CONCURRENCY VMs are installed at the same time, the pools with the fewest
+    sites relative to their high watermark being refilled first.
+
+    :return: the number of sites reserved for each ServerType id
+    """
+    reserved = defaultdict(int)
+    vms = []
+    with transaction.atomic():
+        # Concurrent refills are serialised, so that they do not reserve more sites than needed
+        servertypes = list(ServerType.objects.select_for_update().order_by('id'))
+        depths = pool_depths()
+        slots = getattr(settings, 'WARM_POOL_CONCURRENCY', 4) - sum(depth['building'] for depth in depths.values())
+        wanted = {}
+        for servertype in servertypes:
+            # The sites stuck are left out, so that the pool is refilled without them
+            depth = depths[servertype.id]['ready'] + depths[servertype.id]['building']
+            refilling = (servertype.pool_refilling or depth < low_watermark(servertype)) and \
+                depth < servertype.preallocated
+            if refilling != servertype.pool_refilling:
+                ServerType.objects.filter(id=servertype.id).update(pool_refilling=refilling)
+            if refilling:
+                wanted[servertype] = servertype.preallocated - depth
+        while slots > 0 and wanted:
+            servertype = min(wanted, key=lambda servertype: (
+                float(depths[servertype.id]['ready'] + depths[servertype.id]['building'] + reserved[servertype.id]) /
+                servertype.preallocated,
+                servertype.id))
+            try:
+                with transaction.atomic():
+                    # The VM is allocated straight away so that the host network configuration is not reserved twice
+                    vms.append(allocate_vm(*reserve_new_site(servertype)))
+            except Exception as e:
+                LOGGER.error("The warm pool of the server type %s could not be refilled: %s", servertype, e)
+                break
+            reserved[servertype.id] += 1
+            slots -= 1
+            if reserved[servertype.id] >= wanted[servertype]:
+                del wanted[servertype]
+    for vm in vms:
+        new_site_primary_vm.delay(vm.service, vm=vm)
+    return reserved
+
+
+def record_request(servertype, hit):
+    """Counts a new site request served with a preallocated site of the ServerType given (hit) or refused"""
+    if hit:
+        ServerType.objects.filter(id=servertype.id).update(pool_hits=F('pool_hits') + 1)
+    else:
+        ServerType.objects.filter(id=servertype.id).update(pool_misses=F('pool_misses') + 1)
+
+
+def pool_metrics():
+    """The depth, sites stuck, watermarks, hits and misses of the pool of every ServerType, as dicts"""
+    depths = pool_depths()
+    return [{'servertype': servertype.id, 'ready': depths[servertype.id]['ready'],
+             'building': depths[servertype.id]['building'], 'stuck': depths[servertype.id]['stuck'],
+             'low': low_watermark(servertype),
+             'high': servertype.preallocated, 'refilling': servertype.pool_refilling, 'hits': servertype.pool_hits,
+             'misses': servertype.pool_misses}
+            for servertype in ServerType.objects.order_by('id')]
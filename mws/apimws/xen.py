@@ -4,15 +4,21 @@ import logging
 import uuid
 import json
 import subprocess
+import time
+from multiprocessing.pool import ThreadPool
 from celery import shared_task, Task
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Case, Count, Max, When
+from django.utils import timezone
 from apimws.ansible import launch_ansible
-from apimws.ipreg import set_sshfp
-from apimws.models import Cluster
+from apimws.locks import task_lock
+from apimws.models import AnsibleConfiguration, ProvisioningStage
+from apimws.placement import which_cluster, host_order, record_request
+from apimws.sshfp import reconcile_sshfp
 from apimws.views import post_installation, post_recreate
 from libs.sshpubkey import SSHPubKey
-from mws.celery import app
 from sitesmanagement.models import VirtualMachine, NetworkConfig, SiteKey, Vhost, DomainName
 
 
@@ -31,18 +37,37 @@ class VMAPIFailure(Exception):
     pass
 
 
+def is_idempotent(command, parameters):
+    """Whether the VM API request can be sent again, to another host, if it fails"""
+    return command == 'delete' or (command == 'button' and parameters.get('action') in ('poweron', 'poweroff'))
+
+
 def vm_api_request(command, parameters, vm):
-    api_command = copy.copy(settings.VM_END_POINT_COMMAND)
-    api_command.append(vm.cluster.hosts.first().hostname)
-    api_command.append(command)
-    api_command.append("'%s'" % json.dumps(parameters))
-    try:
-        response = subprocess.check_output(api_command, stderr=subprocess.STDOUT)
-        LOGGER.info("VM API request: %s\nVM API response: %s", api_command, response)
-    except subprocess.CalledProcessError as e:
-        LOGGER.error("VM API request: %s\nVM API response: %s", api_command, e.output)
-        raise VMAPIFailure()
-    return response
+    """
+    Sends the VM API request to a host of the cluster of the VM, chosen by apimws.placement.host_order. Idempotent
+    requests are tried on the next host when they fail, up to VM_API_MAX_ATTEMPTS hosts.
+    """
+    hosts = host_order(vm.cluster)
+    if is_idempotent(command, parameters):
+        hosts = hosts[:getattr(settings, 'VM_API_MAX_ATTEMPTS', 3)]
+    else:
+        hosts = hosts[:1]
+    for host in hosts:
+        api_command = copy.copy(settings.VM_END_POINT_COMMAND)
+        api_command.append(host.hostname)
+        api_command.append(command)
+        api_command.append("'%s'" % json.dumps(parameters))
+        started = time.time()
+        try:
+            response = subprocess.check_output(api_command, stderr=subprocess.STDOUT)
+            LOGGER.info("VM API request: %s\nVM API response: %s", api_command, response)
+        except subprocess.CalledProcessError as e:
+            record_request(host, time.time() - started, False)
+            LOGGER.error("VM API request: %s\nVM API response: %s", api_command, e.output)
+            continue
+        record_request(host, time.time() - started, True)
+        return response
+    raise VMAPIFailure()
 
 
 class XenWithFailure(Task):
@@ -57,123 +82,161 @@ class XenWithFailure(Task):
                          "The parameters passed to the task were: %s\n\n The traceback is: \n %s", task_id, args, einfo)
 
 
+def fetch_pubkey(site, keytype):
+    """Returns the public host key of the site of the type given, one of SiteKey.ALGORITHMS, from mws_pubkey"""
+    p = subprocess.Popen(["userv", "mws-admin", "mws_pubkey"], stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate(json.dumps({"id": "mwssite-%d" % site.id,
+                                               "keytype": "ssh"+keytype.lower()}))
+    try:
+        result = json.loads(stdout)
+    except ValueError as e:
+        LOGGER.error("mws_pubkey response is not properly formated:\nstdout: %s\nstderr: %s" % (stdout, stderr))
+        raise e
+    return result["pubkey"]
+
+
+def fetch_pubkeys(site):
+    """Returns a dict with the public host key of the site of every type in SiteKey.ALGORITHMS, without using the
+    database. The keys of all types are requested at the same time."""
+    keytypes = sorted(SiteKey.ALGORITHMS)
+    pool = ThreadPool(len(keytypes))
+    try:
+        return dict(zip(keytypes, pool.map(lambda keytype: fetch_pubkey(site, keytype), keytypes)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def publish_keys(site, pubkeys):
+    """Creates the SiteKeys of the site missing from the public keys given and sends the SSHFP records missing or
+    stale for all the hostnames of the site to ip-register, with an IPRegBatch"""
+    existing = set(site.keys.values_list('type', flat=True))
+    new_keys = []
+    for keytype, public_key in sorted(pubkeys.items()):
+        pubkey = SSHPubKey(public_key)
+        if keytype not in existing:
+            new_keys.append(SiteKey(site=site, type=keytype, public_key=public_key,
+                                    fingerprint=pubkey.hash_md5(), fingerprint2=pubkey.hash_sha256()))
+    try:
+        with transaction.atomic():
+            SiteKey.objects.bulk_create(new_keys)
+    except IntegrityError:
+        # Some of them were created by a concurrent call
+        for key in new_keys:
+            SiteKey.objects.get_or_create(site=site, type=key.type, defaults={
+                'public_key': key.public_key, 'fingerprint': key.fingerprint, 'fingerprint2': key.fingerprint2})
+
+    try:
+        sshfp_records = reconcile_sshfp(site)
+    except Exception as e:
+        LOGGER.error("Error while trying to set up sshfp records. \nexception: %s" % (str(e.__class__)+" "+str(e)))
+        return
+    for call, e in sshfp_records.errors():
+        LOGGER.error("Error while trying to set up sshfp records. \ncall: %s\nexception: %s"
+                     % (" ".join(call), str(e.__class__)+" "+str(e)))
+
+
 def secrets_prealocation_vm(vm):
     # Gets all the keys generated for the site and generates the fingerprint and the SSHFP from them
-    # It sends the SSHFP record to ip-register
-    service = vm.service
+    # It sends the SSHFP records to ip-register for all the hostnames of the site
+    site = vm.service.site
+    publish_keys(site, fetch_pubkeys(site))
 
-    for keytype in SiteKey.ALGORITHMS:
-        p = subprocess.Popen(["userv", "mws-admin", "mws_pubkey"], stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate(json.dumps({"id": "mwssite-%d" % service.site.id,
-                                                   "keytype": "ssh"+keytype.lower()}))
-        try:
-            result = json.loads(stdout)
-        except ValueError as e:
-            LOGGER.error("mws_pubkey response is not properly formated:\nstdout: %s\nstderr: %s" % (stdout, stderr))
-            raise e
-
-        pubkey = SSHPubKey(result["pubkey"])
-
-        SiteKey.objects.get_or_create(site=service.site, type=keytype, 
-                                      defaults={
-                                          'public_key': result["pubkey"], 
-                                          'fingerprint': pubkey.hash_md5(),
-                                          'fingerprint2': pubkey.hash_sha256()
-                                      })
-
-        for fptype in SiteKey.FP_TYPES:
-            if not fptype == "SHA1":
-                try:
-                    if fptype == "SHA256":
-                        fp = pubkey.sshfp_sha256()
-                    else:
-                        raise Exception("fptype %s is not supported" % fptype)
-                    set_sshfp(service.network_configuration.name, SiteKey.ALGORITHMS[keytype],
-                              SiteKey.FP_TYPES[fptype], fp)
-                    set_sshfp(service.site.test_service.network_configuration.name, SiteKey.ALGORITHMS[keytype],
-                              SiteKey.FP_TYPES[fptype], fp)
-                    set_sshfp(vm.network_configuration.name, SiteKey.ALGORITHMS[keytype], SiteKey.FP_TYPES[fptype],
-                              fp)
-                except Exception as e:
-                    LOGGER.error("Error while trying to set up sshfp records. \nkeytype: %s\nfptype: %s\nexception: %s"
-                                 % (keytype, fptype, str(e.__class__)+" "+str(e)))
-                    pass
 
+class Provisioning(object):
+    """
+    The provisioning of a VM of a service as a sequence of stages, each of them timed and recorded as a
+    ProvisioningStage once the provisioning finishes:
 
-@shared_task(base=XenWithFailure)
-def new_site_primary_vm(service, host_network_configuration=None):
-    parameters = {}
-    parameters["site-id"] = "mwssite-%d" % service.site.id
-    parameters["os"] = getattr(settings, 'OS_VERSION', "stretch")
-
-    if host_network_configuration:
-        netconf = {}
-        if host_network_configuration.IPv4:
-            netconf["IPv4"] = host_network_configuration.IPv4
-        if host_network_configuration.IPv6:
-            netconf["IPv6"] = host_network_configuration.IPv6
-        if host_network_configuration.name:
-            netconf["hostname"] = host_network_configuration.name
-        vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
-                                           network_configuration=host_network_configuration, cluster=which_cluster())
-    else:
-        raise AttributeError("No host network configuration")
+    with Provisioning('new', service) as provisioning:
+        vm = provisioning.run('network', allocate_vm, service, netconf)
+        pubkeys = provisioning.background('keys', fetch_pubkeys, service.site)
+        provisioning.run('create', create_vm, vm, post_installation)
+        provisioning.run('sshfp', publish_keys, service.site, pubkeys.get())
 
-    parameters["features"] = {
-        "cpu": vm.numcpu,
-        "ram": vm.sizeram*1024,
-        "disk": service.site.type.sizedisk,
-    }
+    Stages started with background() run in a thread of their own, at the same time as the stages that follow, and
+    must not use the database. Their result, or their exception, is returned by get() on the object returned.
+    """
 
-    parameters["netconf"] = netconf
-    parameters["callback"] = {
-        "endpoint": "%s%s" % (settings.MAIN_DOMAIN, reverse(post_installation)),
-        "vm_id": vm.id,
-        "secret": str(vm.token),
-    }
+    def __init__(self, pipeline, service):
+        self.pipeline = pipeline
+        self.service = service
+        self.stages = []
+        self.pool = None
 
-    service.status = 'installing'
-    service.save()
+    def __enter__(self):
+        self.started = timezone.now()
+        self.start = time.time()
+        return self
 
-    response = vm_api_request(command='create', parameters=parameters, vm=vm)
+    def timed(self, stage, function, *args):
+        started = timezone.now()
+        start = time.time()
+        try:
+            result = function(*args)
+        except Exception:
+            self.stages.append((stage, started, time.time() - start, 'failure'))
+            raise
+        self.stages.append((stage, started, time.time() - start, 'success'))
+        return result
+
+    def run(self, stage, function, *args):
+        """Runs the stage and returns the result of function(*args)"""
+        return self.timed(stage, function, *args)
+
+    def background(self, stage, function, *args):
+        """Starts the stage in a thread and returns its AsyncResult"""
+        if self.pool is None:
+            self.pool = ThreadPool(getattr(settings, 'VM_PROVISIONING_THREADS', 4))
+        return self.pool.apply_async(self.timed, (stage, function) + args)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Background stages are waited for even if a stage failed, so that they get recorded
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self.stages.append(('total', self.started, time.time() - self.start,
+                            'failure' if exc_type else 'success'))
+        ProvisioningStage.objects.bulk_create([
+            ProvisioningStage(service=self.service, pipeline=self.pipeline, stage=stage, started=started,
+                              duration=duration, outcome=outcome)
+            for stage, started, duration, outcome in self.stages])
+        LOGGER.info("Provisioning (%s) of the %s service of the site %s: %s", self.pipeline, self.service.type,
+                    self.service.site_id, ", ".join("%s %.2fs %s" % (stage, duration, outcome)
+                                                    for stage, started, duration, outcome in self.stages))
+        return False
 
-    try:
-        jresponse = json.loads(response)
-    except ValueError as e:
-        LOGGER.error("VM API response is not properly formated: %s", response)
-        vm.name = vm.network_configuration.name
-        vm.save()
-        raise e
 
-    try:
-        if 'vmid' in jresponse:
-            vm.name = jresponse['vmid']
-        else:
-            vm.name = vm.network_configuration.name
-    except Exception as e:
-        vm.name = vm.network_configuration.name
-    vm.save()
-    from apimws.models import AnsibleConfiguration
-    AnsibleConfiguration.objects.update_or_create(service=service, key='os',
-                                                  defaults={'value': getattr(settings,
-                                                                             "OS_VERSION", "stretch")})
+def provisioning_metrics():
+    """The number of runs, failures, and average and maximum duration of every stage of each pipeline, as dicts"""
+    return list(ProvisioningStage.objects.order_by().values('pipeline', 'stage').annotate(
+        runs=Count('id'), failures=Count(Case(When(outcome='failure', then=1))), average=Avg('duration'),
+        maximum=Max('duration')).order_by('pipeline', 'stage'))
 
-    # Create a default Vhost and associate the service name
-    default_vhost = Vhost.objects.create(service=service, name="default")
-    service_domain = DomainName.objects.create(name=default_vhost.service.network_configuration.name,
-                                               status="accepted", vhost=default_vhost)
-    default_vhost.main_domain = service_domain
-    default_vhost.save()
-    secrets_prealocation_vm(vm)
+
+def allocate_vm(service, network_configuration=None):
+    """Creates the VirtualMachine of the service with the host network configuration given, a free one by default,
+    in the cluster chosen by apimws.placement"""
+    if network_configuration is None:
+        network_configuration = NetworkConfig.get_free_host_config()
+    if not network_configuration:
+        raise AttributeError("No host network configuration")
+    vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
+                                       network_configuration=network_configuration,
+                                       cluster=which_cluster(service))
+    service.status = 'installing'
+    service.save()
+    return vm
 
 
-def recreate_vm(vm_id):
-    vm = VirtualMachine.objects.get(pk=vm_id)
+def create_vm(vm, callback, os=None):
+    """
+    Sends the VM API create request of the VM, which calls the callback view once the VM is installed, and names the
+    VM after the response.
+    """
     service = vm.service
     network_configuration = vm.network_configuration
-    parameters = {}
-    parameters["site-id"] = "mwssite-%d" % service.site.id
     netconf = {}
     if network_configuration.IPv4:
         netconf["IPv4"] = network_configuration.IPv4
@@ -181,26 +244,23 @@ def recreate_vm(vm_id):
         netconf["IPv6"] = network_configuration.IPv6
     if network_configuration.name:
         netconf["hostname"] = network_configuration.name
-    os = vm.service.ansible_configuration.filter(key='os')
+
+    parameters = {}
+    parameters["site-id"] = "mwssite-%d" % service.site.id
     if os:
-        parameters["os"] = os[0].value
+        parameters["os"] = os
     parameters["netconf"] = netconf
-
     parameters["features"] = {
         "cpu": vm.numcpu,
         "ram": vm.sizeram*1024,
         "disk": service.site.type.sizedisk,
     }
-
     parameters["callback"] = {
-        "endpoint": "%s%s" % (settings.MAIN_DOMAIN, reverse(post_recreate)),
+        "endpoint": "%s%s" % (settings.MAIN_DOMAIN, reverse(callback)),
         "vm_id": vm.id,
         "secret": str(vm.token),
     }
 
-    service.status = 'installing'
-    service.save()
-
     response = vm_api_request(command='create', parameters=parameters, vm=vm)
 
     try:
@@ -221,31 +281,86 @@ def recreate_vm(vm_id):
     vm.save()
 
 
+def create_new_vm(vm, callback):
+    """Creates the VM with the OS_VERSION, which is recorded in the Ansible configuration of its service"""
+    os = getattr(settings, 'OS_VERSION', "stretch")
+    create_vm(vm, callback, os)
+    AnsibleConfiguration.objects.update_or_create(service=vm.service, key='os', defaults={'value': os})
+
+
+def create_default_vhost(service):
+    """Creates a default Vhost whose main domain is the service name"""
+    default_vhost = Vhost.objects.create(service=service, name="default")
+    service_domain = DomainName.objects.create(name=default_vhost.service.network_configuration.name,
+                                               status="accepted", vhost=default_vhost)
+    default_vhost.main_domain = service_domain
+    default_vhost.save()
+
+
+def copy_php_libs(site):
+    """Installs the PHP libraries of the production service in the test service"""
+    for phplib in site.production_service.php_libs.all():
+        phplib.services.add(site.test_service)
+
+
+def launch_ansible_services(*services):
+    """Calls Ansible to update the state of the VMs of the services"""
+    for service in services:
+        launch_ansible(service)
+
+
+@shared_task(base=XenWithFailure)
+def new_site_primary_vm(service, host_network_configuration=None, vm=None):
+    # The VM is given if it was already allocated, by apimws.warmpool.refill
+    if not host_network_configuration and vm is None:
+        raise AttributeError("No host network configuration")
+    site = service.site
+    with Provisioning('new', service) as provisioning:
+        if vm is None:
+            vm = provisioning.run('network', allocate_vm, service, host_network_configuration)
+        # The host keys are fetched while the VM is being created
+        pubkeys = provisioning.background('keys', fetch_pubkeys, site)
+        provisioning.run('create', create_new_vm, vm, post_installation)
+        provisioning.run('default vhost', create_default_vhost, service)
+        provisioning.run('sshfp', publish_keys, site, pubkeys.get())
+
+
+def recreate_vm(vm_id):
+    vm = VirtualMachine.objects.get(pk=vm_id)
+    service = vm.service
+    with Provisioning('recreate', service) as provisioning:
+        # The VM keeps its network configuration, its keys and its SSHFP records
+        os = service.ansible_configuration.filter(key='os').first()
+        service.status = 'installing'
+        service.save()
+        provisioning.run('create', create_vm, vm, post_recreate, os.value if os else None)
+
+
+def vm_power_lock(vm_id):
+    """The lock held while a button of the VM is pressed, so that the same button is not pressed twice at once"""
+    return task_lock("vm-%d-power" % vm_id)
+
+
 @shared_task(base=XenWithFailure)
 def change_vm_power_state(vm_id, on):
     if on != 'on' and on != 'off':
         raise VMAPIInputException("passed wrong parameter power %s" % on)
     vm = VirtualMachine.objects.get(pk=vm_id)
-    lock = filter(lambda x: x and x['name'] == u'apimws.xen.change_vm_power_state' and
-                            x['args'] == u"(%s, '%s')" % (vm_id, on),
-                  [item for sublist in app.control.inspect().active().values() for item in sublist])
-    if len(lock) == 1:
+    with vm_power_lock(vm_id) as acquired:
+        if not acquired:
+            return False
         vm_api_request(command='button', parameters={"action": "power%s" % on, "vmid": vm.name}, vm=vm)
         return True
-    else:
-        return False
 
 
 @shared_task(base=XenWithFailure)
 def reset_vm(vm_id):
-    lock = filter(lambda x: x and x['name'] == u'apimws.xen.reset_vm' and x['args'] == u'(%s,)' % vm_id,
-                  [item for sublist in app.control.inspect().active().values() for item in sublist])
-    if len(lock) == 1:
+    with vm_power_lock(vm_id) as acquired:
+        if not acquired:
+            return False
         vm = VirtualMachine.objects.get(pk=vm_id)
         vm_api_request(command='button', vm=vm, parameters={"action": "reboot", "vmid": vm.name})
         return True
-    else:
-        return False
 
 
 @shared_task(base=XenWithFailure)
@@ -258,77 +373,13 @@ def destroy_vm(vm_id):
 @shared_task(base=XenWithFailure)
 def clone_vm_api_call(site):
     service = site.test_service
-    host_network_configuration = NetworkConfig.get_free_host_config()
-    parameters = {}
-    parameters["site-id"] = "mwssite-%d" % service.site.id
-    parameters["os"] = getattr(settings, 'OS_VERSION', "stretch")
-
-    if host_network_configuration:
-        netconf = {}
-        if host_network_configuration.IPv4:
-            netconf["IPv4"] = host_network_configuration.IPv4
-        if host_network_configuration.IPv6:
-            netconf["IPv6"] = host_network_configuration.IPv6
-        if host_network_configuration.name:
-            netconf["hostname"] = host_network_configuration.name
-        vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
-                                           network_configuration=host_network_configuration, cluster=which_cluster())
-    else:
-        raise AttributeError("No host network configuration")
-
-    parameters["features"] = {
-        "cpu": vm.numcpu,
-        "ram": vm.sizeram*1024,
-        "disk": service.site.type.sizedisk,
-    }
-
-    parameters["netconf"] = netconf
-    parameters["callback"] = {
-        "endpoint": "%s%s" % (settings.MAIN_DOMAIN, reverse(post_installation)),
-        "vm_id": vm.id,
-        "secret": str(vm.token),
-    }
-
-    service.status = 'installing'
-    service.save()
-
-    response = vm_api_request(command='create', parameters=parameters, vm=vm)
-
-    try:
-        jresponse = json.loads(response)
-    except ValueError as e:
-        LOGGER.error("VM API response is not properly formated: %s", response)
-        vm.name = vm.network_configuration.name
-        vm.save()
-        raise e
-
-    try:
-        if 'vmid' in jresponse:
-            vm.name = jresponse['vmid']
-        else:
-            vm.name = vm.network_configuration.name
-    except Exception as e:
-        vm.name = vm.network_configuration.name
-    vm.save()
-    from apimws.models import AnsibleConfiguration
-    AnsibleConfiguration.objects.update_or_create(service=service, key='os',
-                                                  defaults={'value': getattr(settings,
-                                                                             "OS_VERSION", "stretch")})
-    secrets_prealocation_vm(vm)
-
-    # PHPLibs
-    for phplib in site.production_service.php_libs.all():
-        phplib.services.add(site.test_service)
-
-    # Call Ansible to update the state of the machine
-    launch_ansible(site.production_service)
-    launch_ansible(site.test_service)
+    with Provisioning('clone', service) as provisioning:
+        vm = provisioning.run('network', allocate_vm, service)
+        # The host keys are fetched while the VM is being created
+        pubkeys = provisioning.background('keys', fetch_pubkeys, site)
+        provisioning.run('create', create_new_vm, vm, post_installation)
+        provisioning.run('php libs', copy_php_libs, site)
+        provisioning.run('sshfp', publish_keys, site, pubkeys.get())
+        provisioning.run('ansible', launch_ansible_services, site.production_service, site.test_service)
 
     return True
-
-
-def which_cluster():
-    """This function decides which cluster to use when creating a new VM based on how busy each cluster is.
-    At present we only have one cluster, so the decision algorithm is pretty obvious. Returns a Cluster object.
-    """
-    return Cluster.objects.first()
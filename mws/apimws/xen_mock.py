@@ -13,7 +13,7 @@ from celery import shared_task, Task
 from django.conf import settings
 from django.urls import reverse
 
-from apimws.models import Cluster
+from apimws.placement import which_cluster
 from apimws.views import post_installation
 from libs.sshpubkey import SSHPubKey
 from sitesmanagement.models import NetworkConfig, VirtualMachine, SiteKey, Vhost, DomainName
@@ -47,24 +47,37 @@ def secrets_prealocation_vm(vm):
                                       public_key=uuid.uuid4(), fingerprint=uuid.uuid4(), fingerprint2=uuid.uuid4())
 
 
+def allocate_vm(service, network_configuration=None):
+    if network_configuration is None:
+        network_configuration = NetworkConfig.get_free_host_config()
+    if not network_configuration:
+        raise AttributeError("No host network configuration")
+    vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
+                                       network_configuration=network_configuration,
+                                       cluster=which_cluster(service))
+    service.status = 'installing'
+    service.save()
+    return vm
+
+
 @shared_task(base=XenWithFailure)
-def new_site_primary_vm(service, host_network_configuration=None):
+def new_site_primary_vm(service, host_network_configuration=None, vm=None):
     parameters = {}
     parameters["site-id"] = "mwssite-%d" % service.site.id
     parameters["os"] = getattr(settings, 'OS_VERSION', "jessie")
 
-    if host_network_configuration:
-        netconf = {}
-        if host_network_configuration.IPv4:
-            netconf["IPv4"] = host_network_configuration.IPv4
-        if host_network_configuration.IPv6:
-            netconf["IPv6"] = host_network_configuration.IPv6
-        if host_network_configuration.name:
-            netconf["hostname"] = host_network_configuration.name
-        vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
-                                           network_configuration=host_network_configuration, cluster=which_cluster())
-    else:
+    if vm is None and host_network_configuration:
+        vm = allocate_vm(service, host_network_configuration)
+    elif vm is None:
         raise AttributeError("No host network configuration")
+    host_network_configuration = vm.network_configuration
+    netconf = {}
+    if host_network_configuration.IPv4:
+        netconf["IPv4"] = host_network_configuration.IPv4
+    if host_network_configuration.IPv6:
+        netconf["IPv6"] = host_network_configuration.IPv6
+    if host_network_configuration.name:
+        netconf["hostname"] = host_network_configuration.name
 
     parameters["features"] = {
         "cpu": vm.numcpu,
@@ -122,7 +135,8 @@ def clone_vm_api_call(site):
         if host_network_configuration.name:
             netconf["hostname"] = host_network_configuration.name
         vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
-                                           network_configuration=host_network_configuration, cluster=which_cluster())
+                                           network_configuration=host_network_configuration,
+                                           cluster=which_cluster(service))
     else:
         raise AttributeError("No host network configuration")
 
@@ -151,12 +165,6 @@ def clone_vm_api_call(site):
     return True
 
 
-def which_cluster():
-    """This function decides which cluster to use when creating a new VM based on how busy each cluster is.
-    At present we only have one cluster, so the decision algorithm is pretty obvious. Returns a Cluster object.
-    """
-    return Cluster.objects.first()
-
 @shared_task(base=XenWithFailure)
 def destroy_vm(vm_id):
     return True
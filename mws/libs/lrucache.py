@@ -0,0 +1,63 @@
+"""
+A thread safe cache of a bounded number of entries with a time to live each, evicting the least recently used
+entry when full.
+
+cache = LRUCache(1000)
+cache.set('key', 'value', 60)
+cache.get('key')  # 'value' for 60 seconds, None afterwards
+print(cache.hits, cache.misses)
+
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    def __init__(self, maxsize, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Returns the value stored for key if it has not expired yet, default otherwise"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= self.clock():
+                self.misses += 1
+                return default
+            # Move it to the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        """Stores value for key during ttl seconds, evicting the least recently used entry if the cache is full"""
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            while len(self.entries) >= self.maxsize:
+                self.entries.popitem(last=False)
+            self.entries[key] = (value, self.clock() + ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+    def __len__(self):
+        return len(self.entries)
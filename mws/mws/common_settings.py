@@ -161,9 +161,64 @@ NEXT_OS = 'stretch'
 
 FINANCE_EMAIL = 'finance@uis.cam.ac.uk'
 
+# Maximum number of per-VM Ansible commands run at the same time for a service
+ANSIBLE_MAX_CONCURRENT_RUNS = 4
+# Command used by the ansible_rollout command and task to run the MWS playbook against a batch of hosts. It is
+# called with --limit <comma separated hostnames> --forks <n> and must print the output of the json stdout callback
+ANSIBLE_BATCH_COMMAND = ['userv', 'mws-admin', 'mws_ansible_batch']
+ANSIBLE_ROLLOUT_BATCH_SIZE = 50
+ANSIBLE_ROLLOUT_FORKS = 20
+# Seconds an Ansible run waits after being requested so that the changes made meanwhile are applied by the same run
+ANSIBLE_RUN_DEBOUNCE = 10
+# Number of times a failed Ansible run is retried before waiting for the next change
+ANSIBLE_RUN_MAX_RETRIES = 2
+# Seconds after which a queued or running Ansible run is assumed lost and a new one can be started
+ANSIBLE_RUN_TIMEOUT = 3*60*60
+# Token the Ansible controller must pass in the X-MWS-Inventory-Token header to the api/inventory/host/ endpoint, which
+# is disabled when it is not set
+ANSIBLE_INVENTORY_TOKEN = None
+
+# How apimws.placement chooses the cluster of new VMs among those with capacity left: 'spread' (the least loaded),
+# 'binpack' (the most loaded) or the import path of a function of the candidate clusters and the VM needs
+VM_PLACEMENT_STRATEGY = 'spread'
+# Consecutive failed VM API requests after which a host gets no requests for VM_API_CIRCUIT_COOLDOWN seconds, the
+# number of hosts an idempotent request is tried on and the weight of the last request in the latency average
+VM_API_CIRCUIT_THRESHOLD = 3
+VM_API_CIRCUIT_COOLDOWN = 5*60
+VM_API_MAX_ATTEMPTS = 3
+VM_API_LATENCY_ALPHA = 0.3
+# Threads in which the stages of the provisioning of a VM that do not depend on each other run (apimws.xen.Provisioning)
+VM_PROVISIONING_THREADS = 4
+# Days the nightly backup results (sitesmanagement.models.BackupRun) are kept for
+BACKUP_HISTORY_DAYS = 90
+# Seconds after which a lock of apimws.locks is assumed to have been lost by its owner and can be taken over
+TASK_LOCK_TTL = 10*60
+# Maximum number of VMs of preallocated sites installed at the same time when refilling the warm pool (apimws.warmpool)
+WARM_POOL_CONCURRENCY = 4
+# Number of seconds after which the installation of a preallocated site is considered hung, and is no longer counted
+# in the warm pool
+WARM_POOL_BUILD_TIMEOUT = 2*60*60
+
 CELERY_IMPORTS = ('apimws.xen', 'apimws.utils', 'apimws.jackdaw', 'apimws.ansible',
-                  'sitesmanagement.cronjobs', 'apimws.ipreg')
+                  'sitesmanagement.cronjobs', 'apimws.ipreg', 'apimws.sshfp')
 IP_REG_API_END_POINT = ['userv', 'mws-admin', 'mws_ipreg']
+# Whether the ip-register API endpoint supports the batch call, used by apimws.ipreg.IPRegBatch to make several
+# calls with a single invocation. If it does not, they are made one after the other. The mws_ipreg endpoint does not
+# support it yet, only apimws/tests/fake_ipreg.py does, so leave it unset until it does.
+IP_REG_API_BATCH = False
+# Number of responses to ip-register API get calls cached by each process, and for how many seconds. Changes made
+# through the API by the process forget the responses about the hostnames changed.
+IP_REG_CACHE_SIZE = 1000
+IP_REG_CACHE_TTL = 60
+# Number of seconds each process keeps the JSON served by the bes API. Changes to the sites made by the process
+# forget it.
+BES_CACHE_TTL = 60
+# Number of days the entries of the change journal of the bes API are kept. Cursors older than that are refused and
+# the full JSON has to be downloaded again.
+BES_JOURNAL_DAYS = 14
+# Number of seconds the entries of the change journal wait before being served, longer than any transaction writing
+# them may take to be committed
+BES_JOURNAL_SETTLE = 10
 
 # Maximum length of time which a domain can remain unapproved.
 MWS_DOMAIN_NAME_GRACE_DAYS = 30
@@ -193,6 +248,25 @@ MWS_RESOLVERS = [
 for resolver in MWS_RESOLVERS:
     resolver['RESOLVER'].nameservers = resolver['SERVERS']
 
+# Number of concurrent queries and timeout in seconds per query of each resolver when validating the domain names,
+# unless set in its CONCURRENCY and TIMEOUT keys
+MWS_DNS_CONCURRENCY = 20
+MWS_DNS_TIMEOUT = 5
+
+# Number of answers of the resolvers cached by each process, the maximum number of seconds an answer is cached for,
+# even if its TTL is longer, and the number of seconds nonexistent names and records are cached for
+MWS_DNS_CACHE_SIZE = 10000
+MWS_DNS_CACHE_MAX_TTL = 3600
+MWS_DNS_NEGATIVE_TTL = 300
+
+# Seconds between the validations of a domain name, doubling from the minimum up to the maximum while its status
+# does not change, and the maximum number of domain names validated by each (hourly) run of validate_domains and
+# how many of them are validated at a time
+MWS_DOMAIN_CHECK_MIN_INTERVAL = 60*60
+MWS_DOMAIN_CHECK_MAX_INTERVAL = 7*24*60*60
+MWS_DOMAIN_CHECK_BATCH = 2000
+MWS_DOMAIN_CHECK_CHUNK = 500
+
 # IP addresses of hosts we want to allow to proxy for the MWS
 MWS_ALLOWED_PROXIES = [
     # doitpoms.admin.cam.ac.uk
@@ -70,7 +70,7 @@ CELERYBEAT_SCHEDULE = {
     },
     'check_num_preallocated_sites': {
         'task': 'sitesmanagement.cronjobs.check_num_preallocated_sites',
-        'schedule': crontab(hour=3, minute=25),
+        'schedule': crontab(minute='*/15'),
         'args': ()
     },
     'send_warning_last_or_none_admin': {
@@ -85,7 +85,7 @@ CELERYBEAT_SCHEDULE = {
     },
     'validate_domains': {
         'task': 'sitesmanagement.cronjobs.validate_domains',
-        'schedule': crontab(hour=0, minute=55),
+        'schedule': crontab(minute=55),
         'args': ()
     },
     'expire_domains': {
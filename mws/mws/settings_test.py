@@ -60,7 +60,7 @@ CELERYBEAT_SCHEDULE = {
     },
     'validate_domains': {
         'task': 'sitesmanagement.cronjobs.validate_domains',
-        'schedule': crontab(hour=0, minute=55),
+        'schedule': crontab(minute=55),
         'args': ()
     },
     'expire_domains': {
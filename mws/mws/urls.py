@@ -86,6 +86,8 @@ urlpatterns = [
     url(r'^confirm_email/(?P<ec_id>[0-9]+)/(?P<token>(\w|\-)+)/$', apimws.views.confirm_email, name='apimws.views.confirm_email'),
     url(r'^api/post_installation/$', apimws.views.post_installation, name='apimws.views.post_installation'),
     url(r'^api/post_recreate/$', apimws.views.post_recreate, name='apimws.views.post_recreate'),
+    url(r'^api/inventory/host/(?P<hostname>[^/]+)/$', apimws.views.inventory_host,
+        name='apimws.views.inventory_host'),
     url(r'^api/resend_email_confirmation/(?P<site_id>[0-9]+)/$', apimws.views.resend_email_confirmation_view, name='apimws.views.resend_email_confirmation_view'),
 
     # test os updates
@@ -111,6 +113,7 @@ urlpatterns = [
     # Admin
     url(r'^searchadmin/$', sitesmanagement.views.admin_search, name='searchadmin'),
     url(r'^adminemailist/$', sitesmanagement.views.others.admin_email_list, name='adminemailist'),
+    url(r'^adminbackups/$', sitesmanagement.views.backup_trends, name='adminbackups'),
 
     # Stats
     url(r'^stats/$', apimws.views.stats, name='stats'),
@@ -218,15 +218,16 @@ class AuthTestCases(TestCase):
         self.assertEqual(len(site_with_auth_users.groups.all()), 0)
         with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
             mock_subprocess.check_output.return_value.returncode = 0
-            response = self.client.post(reverse(views.auth_change, kwargs={'site_id': site_with_auth_users.id}), {
-                'users_crsids': "amc203",
-                'groupids': "101888"
-                # we authorise amc203 user and 101888 group
-            })
-            mock_subprocess.check_output.assert_called_with([
-                "userv", "mws-admin", "mws_ansible_host",
-                site_with_auth_users.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            with mock.patch("sitesmanagement.models.get_users_of_a_group") as mock_get_users_of_a_group:
+                mock_get_users_of_a_group.return_value = [amc203_user]
+                response = self.client.post(reverse(views.auth_change, kwargs={'site_id': site_with_auth_users.id}), {
+                    'users_crsids': "amc203",
+                    'groupids': "101888"
+                    # we authorise amc203 user and 101888 group
+                })
+            # amc203 was already authorised and is the only member of the group, so the users of the server have
+            # not changed and Ansible is not run
+            mock_subprocess.check_output.assert_not_called()
         self.assertRedirects(response, expected_url=site_with_auth_users.get_absolute_url())
         self.assertEqual(len(site_with_auth_users.users.all()), 1)
         self.assertEqual(site_with_auth_users.users.first(), amc203_user)
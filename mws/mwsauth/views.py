@@ -6,6 +6,7 @@ from django.http import HttpResponseForbidden
 from django.shortcuts import render, redirect
 from ucamlookup import validate_crsid_list, validate_groupid_list
 from apimws.ansible import launch_ansible_site, launch_ansible_by_user
+from apimws.inventory import invalidate_hostvars
 from mwsauth.models import MWSUser
 from mwsauth.utils import privileges_check, remove_supporter
 from sitesmanagement.views.sites import warning_messages
@@ -62,7 +63,9 @@ def force_update(request, site_id):
         return HttpResponseForbidden()
 
     if request.method == 'POST':
-        launch_ansible_site(site)  # to refresh lookup lists
+        # lookup group membership changes are not signalled, drop the cached hostvars built from them
+        invalidate_hostvars(vm__service__site=site)
+        launch_ansible_site(site, force=True)  # to refresh lookup lists
         # TODO add message to the user
 
     return redirect(site)
@@ -7,7 +7,8 @@ from django.template.response import TemplateResponse
 from django.utils.encoding import force_text
 from reversion.admin import VersionAdmin
 from .models import Site, Billing, DomainName, Suspension, VirtualMachine, EmailConfirmation, \
-    Vhost, UnixGroup, NetworkConfig, SiteKey, Service, Snapshot, ServerType
+    Vhost, UnixGroup, NetworkConfig, SiteKey, Service, Snapshot, ServerType, BackupRun, BackupResult
+from .backups import failing_streaks
 
 
 def recreate_vm(modeladmin, request, queryset):
@@ -60,7 +61,7 @@ recreate_vm.short_description = "Recreate VM"
 def execute_ansible(modeladmin, request, queryset):
     from apimws.ansible import launch_ansible
     for service in queryset:
-        launch_ansible(service)
+        launch_ansible(service, force=True)
 
 
 execute_ansible.short_description = "Launch Ansible"
@@ -170,18 +171,50 @@ class VirtualMachineAdmin(VersionAdmin):
     actions = [recreate_vm]
 
 
+class ServerTypeAdmin(ModelAdmin):
+    list_display = ('__unicode__', 'preallocated_low', 'preallocated', 'pool_refilling', 'pool_hits', 'pool_misses')
+    readonly_fields = ('pool_hits', 'pool_misses')
+
+
+class FailingStreakFilter(admin.SimpleListFilter):
+    title = 'failing streak'
+    parameter_name = 'streak'
+
+    def lookups(self, request, model_admin):
+        return [(str(nights), 'Failed the last %d nights' % nights) for nights in (2, 3, 7)]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(vm_name__in=failing_streaks(int(self.value())))
+        return queryset
+
+
+class BackupRunAdmin(ModelAdmin):
+    list_display = ('date', 'checked', 'ok', 'failed', 'missing', 'checked_at')
+    date_hierarchy = 'date'
+
+
+class BackupResultAdmin(ModelAdmin):
+    list_display = ('vm_name', 'date', 'status')
+    list_filter = (FailingStreakFilter, 'status', 'date')
+    search_fields = ('vm_name', )
+    raw_id_fields = ('run', 'vm')
+
+
 class EmailConfirmationAdmin(ModelAdmin):
     list_display = ('email', 'site', 'status')
 
 
 admin.site.register(Site, SiteAdmin)
-admin.site.register(ServerType, ModelAdmin)
+admin.site.register(ServerType, ServerTypeAdmin)
 admin.site.register(Billing, BillingAdmin)
 admin.site.register(Vhost, VhostAdmin)
 admin.site.register(DomainName, DomainNameAdmin)
 admin.site.register(Suspension, SuspensionAdmin)
 admin.site.register(VirtualMachine, VirtualMachineAdmin)
 admin.site.register(EmailConfirmation, EmailConfirmationAdmin)
+admin.site.register(BackupRun, BackupRunAdmin)
+admin.site.register(BackupResult, BackupResultAdmin)
 admin.site.register(UnixGroup, VersionAdmin)
 admin.site.register(NetworkConfig, NetworkConfigAdmin)
 admin.site.register(Service, ServiceAdmin)
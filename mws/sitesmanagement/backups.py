@@ -0,0 +1,143 @@
+'''Reconciliation of the result of the nightly backups (mws_check_backups) with the VMs that should be backed up'''
+import json
+from bisect import bisect_left
+from datetime import date, timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, Q, When
+from sitesmanagement.models import BackupResult, BackupRun, VirtualMachine
+
+
+# Statuses of a BackupResult counted as failures by the trend queries
+FAILING = ('failed', 'missing')
+
+
+class HostIndex(object):
+    """The hostnames of a backup result, sorted so that those starting with a prefix are found with a bisection"""
+
+    def __init__(self, hosts):
+        self.hosts = sorted(hosts)
+
+    def matches(self, prefix):
+        """The hosts that start with the prefix given"""
+        matches = []
+        for host in self.hosts[bisect_left(self.hosts, prefix):]:
+            if not host.startswith(prefix):
+                break
+            matches.append(host)
+        return matches
+
+
+class BackupReport(object):
+    """
+    The outcome of the backup of every VM checked, as a list of (vm id, vm name, status) in vms, where status is
+    'failed' if the backup of a host starting with the VM name failed, 'ok' if one was backed up and 'missing' if
+    there was no backup at all. failed_hosts are all the hosts whose backup failed, belonging to a VM or not.
+    """
+    STATUSES = ('ok', 'failed', 'missing')
+
+    def __init__(self, vms, failed_hosts):
+        self.vms = vms
+        self.failed_hosts = failed_hosts
+
+    def names(self, status):
+        return [name for vm_id, name, vm_status in self.vms if vm_status == status]
+
+    @property
+    def ok(self):
+        return self.names('ok')
+
+    @property
+    def failed(self):
+        return self.names('failed')
+
+    @property
+    def missing(self):
+        return self.names('missing')
+
+    def as_dict(self):
+        """The report as a dict that can be serialised as JSON"""
+        report = dict((status, self.names(status)) for status in self.STATUSES)
+        report['checked'] = len(self.vms)
+        report['failed_hosts'] = self.failed_hosts
+        return report
+
+
+def backup_report(result, vms):
+    """
+    Reconciles the result of mws_check_backups, a dict with the lists of hosts backed up ('ok') and whose backup
+    failed ('failed'), with the VMs given as (id, name) pairs. The hosts of a VM are those whose name starts with the
+    VM name.
+    """
+    ok = HostIndex(result['ok'])
+    failed = HostIndex(result['failed'])
+    statuses = []
+    for vm_id, name in vms:
+        if failed.matches(name):
+            status = 'failed'
+        elif ok.matches(name):
+            status = 'ok'
+        else:
+            status = 'missing'
+        statuses.append((vm_id, name, status))
+    return BackupReport(statuses, failed.hosts)
+
+
+def backed_up_vms(today=None):
+    """The (id, name) of the VMs of the live sites that should have been backed up last night"""
+    if today is None:
+        today = date.today()
+    return VirtualMachine.objects.filter(
+        Q(service__site__deleted=False, service__site__disabled=False,
+          service__site__start_date__lt=(today - timedelta(days=1)),
+          service__status__in=('ansible', 'ansible_queued', 'ready')) &
+        (Q(service__site__end_date__isnull=True) | Q(service__site__end_date__gt=today))
+    ).exclude(name=None).order_by('name').values_list('id', 'name')
+
+
+def store_report(report, day=None):
+    """Stores the report as the BackupRun of the day given (today by default), replacing the one stored before"""
+    if day is None:
+        day = date.today()
+    with transaction.atomic():
+        run, created = BackupRun.objects.update_or_create(date=day, defaults={
+            'checked': len(report.vms), 'ok': len(report.ok), 'failed': len(report.failed),
+            'missing': len(report.missing), 'failed_hosts': json.dumps(report.failed_hosts)})
+        if not created:
+            BackupResult.objects.filter(run=run).delete()
+        BackupResult.objects.bulk_create([BackupResult(run=run, vm_id=vm_id, vm_name=name, date=day, status=status)
+                                          for vm_id, name, status in report.vms], batch_size=1000)
+    return run
+
+
+def prune_history(today=None):
+    """Deletes the BackupRuns older than BACKUP_HISTORY_DAYS days, returns how many were deleted"""
+    if today is None:
+        today = date.today()
+    limit = today - timedelta(days=getattr(settings, 'BACKUP_HISTORY_DAYS', 90))
+    # The results are deleted first with a single query, without collecting them
+    BackupResult.objects.filter(date__lt=limit).delete()
+    return BackupRun.objects.filter(date__lt=limit).delete()[0]
+
+
+def failing_streaks(nights=3):
+    """The names of the VMs whose backup failed or was missing in each of the last nights runs, with a single query"""
+    last_runs = BackupRun.objects.order_by('-date').values('date')[:nights]
+    # Nights rather than results are counted, as VMs may share a name
+    return list(BackupResult.objects.filter(date__in=last_runs, status__in=FAILING).order_by().values('vm_name')
+                .annotate(nights=Count('date', distinct=True)).filter(nights=nights).order_by('vm_name')
+                .values_list('vm_name', flat=True))
+
+
+def failure_rates(days=30, today=None):
+    """
+    The number of runs and failures of the VMs whose backup failed or was missing in the last days, and the
+    fraction of runs that failed, most failures first, with a single query.
+    """
+    if today is None:
+        today = date.today()
+    rows = BackupResult.objects.filter(date__gt=today - timedelta(days=days)).order_by().values('vm_name').annotate(
+        runs=Count('date', distinct=True),
+        failures=Count(Case(When(status__in=FAILING, then='date')), distinct=True)).filter(failures__gt=0) \
+        .order_by('-failures', 'vm_name')
+    return [dict(row, rate=float(row['failures']) / row['runs']) for row in rows]
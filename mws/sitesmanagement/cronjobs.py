@@ -17,11 +17,13 @@ from django.db.models import F, Q
 from django.utils.timezone import now
 from django.core.urlresolvers import reverse
 
-from apimws.utils import preallocate_new_site
+from apimws import bes, warmpool
 from apimws.ansible import launch_ansible
 from apimws.models import QueueEntry
 from apimws.vm import clone_vm_api_call
-from sitesmanagement.models import Billing, Site, Service, VirtualMachine, DomainName, ServerType
+from sitesmanagement import backups, dnscache
+from sitesmanagement.models import Billing, Site, Service, DomainName
+from sitesmanagement.validation import validate_domain_names, due_domain_names
 
 
 LOGGER = logging.getLogger('mws')
@@ -188,17 +190,14 @@ def check_backups():
         LOGGER.error("An error happened when checking ook backups in ent.\n\n"
                      "Result is not in json format: %s\n", result)
         raise e
-    for failed_backup in result['failed']:
+    report = backups.backup_report(result, backups.backed_up_vms())
+    for failed_backup in report.failed_hosts:
         LOGGER.error("A backup for the host %s did not complete last night", failed_backup)
-
-    for vm in VirtualMachine.objects.filter(Q(service__site__deleted=False, service__site__disabled=False,
-                                              service__site__start_date__lt=(date.today() - timedelta(days=1)),
-                                              service__status__in=('ansible', 'ansible_queued', 'ready')) & (
-                                                Q(service__site__end_date__isnull=True) |
-                                                Q(service__site__end_date__gt=date.today()))
-                                            ):
-        if not filter(lambda host: host.startswith(vm.name), result['ok']+result['failed']):
-            LOGGER.error("A backup for the host %s did not complete last night", vm.name)
+    for vm_name in report.missing:
+        LOGGER.error("A backup for the host %s did not complete last night", vm_name)
+    backups.store_report(report)
+    backups.prune_history()
+    return report.as_dict()
 
 
 @shared_task(base=ScheduledTaskWithFailure)
@@ -218,20 +217,26 @@ def delete_cancelled():
         LOGGER.info("The Site %s has been deleted because it was cancelled more than 8 weeks ago" % site.name)
     sites_cancelled.delete()
 
+    # The sites cancelled today are no longer backed up, which no signal tells the bes API change feed
+    bes.record_cancellations()
+    bes.prune_journal()
+
 
 @shared_task(base=ScheduledTaskWithFailure)
 def check_num_preallocated_sites():
     """
-    A :py:class:`~.ScheduledTaskWithFailure` which checks, for each
-    :py:class:`~sitesmanagement.models.ServerType` how many pre-allocated
-    :py:class:`~sitesmanagement.models.Site` instances there are. If that is
-    smaller than the number which should be pre-allocated, allocate a new one
-    via :py:func:`apimws.utils.preallocate_new_site`.
+    A :py:class:`~.ScheduledTaskWithFailure` which refills the warm pool of
+    pre-allocated :py:class:`~sitesmanagement.models.Site` instances of each
+    :py:class:`~sitesmanagement.models.ServerType` that has fewer than its low
+    watermark via :py:func:`apimws.warmpool.refill`. It also runs every time a
+    pre-allocated site is claimed, or could not be.
 
     """
-    for servertype in ServerType.objects.all():
-        if Site.objects.filter(preallocated=True, type=servertype).count() < servertype.preallocated:
-            preallocate_new_site(servertype=servertype)
+    reserved = warmpool.refill()
+    for metrics in warmpool.pool_metrics():
+        LOGGER.info("Warm pool of server type %(servertype)d: %(ready)d ready, %(building)d building, "
+                    "%(stuck)d stuck (watermarks %(low)d-%(high)d), %(hits)d hits, %(misses)d misses" % metrics)
+    return dict(reserved)
 
 
 @shared_task(base=ScheduledTaskWithFailure)
@@ -313,20 +318,29 @@ def reject_or_accepted_old_domain_names_requests():
                                    "%s days.") % (grace_days,))
         else:
             domain_name.accept_it()
+    from apimws.ipreg import read_cache_stats
+    LOGGER.info("ip-register API get calls: %(hits)d answered from the cache, %(misses)d made", read_cache_stats())
 
 @shared_task(base=ScheduledTaskWithFailure)
 def validate_domains():
     '''
-    Iterate over DomainName objects and set them to:
+    Iterate over the DomainName objects due to be validated and set them to:
      - global if they are visible to (currently) Google's nameservers
      - private if they are only available to the Cambridge nameservers
      - deleted if they are visible to none of the above.
     except for external and special domains which are set to deleted if invalid and not changed otherwise.
-    '''
-    active_states = ['accepted', 'private', 'global', 'external', 'special', 'deleted']
 
-    for domainname in DomainName.objects.filter(status__in=active_states):
-            domainname.validate(update=True)
+    Up to MWS_DOMAIN_CHECK_BATCH DomainNames are validated per run, MWS_DOMAIN_CHECK_CHUNK at a time, so that a
+    backlog of due names is spread over the next runs.
+    '''
+    due = due_domain_names(getattr(settings, 'MWS_DOMAIN_CHECK_BATCH', 2000))
+    chunk_size = getattr(settings, 'MWS_DOMAIN_CHECK_CHUNK', 500)
+    for i in range(0, len(due), chunk_size):
+        validate_domain_names(DomainName.objects.filter(id__in=due[i:i+chunk_size])
+                              .select_related('vhost__service__network_configuration'))
+    LOGGER.info("Validated %d domain names", len(due))
+    LOGGER.info("DNS cache after validating the domain names: %(hits)d hits, %(misses)d misses, %(size)d entries",
+                dnscache.stats())
 
 @shared_task(base=ScheduledTaskWithFailure)
 def expire_domains():
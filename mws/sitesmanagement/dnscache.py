@@ -0,0 +1,49 @@
+'''Process-wide cache of the answers of the MWS_RESOLVERS, shared by everything that validates DomainNames'''
+import time
+import dns.name
+import dns.resolver
+import dns.rdatatype
+from django.conf import settings
+from libs.lrucache import LRUCache
+
+
+CACHE = LRUCache(getattr(settings, 'MWS_DNS_CACHE_SIZE', 10000))
+
+# Failures cached as negative answers. Other errors, e.g. timeouts, are not cached.
+NEGATIVE_ANSWERS = (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)
+
+
+def query(scope, resolver, name, rdtype):
+    """
+    Returns the text of the rdtype records of name as resolved by resolver, the one of scope in MWS_RESOLVERS.
+    Answers are cached for their TTL, up to MWS_DNS_CACHE_MAX_TTL seconds, and NXDOMAIN and NoAnswer failures
+    for MWS_DNS_NEGATIVE_TTL seconds, in which case they are raised again from the cache.
+    """
+    name = dns.name.from_text(name)
+    key = (scope, name.to_text().lower(), rdtype)
+    cached = CACHE.get(key)
+    if cached is None:
+        try:
+            # An absolute name, as relative ones are looked up again with the domain of the resolver appended
+            answer = resolver.query(name, rdtype)
+        except NEGATIVE_ANSWERS as e:
+            CACHE.set(key, (type(e), None), getattr(settings, 'MWS_DNS_NEGATIVE_TTL', 300))
+            raise
+        cached = (None, [record.to_text() for record in answer.rrset.items
+                         if record.rdtype == dns.rdatatype.from_text(rdtype)])
+        # The expiration of the answer is that of the record with the lowest TTL of the CNAME chain followed
+        CACHE.set(key, cached, min(answer.expiration - time.time(), getattr(settings, 'MWS_DNS_CACHE_MAX_TTL', 3600)))
+    error, records = cached
+    if error is not None:
+        raise error()
+    return records
+
+
+def resolver_scope(resolver):
+    """The cache scope of a resolver which is not one of MWS_RESOLVERS: its nameservers"""
+    return tuple(resolver.nameservers), resolver.port
+
+
+def stats():
+    """The number of hits and misses and the number of entries of the cache"""
+    return CACHE.stats()
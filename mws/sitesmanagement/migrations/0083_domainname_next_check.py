@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0082_site_migrated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='domainname',
+            name='next_check',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='domainname',
+            name='stability',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 21:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0083_domainname_next_check'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servertype',
+            name='pool_hits',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='servertype',
+            name='pool_misses',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='servertype',
+            name='pool_refilling',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='servertype',
+            name='preallocated_low',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0084_servertype_warm_pool'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vm_name', models.CharField(max_length=250)),
+                ('date', models.DateField()),
+                ('status', models.CharField(choices=[(b'ok', b'Backed up'), (b'failed', b'Failed'), (b'missing', b'Missing')], max_length=10)),
+            ],
+            options={
+                'ordering': ['-date', 'vm_name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='BackupRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('checked_at', models.DateTimeField(auto_now=True)),
+                ('checked', models.PositiveIntegerField(default=0)),
+                ('ok', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('missing', models.PositiveIntegerField(default=0)),
+                ('failed_hosts', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.AddField(
+            model_name='backupresult',
+            name='run',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='results', to='sitesmanagement.BackupRun'),
+        ),
+        migrations.AddField(
+            model_name='backupresult',
+            name='vm',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='backup_results', to='sitesmanagement.VirtualMachine'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='backupresult',
+            unique_together=set([('run', 'vm_name')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='backupresult',
+            index_together=set([('vm_name', 'date'), ('date', 'status')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0085_backup_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='preallocated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:50
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0086_site_preallocated_at'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='backupresult',
+            unique_together=set([('run', 'vm')]),
+        ),
+    ]
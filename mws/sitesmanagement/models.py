@@ -57,6 +57,13 @@ class ServerType(models.Model):
     sizeram = models.IntegerField()  # In GB
     sizedisk = models.IntegerField()  # In GB
     preallocated = models.IntegerField()  # Number of pre-allocated server of this type
+    # The warm pool of pre-allocated servers (apimws.warmpool) is refilled up to preallocated servers once it has fewer
+    # than preallocated_low, the same as preallocated if not set. pool_refilling is set until the refill is complete.
+    preallocated_low = models.IntegerField(blank=True, null=True)
+    pool_refilling = models.BooleanField(default=False)
+    # Number of new server requests served with a pre-allocated server, and refused because there was none
+    pool_hits = models.PositiveIntegerField(default=0)
+    pool_misses = models.PositiveIntegerField(default=0)
     price = models.DecimalField(max_digits=6, decimal_places=2)
     description = models.CharField(max_length=100, blank=True, null=True)
     order = models.IntegerField()
@@ -115,6 +122,8 @@ class Site(models.Model):
 
     """
     preallocated = models.BooleanField(default=False)
+    # When it was preallocated, so that the warm pool can tell the installations that hang (apimws.warmpool)
+    preallocated_at = models.DateTimeField(null=True, blank=True)
     name = models.CharField(max_length=100, unique=True)
     description = models.CharField(max_length=250, blank=True)
     institution_id = models.CharField(max_length=100, blank=True, null=True)
@@ -493,10 +502,9 @@ class Service(models.Model):
     def power_on(self):
         for vm in self.virtual_machines.all():
             vm.power_on()
-        self.status = 'ansible'
-        self.save()
-        from apimws.ansible import launch_ansible_async
-        launch_ansible_async.apply_async((self, ), countdown=120)
+        from apimws.ansible import schedule_ansible_run
+        # Leave enough time for the VMs to boot
+        schedule_ansible_run(self, force=True, countdown=120)
 
     def power_off(self):
         for vm in self.virtual_machines.all():
@@ -663,6 +671,12 @@ class DomainName(models.Model):
         ('denied', 'Denied'),       #   has not been accepted by the domain owner
         ('deleted', 'Deleted'),     #   has failed validation and is scheduled to be deleted
     )
+    # Statuses that are not changed by validation
+    UNVALIDATED_STATUSES = ('requested', 'denied')
+    # Statuses expected to change soon, validated every MWS_DOMAIN_CHECK_MIN_INTERVAL whatever their stability
+    UNSTABLE_STATUSES = ('accepted', 'deleted')
+    # Stability beyond which the interval between validations stops growing
+    MAX_STABILITY = 16
 
     name = models.CharField(max_length=250, unique=True, validators=[full_domain_validator])
     status = models.CharField(max_length=50, choices=STATUS_CHOICES, default='requested')
@@ -673,9 +687,27 @@ class DomainName(models.Model):
     reject_reason = models.CharField(max_length=250, blank=True, null=True)
     token = models.CharField(max_length=50, default=uuid.uuid4)
     authorised_by = models.ForeignKey(User, related_name='domain_names_authorised', blank=True, null=True)
+    # When the DomainName is next due to be validated, as soon as possible if null
+    next_check = models.DateTimeField(blank=True, null=True, db_index=True)
+    # Number of consecutive validations that did not change its status
+    stability = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def check_interval(cls, status, stability):
+        '''
+        Return the time to wait before validating again a DomainName with the status and stability given: it
+        doubles with every validation that does not change the status, from MWS_DOMAIN_CHECK_MIN_INTERVAL up to
+        MWS_DOMAIN_CHECK_MAX_INTERVAL seconds.
+        '''
+        min_interval = getattr(settings, 'MWS_DOMAIN_CHECK_MIN_INTERVAL', 60*60)
+        if status in cls.UNSTABLE_STATUSES:
+            return timedelta(seconds=min_interval)
+        return timedelta(seconds=min(min_interval * 2 ** min(stability, cls.MAX_STABILITY),
+                                     getattr(settings, 'MWS_DOMAIN_CHECK_MAX_INTERVAL', 7*24*60*60)))
 
     def accept_it(self):
         self.status = 'accepted'
+        self.next_check = None
         self.save()
         if self.vhost.main_domain is None or \
                         self.vhost.main_domain.name == self.vhost.service.network_configuration.name:
@@ -715,53 +747,58 @@ class DomainName(models.Model):
         self.save()
         # TODO send email as special
 
-    def _resolve(self, resolver=None, nameservers=None):
+    def _resolve(self, resolver=None, nameservers=None, scope=None):
         '''
         Attempt to resolve DomainName, using either specified or default nameservers
         or a custom resolver callable.
         Return True if there are any A or AAAA records that match IPv4/6 addresses
         configured on the DomainName's Vhost's Service.
+        Answers are shared through sitesmanagement.dnscache, under the scope given or,
+        if none is, under the nameservers of the resolver.
         '''
         import dns.resolver
-        import dns.name
-        import dns.rdatatype
+        from sitesmanagement import dnscache
 
         if resolver and nameservers:
             raise ValueError('resolver and nameservers are mutually exclusive')
 
         r = resolver if resolver else dns.resolver.Resolver()
         r.nameservers = nameservers if nameservers else r.nameservers
+        scope = scope if scope else dnscache.resolver_scope(r)
         proxies = getattr(settings, 'MWS_ALLOWED_PROXIES', [])
-        dnsname = dns.name.from_text(self.name)
         ip4 = self.vhost.service.network_configuration.IPv4
         ip6 = self.vhost.service.network_configuration.IPv6
 
         try:
-            answer = r.query(dnsname, 'AAAA')
-            return ip6 in [AAAA.to_text() for AAAA in answer.rrset.items if AAAA.rdtype == dns.rdatatype.AAAA] or \
-                   any([AAAA.to_text() in proxies for AAAA in answer.rrset.items if AAAA.rdtype == dns.rdatatype.AAAA])
+            addresses = dnscache.query(scope, r, self.name, 'AAAA')
+            return ip6 in addresses or any([AAAA in proxies for AAAA in addresses])
         except:
             try:
-                answer = r.query(dnsname, 'A')
-                return ip4 in [A.to_text() for A in answer.rrset.items if A.rdtype == dns.rdatatype.A] or \
-                       any([A.to_text() in proxies for A in answer.rrset.items if A.rdtype == dns.rdatatype.A])
+                addresses = dnscache.query(scope, r, self.name, 'A')
+                return ip4 in addresses or any([A in proxies for A in addresses])
             except:
                 return False
 
+    def status_for_scopes(self, scopes):
+        '''
+        Return the status of the DomainName given the scopes of the MWS_RESOLVERS that resolve it to its service.
+        '''
+        if self.status in self.UNVALIDATED_STATUSES:
+            return self.status
+        if scopes:
+            return scopes[0] if self.status not in ['external', 'special'] else self.status
+        return 'deleted'
+
     def validate(self, update=False):
         '''
         Validate DomainName using a set of resolvers.
+        See sitesmanagement.validation to validate many of them at once.
         '''
         status = self.status
-        results = []
-        if status not in ['requested', 'denied']:
-            for resolver in settings.MWS_RESOLVERS:
-                if self._resolve(resolver=resolver['RESOLVER']):
-                    results.append(resolver['SCOPE'])
-            if results:
-                status = results[0] if status not in ['external', 'special'] else status
-            else:
-                status = 'deleted'
+        if status not in self.UNVALIDATED_STATUSES:
+            scopes = [resolver['SCOPE'] for resolver in settings.MWS_RESOLVERS
+                      if self._resolve(resolver=resolver['RESOLVER'], scope=resolver['SCOPE'])]
+            status = self.status_for_scopes(scopes)
             if update and self.status != status:
                 self.status = status
                 self.save()
@@ -832,6 +869,51 @@ class Snapshot(models.Model):
         unique_together = (("name", "service"), )
 
 
+class BackupRun(models.Model):
+    """
+    The result of mws_check_backups for a night, as reconciled by sitesmanagement.backups, with the outcome of the
+    backup of each VM in its results. Runs older than BACKUP_HISTORY_DAYS are pruned.
+    """
+    date = models.DateField(unique=True)
+    checked_at = models.DateTimeField(auto_now=True)
+    checked = models.PositiveIntegerField(default=0)
+    ok = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    missing = models.PositiveIntegerField(default=0)
+    # JSON list of all the hosts whose backup failed, belonging to a VM or not
+    failed_hosts = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-date']
+
+    def __unicode__(self):
+        return unicode(self.date)
+
+
+class BackupResult(models.Model):
+    """The outcome of the backup of a VM in a BackupRun. The VM name and the date are kept with it to query them."""
+    STATUS_CHOICES = (
+        ('ok', 'Backed up'),
+        ('failed', 'Failed'),
+        ('missing', 'Missing'),
+    )
+    run = models.ForeignKey(BackupRun, on_delete=models.CASCADE, related_name='results')
+    vm = models.ForeignKey(VirtualMachine, on_delete=models.SET_NULL, related_name='backup_results', null=True,
+                           blank=True)
+    vm_name = models.CharField(max_length=250)
+    date = models.DateField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+
+    class Meta:
+        ordering = ['-date', 'vm_name']
+        # Not the name, which VMs may share
+        unique_together = (("run", "vm"), )
+        index_together = (("vm_name", "date"), ("date", "status"))
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.vm_name, self.date, self.status)
+
+
 reversion.register(Service, follow=["unix_groups", "ansible_configuration", "vhosts", "virtual_machines"])
 reversion.register(VirtualMachine, follow=["service"])
 reversion.register(Vhost, follow=["domain_names", "service"])
@@ -1,8 +1,17 @@
 import logging
-from django.db.models.signals import post_save, pre_delete
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save, m2m_changed
 from django.dispatch import receiver
-from apimws.ipreg import delete_sshfp, delete_cname
-from sitesmanagement.models import DomainName, SiteKey, Site, VirtualMachine
+from apimws import bes
+from apimws.inventory import invalidate_hostvars
+from apimws.ipreg import delete_cname
+from apimws.models import AnsibleConfiguration, PHPLib, PHPPackage
+from apimws.sshfp import delete_sshfp_records, reconcile_site_sshfp, site_hostnames
+from mwsauth.models import MWSUser
+from sitesmanagement.models import (DomainName, SiteKey, Site, VirtualMachine, Service, Vhost, UnixGroup,
+                                    NetworkConfig)
 
 LOGGER = logging.getLogger('mws')
 
@@ -18,14 +27,18 @@ def check_main_domain_name(instance, **kwargs):
 @receiver(pre_delete, sender=SiteKey)
 def delete_sshfp_from_dns(instance, **kwargs):
     '''Delete SSHFP records from the DNS using the DNS API when a SiteKey is deleted from the database'''
-    for service in instance.site.services.all():
-        for fptype in SiteKey.FP_TYPES:
-            delete_sshfp(service.network_configuration.name, SiteKey.ALGORITHMS[instance.type],
-                         SiteKey.FP_TYPES[fptype])
-        for vm in service.virtual_machines.all():
-            for fptype in SiteKey.FP_TYPES:
-                delete_sshfp(vm.network_configuration.name, SiteKey.ALGORITHMS[instance.type],
-                             SiteKey.FP_TYPES[fptype])
+    # Once committed, so that the other keys deleted with it are not published again and a failure of the DNS API
+    # does not prevent the deletion
+    site_id = instance.site_id
+    transaction.on_commit(lambda: reconcile_site_sshfp.delay(site_id))
+
+
+@receiver(pre_delete, sender=Site)
+def delete_site_sshfp_from_dns(instance, **kwargs):
+    '''Delete all the SSHFP records of the hostnames of a Site deleted from the database'''
+    # Its services and VMs, and so its hostnames, are deleted with it
+    hostnames = site_hostnames(instance)
+    transaction.on_commit(lambda: delete_sshfp_records.delay(hostnames))
 
 @receiver(pre_delete, sender=DomainName)
 def delete_cname_from_dns(instance, **kwargs):
@@ -43,3 +56,228 @@ def log_deleted_site(sender, instance, **kwargs):
 @receiver(pre_delete, sender=VirtualMachine)
 def log_deleted_site(sender, instance, **kwargs):
     LOGGER.info("Class %s deleted the Virtual Machine %s" % (str(sender), instance.name))
+
+
+# Cached Ansible hostvars (apimws.models.HostvarsCache) invalidation. Each handler deletes the cached hostvars of
+# the VMs whose hostvars are built from the instance that changed.
+
+# Fields used to build the hostvars. Saves that do not change any of them (e.g. the Service status changes
+# around every Ansible run) keep the cache.
+HOSTVARS_FIELDS = {
+    Site: ('name', 'email', 'disabled', 'deleted', 'end_date', 'migrated'),
+    Service: ('site_id', 'type', 'quarantined', 'network_configuration_id'),
+    VirtualMachine: ('service_id', 'network_configuration_id'),
+}
+
+
+# Fields the bes API JSON is built from. Saves that change any of them are written to its change journal.
+BES_FIELDS = {
+    Site: ('disabled', 'deleted', 'end_date'),
+    Service: ('site_id', 'status', 'network_configuration_id'),
+    VirtualMachine: ('name', 'service_id', 'network_configuration_id'),
+}
+
+
+@receiver(pre_save, sender=Site)
+@receiver(pre_save, sender=Service)
+@receiver(pre_save, sender=VirtualMachine)
+def check_changed_fields(sender, instance, **kwargs):
+    # The old values of the fields of both are read with a single query
+    fields = sorted(set(HOSTVARS_FIELDS[sender] + BES_FIELDS[sender]))
+    old_values = sender.objects.filter(pk=instance.pk).values(*fields).first() if instance.pk else None
+
+    def changed(fields):
+        return old_values is None or any(old_values[field] != getattr(instance, field) for field in fields)
+
+    instance._hostvars_changed = changed(HOSTVARS_FIELDS[sender])
+    instance._bes_changed = changed(BES_FIELDS[sender])
+
+
+def hostvars_changed(instance, created):
+    return created or getattr(instance, '_hostvars_changed', True)
+
+
+@receiver(post_save, sender=Site)
+def invalidate_site_hostvars(instance, created, **kwargs):
+    if hostvars_changed(instance, created):
+        invalidate_hostvars(vm__service__site=instance)
+
+
+@receiver(pre_delete, sender=Site)
+def invalidate_deleted_site_hostvars(instance, **kwargs):
+    invalidate_hostvars(vm__service__site=instance)
+
+
+@receiver(post_save, sender=Service)
+def invalidate_service_hostvars(instance, created, **kwargs):
+    if hostvars_changed(instance, created):
+        # The test VM uses the vhosts of the production service and the production VM knows about the test one
+        if instance.site_id:
+            invalidate_hostvars(vm__service__site=instance.site_id)
+        else:
+            invalidate_hostvars(vm__service=instance)
+
+
+@receiver(pre_delete, sender=Service)
+def invalidate_deleted_service_hostvars(instance, **kwargs):
+    if instance.site_id:
+        invalidate_hostvars(vm__service__site=instance.site_id)
+
+
+@receiver(post_save, sender=VirtualMachine)
+def invalidate_vm_hostvars(instance, created, **kwargs):
+    if hostvars_changed(instance, created):
+        invalidate_hostvars(vm__service__site__services=instance.service_id)
+
+
+@receiver(pre_delete, sender=VirtualMachine)
+def invalidate_deleted_vm_hostvars(instance, **kwargs):
+    invalidate_hostvars(vm__service__site__services=instance.service_id)
+
+
+@receiver(post_save, sender=NetworkConfig)
+def invalidate_network_configuration_hostvars(instance, created, **kwargs):
+    if not created:
+        invalidate_hostvars(Q(vm__network_configuration=instance) |
+                            Q(vm__service__site__services__network_configuration=instance))
+
+
+@receiver(post_save, sender=Vhost)
+@receiver(pre_delete, sender=Vhost)
+@receiver(post_save, sender=UnixGroup)
+@receiver(pre_delete, sender=UnixGroup)
+def invalidate_vhost_or_unix_group_hostvars(instance, **kwargs):
+    invalidate_hostvars(vm__service__site__services=instance.service_id)
+
+
+@receiver(post_save, sender=DomainName)
+@receiver(pre_delete, sender=DomainName)
+def invalidate_domain_name_hostvars(instance, **kwargs):
+    invalidate_hostvars(vm__service__site__services__vhosts=instance.vhost_id)
+
+
+@receiver(post_save, sender=AnsibleConfiguration)
+@receiver(pre_delete, sender=AnsibleConfiguration)
+def invalidate_ansible_configuration_hostvars(instance, **kwargs):
+    invalidate_hostvars(vm__service=instance.service_id)
+
+
+@receiver(post_save, sender=PHPLib)
+@receiver(pre_delete, sender=PHPLib)
+def invalidate_php_lib_hostvars(instance, **kwargs):
+    invalidate_hostvars(vm__service__php_libs=instance)
+
+
+@receiver(post_save, sender=PHPPackage)
+@receiver(pre_delete, sender=PHPPackage)
+def invalidate_php_package_hostvars(instance, **kwargs):
+    # The list of disabled libraries of every VM with the same OS changes as well
+    invalidate_hostvars(vm__service__ansible_configuration__key='os',
+                        vm__service__ansible_configuration__value=instance.os)
+
+
+def site_users_filter(user):
+    return (Q(vm__service__site__users=user) | Q(vm__service__site__ssh_users=user) |
+            Q(vm__service__site__supporters=user))
+
+
+@receiver(post_save, sender=MWSUser)
+@receiver(pre_delete, sender=MWSUser)
+def invalidate_mws_user_hostvars(instance, **kwargs):
+    invalidate_hostvars(site_users_filter(User.objects.filter(username=instance.user_id)))
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_hostvars(instance, created, update_fields, **kwargs):
+    # Logins only update last_login
+    if not created and set(update_fields or []) != {'last_login'}:
+        invalidate_hostvars(site_users_filter(instance))
+
+
+SITE_USERS_RELATIONS = {
+    Site.users.through: 'users',
+    Site.ssh_users.through: 'ssh_users',
+    Site.supporters.through: 'supporters',
+    Site.groups.through: 'groups',
+    Site.ssh_groups.through: 'ssh_groups',
+}
+
+
+@receiver(m2m_changed)
+def invalidate_m2m_hostvars(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if sender in SITE_USERS_RELATIONS:
+        if not reverse:
+            invalidate_hostvars(vm__service__site=instance)
+        elif pk_set is not None:
+            invalidate_hostvars(vm__service__site__in=pk_set)
+        else:
+            invalidate_hostvars(**{'vm__service__site__%s' % SITE_USERS_RELATIONS[sender]: instance})
+    elif sender is UnixGroup.users.through:
+        if not reverse:
+            invalidate_hostvars(vm__service__site__services=instance.service_id)
+        elif pk_set is not None:
+            invalidate_hostvars(vm__service__site__services__unix_groups__in=pk_set)
+        else:
+            invalidate_hostvars(vm__service__site__services__unix_groups__users=instance)
+    elif sender is PHPLib.services.through:
+        if reverse:
+            invalidate_hostvars(vm__service=instance)
+        elif pk_set is not None:
+            invalidate_hostvars(vm__service__in=pk_set)
+        else:
+            invalidate_hostvars(vm__service__php_libs=instance)
+
+
+# The cached bes API JSON is built from the sites, their services and VMs, the network configurations of both and
+# the SiteKeys. Updates of querysets send no signals, the cache expires after BES_CACHE_TTL seconds anyway.
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+@receiver(post_save, sender=VirtualMachine)
+@receiver(post_delete, sender=VirtualMachine)
+@receiver(post_save, sender=SiteKey)
+@receiver(post_delete, sender=SiteKey)
+@receiver(post_save, sender=NetworkConfig)
+def invalidate_bes(**kwargs):
+    bes.invalidate()
+
+
+# The bes API change journal. Each handler writes an entry for the site whose data served by the API changed.
+
+@receiver(post_save, sender=Site)
+def journal_site(instance, created, **kwargs):
+    if created or getattr(instance, '_bes_changed', True):
+        bes.record_changes([instance.id])
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_save, sender=VirtualMachine)
+def journal_service_or_vm(sender, instance, created, **kwargs):
+    if created or getattr(instance, '_bes_changed', True):
+        bes.record_changes([instance.site_id if sender is Service else instance.service.site_id])
+
+
+@receiver(post_delete, sender=Site)
+@receiver(post_delete, sender=Service)
+@receiver(post_save, sender=SiteKey)
+@receiver(post_delete, sender=SiteKey)
+def journal_site_id(sender, instance, **kwargs):
+    # The entries of the sites deleted are their tombstones
+    bes.record_changes([instance.id if sender is Site else instance.site_id])
+
+
+@receiver(pre_delete, sender=VirtualMachine)
+def journal_deleted_vm(instance, **kwargs):
+    # Before the VM is deleted, as its service may be deleted with it
+    bes.record_changes(Service.objects.filter(id=instance.service_id).values_list('site_id', flat=True))
+
+
+@receiver(post_save, sender=NetworkConfig)
+def journal_network_configuration(instance, created, **kwargs):
+    if not created:
+        bes.record_changes(Site.objects.filter(Q(services__network_configuration=instance) |
+                                               Q(services__virtual_machines__network_configuration=instance))
+                           .values_list('id', flat=True))
@@ -0,0 +1,141 @@
+import json
+from datetime import date, timedelta
+from django.contrib.auth.models import User
+from django.test import RequestFactory, TestCase, override_settings
+from mock import patch
+from apimws.benchmark import create_fleet
+from sitesmanagement.backups import (HostIndex, backup_report, backed_up_vms, store_report, prune_history,
+                                     failing_streaks, failure_rates)
+from sitesmanagement.cronjobs import check_backups
+from sitesmanagement.models import Site, Service, BackupRun, BackupResult, VirtualMachine
+from sitesmanagement.views import backup_trends
+
+
+class BackupReportTests(TestCase):
+
+    def test_host_index(self):
+        index = HostIndex(["mws-client10.example", "mws-client1.example", "mws-client2.example", "other"])
+        self.assertEqual(index.matches("mws-client1"), ["mws-client1.example", "mws-client10.example"])
+        self.assertEqual(index.matches("mws-client2"), ["mws-client2.example"])
+        self.assertEqual(index.matches("mws-client3"), [])
+        self.assertEqual(index.matches("z"), [])
+
+    def test_backup_report(self):
+        result = {'ok': ["vm1.example", "vm3.example"], 'failed': ["vm2.example", "vm3-old.example", "unknown"]}
+        report = backup_report(result, [(1, "vm1"), (2, "vm2"), (3, "vm3"), (4, "vm4")])
+        self.assertEqual(report.vms, [(1, "vm1", 'ok'), (2, "vm2", 'failed'), (3, "vm3", 'failed'),
+                                      (4, "vm4", 'missing')])
+        self.assertEqual(report.as_dict(), {
+            'checked': 4, 'ok': ["vm1"], 'failed': ["vm2", "vm3"], 'missing': ["vm4"],
+            'failed_hosts': ["unknown", "vm2.example", "vm3-old.example"]})
+
+
+class CheckBackupsTests(TestCase):
+
+    def setUp(self):
+        create_fleet(3)
+        Site.objects.update(start_date=date.today() - timedelta(days=7))
+
+    def test_backed_up_vms(self):
+        self.assertEqual([name for vm_id, name in backed_up_vms()],
+                         ["bench-testvm0", "bench-testvm1", "bench-testvm2", "bench-vm0", "bench-vm1", "bench-vm2"])
+        Site.objects.filter(name="bench1").update(start_date=date.today())
+        Service.objects.filter(site__name="bench2", type='test').update(status='installing')
+        with self.assertNumQueries(1):
+            self.assertEqual([name for vm_id, name in backed_up_vms()],
+                             ["bench-testvm0", "bench-vm0", "bench-vm2"])
+
+    @patch("sitesmanagement.cronjobs.LOGGER")
+    @patch("sitesmanagement.cronjobs.subprocess")
+    def test_check_backups(self, mock_subprocess, mock_logger):
+        mock_subprocess.check_output.return_value = json.dumps({
+            'ok': ["bench-vm0.example", "bench-testvm0.example", "bench-vm1.example"],
+            'failed': ["bench-testvm1.example"]})
+        report = check_backups()
+        self.assertEqual(report['missing'], ["bench-testvm2", "bench-vm2"])
+        self.assertEqual(report['failed'], ["bench-testvm1"])
+        self.assertEqual(report['checked'], 6)
+        self.assertEqual([call[0][1] for call in mock_logger.error.call_args_list],
+                         ["bench-testvm1.example", "bench-testvm2", "bench-vm2"])
+        # The results are stored as the run of the night
+        run = BackupRun.objects.get(date=date.today())
+        self.assertEqual((run.checked, run.ok, run.failed, run.missing), (6, 3, 1, 2))
+        self.assertEqual(json.loads(run.failed_hosts), ["bench-testvm1.example"])
+        self.assertEqual(dict(run.results.values_list('vm__name', 'status'))["bench-testvm1"], 'failed')
+
+
+class BackupHistoryTests(TestCase):
+
+    def setUp(self):
+        self.today = date.today()
+        self.nights = [self.today - timedelta(days=n) for n in range(4, -1, -1)]
+        # vm1 fails every night, vm2 the last two, vm3 one night out of two and vm4 never
+        statuses = {
+            "vm1": ['failed', 'missing', 'failed', 'failed', 'missing'],
+            "vm2": ['ok', 'ok', 'ok', 'failed', 'failed'],
+            "vm3": ['failed', 'ok', 'failed', 'ok', 'failed'],
+            "vm4": ['ok', 'ok', 'ok', 'ok', 'ok'],
+        }
+        for n, night in enumerate(self.nights):
+            report = backup_report({'ok': [], 'failed': []}, [])
+            report.vms = [(None, name, statuses[name][n]) for name in sorted(statuses)]
+            store_report(report, night)
+
+    def test_store_report(self):
+        self.assertEqual(BackupRun.objects.count(), 5)
+        self.assertEqual(BackupResult.objects.count(), 20)
+        # Storing the run of a night again replaces it
+        store_report(backup_report({'ok': ["vm1.example"], 'failed': []}, [(None, "vm1")]), self.today)
+        self.assertEqual(BackupRun.objects.count(), 5)
+        self.assertEqual(list(BackupResult.objects.filter(date=self.today).values_list('vm_name', 'status')),
+                         [("vm1", 'ok')])
+
+    def test_shared_names(self):
+        # Two VMs with the same name are stored, and counted once a night
+        create_fleet(2)
+        vm_ids = list(VirtualMachine.objects.filter(name__startswith="bench-vm").values_list('id', flat=True))
+        for night in self.nights[-3:]:
+            report = backup_report({'ok': [], 'failed': []}, [(vm_id, "shared") for vm_id in vm_ids])
+            store_report(report, night)
+        self.assertEqual(BackupResult.objects.filter(vm_name="shared").count(), 6)
+        self.assertEqual(failing_streaks(3), ["shared"])
+        self.assertEqual([row for row in failure_rates(30) if row['vm_name'] == "shared"],
+                         [{'vm_name': "shared", 'runs': 3, 'failures': 3, 'rate': 1.0}])
+
+    def test_trends(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(failing_streaks(2), ["vm1", "vm2"])
+        with self.assertNumQueries(1):
+            self.assertEqual(failing_streaks(3), ["vm1"])
+        # There are not as many runs
+        self.assertEqual(failing_streaks(6), [])
+        with self.assertNumQueries(1):
+            rates = failure_rates(30)
+        self.assertEqual(rates, [
+            {'vm_name': "vm1", 'runs': 5, 'failures': 5, 'rate': 1.0},
+            {'vm_name': "vm3", 'runs': 5, 'failures': 3, 'rate': 0.6},
+            {'vm_name': "vm2", 'runs': 5, 'failures': 2, 'rate': 0.4},
+        ])
+        self.assertEqual([row['vm_name'] for row in failure_rates(2)], ["vm1", "vm2", "vm3"])
+
+    @override_settings(BACKUP_HISTORY_DAYS=2)
+    def test_prune_history(self):
+        self.assertEqual(prune_history(self.today), 2)
+        self.assertEqual(sorted(BackupRun.objects.values_list('date', flat=True)), self.nights[2:])
+        self.assertEqual(BackupResult.objects.count(), 12)
+
+    def test_backup_trends(self):
+        User.objects.bulk_create([User(username="admin", is_superuser=True), User(username="user")])
+        request = RequestFactory().get('/adminbackups/', {'nights': 2, 'days': 2})
+        request.user = User.objects.get(username="user")
+        self.assertEqual(backup_trends(request).status_code, 403)
+        request.user = User.objects.get(username="admin")
+        response = backup_trends(request)
+        self.assertEqual(response.status_code, 200)
+        trends = json.loads(response.content)
+        self.assertEqual(trends['streak'], {'nights': 2, 'vms': ["vm1", "vm2"]})
+        for parameters in ({'nights': 0}, {'nights': -1}, {'days': 0}, {'days': "a"}):
+            request = RequestFactory().get('/adminbackups/', parameters)
+            request.user = User.objects.get(username="admin")
+            self.assertEqual(backup_trends(request).status_code, 400)
+        self.assertEqual([row['vm_name'] for row in trends['failure_rates']['vms']], ["vm1", "vm2", "vm3"])
@@ -0,0 +1,253 @@
+import socket
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from apimws.models import Cluster, Host
+from apimws.xen import which_cluster
+from libs.lrucache import LRUCache
+from sitesmanagement import dnscache
+from sitesmanagement.cronjobs import validate_domains
+from sitesmanagement.models import Site, Service, NetworkConfig, ServerType, VirtualMachine, DomainName
+from sitesmanagement.validation import DomainNameValidator, validate_domain_names
+
+
+class StubDNSServer(object):
+    """
+    A DNS server answering on a local UDP port from the records given as {name: {rdtype: [rdata, ...]}}, with
+    absolute names, following CNAMEs. It counts the queries it receives by (name, rdtype).
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.queries = Counter()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.port = self.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def answer(self, response, name, rdtype):
+        records = self.records.get(name.to_text(), {})
+        if rdtype != dns.rdatatype.CNAME and 'CNAME' in records:
+            response.answer.append(dns.rrset.from_text(name, 300, 'IN', 'CNAME', *records['CNAME']))
+            return self.answer(response, dns.name.from_text(records['CNAME'][0]), rdtype)
+        if dns.rdatatype.to_text(rdtype) in records:
+            response.answer.append(dns.rrset.from_text(name, 300, 'IN', rdtype,
+                                                       *records[dns.rdatatype.to_text(rdtype)]))
+        elif not records:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+
+    def serve(self):
+        while True:
+            try:
+                data, address = self.socket.recvfrom(4096)
+            except socket.error:
+                return
+            query = dns.message.from_wire(data)
+            question = query.question[0]
+            self.queries[(question.name.to_text(), dns.rdatatype.to_text(question.rdtype))] += 1
+            response = dns.message.make_response(query)
+            self.answer(response, question.name, question.rdtype)
+            self.socket.sendto(response.to_wire(), address)
+
+    def resolver(self):
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = ['127.0.0.1']
+        resolver.port = self.port
+        return resolver
+
+    def close(self):
+        self.socket.close()
+
+
+class DomainNameValidationTests(TestCase):
+
+    def setUp(self):
+        dnscache.CACHE.clear()
+        cluster = Cluster.objects.create(name="mws-test-1")
+        Host.objects.create(hostname="mws-test-1.dev.mws3.cam.ac.uk", cluster=cluster)
+        site = Site.objects.create(name="testSite", start_date=datetime.today(), type=ServerType.objects.get(id=1))
+        service = Service.objects.create(
+            type="production", site=site, status="ready",
+            network_configuration=NetworkConfig.objects.create(IPv4='198.51.100.1', IPv6='2001:db8::1',
+                                                               type='ipvxpub', name="mws-1.example"))
+        VirtualMachine.objects.create(
+            name="test_vm", token=uuid.uuid4(), service=service, cluster=which_cluster(),
+            network_configuration=NetworkConfig.objects.create(IPv6='2001:db8::100', type='ipv6',
+                                                               name='mws-client1.example'))
+        self.vhost = service.vhosts.create(name="vhost1")
+        service_records = {'AAAA': ['2001:db8::1'], 'A': ['198.51.100.1']}
+        self.public = StubDNSServer({
+            'mws-1.example.': service_records,
+            'www.example.': {'CNAME': ['mws-1.example.']},
+            'blog.example.': {'CNAME': ['mws-1.example.']},
+            'old.example.': {'AAAA': ['2001:db8::99']},
+            'ext.example.': {'CNAME': ['mws-1.example.']},
+        })
+        self.private = StubDNSServer({
+            'mws-1.example.': service_records,
+            'www.example.': {'CNAME': ['mws-1.example.']},
+            'blog.example.': {'CNAME': ['mws-1.example.']},
+            'intranet.example.': {'A': ['198.51.100.1']},
+            'ext.example.': {'CNAME': ['mws-1.example.']},
+        })
+        self.resolvers = [{'SCOPE': 'global', 'RESOLVER': self.public.resolver()},
+                          {'SCOPE': 'private', 'RESOLVER': self.private.resolver()}]
+        for name, status in (("www.example", 'accepted'), ("blog.example", 'private'), ("old.example", 'global'),
+                             ("intranet.example", 'global'), ("ext.example", 'external'),
+                             ("requested.example", 'requested')):
+            self.vhost.domain_names.create(name=name, status=status)
+
+    def tearDown(self):
+        self.public.close()
+        self.private.close()
+
+    def test_same_as_validate(self):
+        domain_names = list(DomainName.objects.filter(vhost=self.vhost))
+        with override_settings(MWS_RESOLVERS=self.resolvers):
+            expected = dict((domain_name.id, domain_name.validate()) for domain_name in domain_names)
+            statuses = DomainNameValidator().validate(domain_names)
+        del expected[DomainName.objects.get(name="requested.example").id]
+        self.assertEqual(statuses, expected)
+        self.assertEqual(dict((DomainName.objects.get(id=id).name, status) for id, status in statuses.items()), {
+            "www.example": 'global', "blog.example": 'global', "old.example": 'deleted',
+            "intranet.example": 'private', "ext.example": 'external'})
+
+    @override_settings(MWS_DNS_CONCURRENCY=2)
+    def test_shared_cname_targets(self):
+        DomainNameValidator(self.resolvers).validate(DomainName.objects.filter(vhost=self.vhost))
+        for server in (self.public, self.private):
+            # The addresses of the service are looked up once for the three hostnames pointing to it
+            self.assertEqual(server.queries[('mws-1.example.', 'AAAA')], 1)
+            self.assertEqual(server.queries[('www.example.', 'AAAA')], 0)
+            self.assertEqual(server.queries[('requested.example.', 'CNAME')], 0)
+
+    def test_timeout(self):
+        unresponsive = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        unresponsive.bind(('127.0.0.1', 0))
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = ['127.0.0.1']
+        resolver.port = unresponsive.getsockname()[1]
+        try:
+            statuses = DomainNameValidator([{'SCOPE': 'global', 'RESOLVER': resolver, 'TIMEOUT': 0.2}]).validate(
+                DomainName.objects.filter(name="www.example"))
+        finally:
+            unresponsive.close()
+        self.assertEqual(statuses.values(), ['deleted'])
+
+    def test_validate_domains(self):
+        old = DomainName.objects.get(name="old.example")
+        with override_settings(MWS_RESOLVERS=self.resolvers):
+            with self.assertNumQueries(9):
+                # The selects of the due DomainNames, one update per new status and stability, and the invalidation
+                # of the cached hostvars
+                validate_domains()
+        self.assertEqual(DomainName.objects.get(name="www.example").status, 'global')
+        self.assertEqual(DomainName.objects.get(name="intranet.example").status, 'private')
+        self.assertEqual(DomainName.objects.get(name="ext.example").status, 'external')
+        self.assertEqual(DomainName.objects.get(name="requested.example").status, 'requested')
+        # expire_domains counts the grace period from the update
+        self.assertGreater(DomainName.objects.get(name="old.example").updated_at, old.updated_at)
+
+        with override_settings(MWS_RESOLVERS=self.resolvers):
+            self.assertEqual(validate_domain_names(DomainName.objects.all()), {})
+
+    def test_next_check(self):
+        with override_settings(MWS_RESOLVERS=self.resolvers):
+            validate_domains()
+        changed, stable, deleted = [DomainName.objects.get(name=name) for name in
+                                    ("www.example", "ext.example", "old.example")]
+        self.assertEqual((changed.stability, changed.next_check - changed.updated_at), (0, timedelta(hours=1)))
+        self.assertEqual((stable.stability, stable.next_check - changed.updated_at), (1, timedelta(hours=2)))
+        self.assertEqual((deleted.stability, deleted.next_check - changed.updated_at), (0, timedelta(hours=1)))
+        self.assertIsNone(DomainName.objects.get(name="requested.example").next_check)
+
+        # Only the DomainNames due are validated again
+        DomainName.objects.filter(id__in=[stable.id, deleted.id]).update(next_check=timezone.now())
+        with override_settings(MWS_RESOLVERS=self.resolvers):
+            validate_domains()
+        self.assertEqual(DomainName.objects.get(id=changed.id).next_check, changed.next_check)
+        stable = DomainName.objects.get(id=stable.id)
+        self.assertEqual(stable.stability, 2)
+        self.assertGreater(stable.next_check, timezone.now() + timedelta(hours=3, minutes=59))
+        # deleted DomainNames are checked often however long they stay deleted
+        deleted = DomainName.objects.get(id=deleted.id)
+        self.assertEqual(deleted.stability, 1)
+        self.assertLess(deleted.next_check, timezone.now() + timedelta(hours=1))
+
+        self.assertEqual(DomainName.check_interval('global', DomainName.MAX_STABILITY), timedelta(days=7))
+
+    def test_cache(self):
+        intranet = DomainName.objects.get(name="intranet.example")
+        with override_settings(MWS_RESOLVERS=self.resolvers):
+            validate_domains()
+            intranet.validate()
+            queries = sum(self.public.queries.values()) + sum(self.private.queries.values())
+            misses = dnscache.stats()['misses']
+            # Neither the next run nor the next validation of a single domain name query the nameservers again
+            DomainName.objects.update(next_check=timezone.now())
+            validate_domains()
+            self.assertEqual(intranet.validate(), 'private')
+        self.assertEqual(sum(self.public.queries.values()) + sum(self.private.queries.values()), queries)
+        self.assertEqual(dnscache.stats()['misses'], misses)
+        self.assertGreater(dnscache.stats()['hits'], 0)
+
+    def test_negative_cache(self):
+        missing = self.vhost.domain_names.create(name="missing.example", status='global')
+        with override_settings(MWS_RESOLVERS=self.resolvers):
+            self.assertEqual(missing.validate(), 'deleted')
+            self.assertEqual(missing.validate(), 'deleted')
+            with override_settings(MWS_DNS_NEGATIVE_TTL=0):
+                dnscache.CACHE.clear()
+                missing.validate()
+                missing.validate()
+        self.assertEqual(self.public.queries[('missing.example.', 'AAAA')], 3)
+        self.assertEqual(self.public.queries[('missing.example.', 'A')], 3)
+
+    def test_scopes_not_shared(self):
+        with override_settings(MWS_RESOLVERS=self.resolvers):
+            # The NXDOMAIN answer of the global nameservers is not used for the private ones
+            self.assertEqual(DomainName.objects.get(name="intranet.example").validate(), 'private')
+
+    @override_settings(MWS_DOMAIN_CHECK_BATCH=3, MWS_DOMAIN_CHECK_CHUNK=2)
+    def test_due_slice(self):
+        DomainName.objects.filter(name="ext.example").update(next_check=timezone.now() + timedelta(hours=1))
+        DomainName.objects.filter(name="www.example").update(next_check=timezone.now() - timedelta(days=1))
+        before = dict(DomainName.objects.values_list('name', 'next_check'))
+        with override_settings(MWS_RESOLVERS=self.resolvers):
+            validate_domains()
+        validated = set(name for name, next_check in DomainName.objects.values_list('name', 'next_check')
+                        if next_check != before[name])
+        # The DomainNames never validated go first, then the most overdue
+        self.assertEqual(validated, set(["blog.example", "old.example", "intranet.example"]))
+        with override_settings(MWS_RESOLVERS=self.resolvers):
+            validate_domains()
+        self.assertEqual(DomainName.objects.get(name="www.example").status, 'global')
+        self.assertEqual(DomainName.objects.get(name="ext.example").next_check, before["ext.example"])
+
+
+class LRUCacheTests(TestCase):
+
+    def test_expiry_and_eviction(self):
+        now = [0]
+        cache = LRUCache(2, clock=lambda: now[0])
+        cache.set('a', 1, 10)
+        cache.set('b', 2, 20)
+        self.assertEqual(cache.get('a'), 1)
+        # b is the least recently used entry
+        cache.set('c', 3, 30)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        now[0] = 15
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 2, 'size': 1})
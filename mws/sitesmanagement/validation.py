@@ -0,0 +1,154 @@
+'''Concurrent validation of DomainNames against the nameservers in MWS_RESOLVERS'''
+import logging
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+import dns.exception
+import dns.resolver
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from apimws.inventory import invalidate_hostvars
+from sitesmanagement import dnscache
+from sitesmanagement.models import DomainName
+
+
+LOGGER = logging.getLogger('mws')
+
+# Maximum number of DomainNames updated by a single query
+UPDATE_CHUNK = 500
+
+
+class DomainNameValidator(object):
+    """
+    Validates many DomainNames at once, as DomainName.validate does one by one. Every resolver in MWS_RESOLVERS
+    is queried by its own pool of threads, of its CONCURRENCY setting size (MWS_DNS_CONCURRENCY by default), with
+    a TIMEOUT (MWS_DNS_TIMEOUT by default) in seconds per name lookup. The CNAME of every hostname is resolved
+    first so that the addresses of a CNAME target shared by several hostnames, e.g. the hostname of the service
+    of a vhost, are only looked up once per resolver. Answers are shared with DomainName.validate and between runs
+    through sitesmanagement.dnscache.
+    """
+
+    def __init__(self, resolvers=None):
+        self.resolvers = []
+        for resolver_settings in resolvers or settings.MWS_RESOLVERS:
+            configured = resolver_settings['RESOLVER']
+            # A resolver of our own so that the timeouts of the one in the settings are left alone
+            resolver = dns.resolver.Resolver(configure=False)
+            resolver.nameservers = list(configured.nameservers)
+            resolver.port = configured.port
+            resolver.timeout = resolver.lifetime = \
+                resolver_settings.get('TIMEOUT', getattr(settings, 'MWS_DNS_TIMEOUT', 5))
+            concurrency = resolver_settings.get('CONCURRENCY', getattr(settings, 'MWS_DNS_CONCURRENCY', 20))
+            self.resolvers.append((resolver_settings['SCOPE'], resolver, concurrency))
+
+    @staticmethod
+    def canonical_name(scope, resolver, name):
+        """Returns the target of the CNAME of name, name itself if it has none, or None if it does not exist"""
+        try:
+            return dnscache.query(scope, resolver, name, 'CNAME')[0]
+        except dns.resolver.NXDOMAIN:
+            return None
+        except dns.exception.DNSException:
+            return name
+
+    @staticmethod
+    def addresses(scope, resolver, name):
+        """
+        Returns the record type and the IPv6 addresses of name or, if it has none, its IPv4 addresses, or None if
+        it has neither. This is the lookup DomainName._resolve does.
+        """
+        for rdtype in ('AAAA', 'A'):
+            try:
+                return rdtype, dnscache.query(scope, resolver, name, rdtype)
+            except dns.exception.DNSException:
+                pass
+        return None
+
+    def resolve(self, scope, resolver, concurrency, names):
+        """Returns the addresses of each one of names as returned by addresses(), using up to concurrency threads"""
+        pool = ThreadPool(concurrency)
+        try:
+            targets = dict(zip(names, pool.map(lambda name: self.canonical_name(scope, resolver, name), names)))
+            unique_targets = list(set(target for target in targets.values() if target is not None))
+            answers = dict(zip(unique_targets, pool.map(lambda target: self.addresses(scope, resolver, target),
+                                                        unique_targets)))
+        finally:
+            pool.close()
+            pool.join()
+        return dict((name, answers.get(target)) for name, target in targets.items())
+
+    @staticmethod
+    def matches(domain_name, answer):
+        """Whether the addresses resolved point to the service of the vhost of the DomainName or to a proxy"""
+        if answer is None:
+            return False
+        rdtype, addresses = answer
+        network_configuration = domain_name.vhost.service.network_configuration
+        ip = network_configuration.IPv6 if rdtype == 'AAAA' else network_configuration.IPv4
+        proxies = getattr(settings, 'MWS_ALLOWED_PROXIES', [])
+        return ip in addresses or any(address in proxies for address in addresses)
+
+    def validate(self, domain_names):
+        """Returns the status each one of the DomainNames given should have, keyed by DomainName id"""
+        domain_names = [domain_name for domain_name in domain_names
+                        if domain_name.status not in DomainName.UNVALIDATED_STATUSES]
+        names = list(set(domain_name.name for domain_name in domain_names))
+        pool = ThreadPool(len(self.resolvers) or 1)
+        try:
+            answers = pool.map(lambda entry: self.resolve(*(entry + (names, ))), self.resolvers)
+        finally:
+            pool.close()
+            pool.join()
+        return dict((domain_name.id, domain_name.status_for_scopes(
+            [scope for (scope, resolver, concurrency), scope_answers in zip(self.resolvers, answers)
+             if self.matches(domain_name, scope_answers[domain_name.name])]))
+            for domain_name in domain_names)
+
+
+def validate_domain_names(domain_names, validator=None):
+    """
+    Validates the DomainNames given concurrently and stores the new statuses of those that changed, and when
+    each one of them is next due to be validated (see DomainName.check_interval), with one update query per
+    status and stability.
+
+    :return: a dict with the DomainNames whose status changed keyed by their new status
+    """
+    domain_names = list(domain_names)
+    statuses = (validator or DomainNameValidator()).validate(domain_names)
+    changes = defaultdict(list)
+    schedule = defaultdict(list)
+    for domain_name in domain_names:
+        if domain_name.id not in statuses:
+            continue
+        status = statuses[domain_name.id]
+        if status != domain_name.status:
+            changes[status].append(domain_name)
+            schedule[(status, 0, True)].append(domain_name.id)
+        else:
+            stability = min(domain_name.stability + 1, DomainName.MAX_STABILITY)
+            schedule[(status, stability, False)].append(domain_name.id)
+    checked_at = timezone.now()
+    with transaction.atomic():
+        for (status, stability, changed), ids in schedule.items():
+            values = {'status': status, 'stability': stability,
+                      'next_check': checked_at + DomainName.check_interval(status, stability)}
+            if changed:
+                values['updated_at'] = checked_at
+            for i in range(0, len(ids), UPDATE_CHUNK):
+                DomainName.objects.filter(id__in=ids[i:i+UPDATE_CHUNK]).update(**values)
+        for status, changed in changes.items():
+            LOGGER.info("DomainNames changed to %s: %s", status,
+                        ", ".join(domain_name.name for domain_name in changed))
+    # The updates do not send the post_save signals that invalidate the hostvars of the VMs serving them
+    vhost_ids = list(set(domain_name.vhost_id for changed in changes.values() for domain_name in changed))
+    for i in range(0, len(vhost_ids), UPDATE_CHUNK):
+        invalidate_hostvars(vm__service__site__services__vhosts__in=vhost_ids[i:i+UPDATE_CHUNK])
+    return changes
+
+
+def due_domain_names(limit):
+    """The ids of up to limit DomainNames due to be validated, the most overdue first"""
+    return list(DomainName.objects.exclude(status__in=DomainName.UNVALIDATED_STATUSES)
+                .filter(Q(next_check__isnull=True) | Q(next_check__lte=timezone.now()))
+                .order_by(F('next_check').asc(nulls_first=True), 'id').values_list('id', flat=True)[:limit])
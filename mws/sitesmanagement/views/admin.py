@@ -1,8 +1,9 @@
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseForbidden
+from django.http import HttpResponseForbidden, JsonResponse
 from django.shortcuts import render
 from ucamlookup import validate_crsid_list
 
+from sitesmanagement.backups import failing_streaks, failure_rates
 from sitesmanagement.models import Site
 
 
@@ -32,3 +33,24 @@ def admin_search(request):
             parameters['results'] = sites
 
     return render(request, 'mws/admin/search.html', parameters)
+
+
+@login_required
+def backup_trends(request):
+    """
+    The VMs whose backup failed or was missing in each of the last 'nights' (3 by default) nightly checks, and the
+    failure rate of those that failed in the last 'days' (30 by default), as JSON.
+    """
+    if not request.user.is_superuser:
+        return HttpResponseForbidden()
+    try:
+        nights = int(request.GET.get('nights', 3))
+        days = int(request.GET.get('days', 30))
+    except ValueError:
+        return JsonResponse({'error': "nights and days must be integers"}, status=400)
+    if nights < 1 or days < 1:
+        return JsonResponse({'error': "nights and days must be at least 1"}, status=400)
+    return JsonResponse({
+        'streak': {'nights': nights, 'vms': failing_streaks(nights)},
+        'failure_rates': {'days': days, 'vms': failure_rates(days)},
+    })
@@ -5,12 +5,14 @@ import logging
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse, reverse_lazy
+from django.db import transaction
 from django.http import HttpResponseForbidden
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils.html import format_html
 from django.views.generic import FormView, ListView, UpdateView
 from django.views.generic.detail import SingleObjectMixin, DetailView
 from ucamlookup import user_in_groups, get_user_lookupgroups
+from apimws import warmpool
 from apimws.ansible import launch_ansible_site
 from apimws.models import AnsibleConfiguration
 from apimws.utils import email_confirmation
@@ -143,28 +145,34 @@ class SiteCreate(LoginRequiredMixin, FormView):
         # This method is called when valid form data has been POSTed.
         # It should return an HttpResponse.
         siteform = form.save(commit=False)
-        preallocated_site = Site.objects.filter(preallocated=True, disabled=True, type=siteform.type).first()
+        with transaction.atomic():
+            # Concurrent requests are given different sites
+            preallocated_site = Site.objects.select_for_update(skip_locked=True).filter(
+                preallocated=True, disabled=True, type=siteform.type).first()
+            if preallocated_site:
+                preallocated_site.start_date = datetime.date.today()
+                preallocated_site.name = siteform.name
+                preallocated_site.description = siteform.description
+                preallocated_site.email = siteform.email
+                preallocated_site.disabled = False
+                preallocated_site.preallocated = False
+                preallocated_site.full_clean()
+                preallocated_site.save()
+        warmpool.record_request(siteform.type, preallocated_site is not None)
+        # The pool is refilled straight away
+        check_num_preallocated_sites.delay()
         if not preallocated_site:
             form.add_error("type", "No MWS Servers available at this moment with this configuration as they are "
                                    "currently being built, please try again later (they usually take 20 minutes to "
                                    "build) or email %s if you have any question."
                            % getattr(django_settings, 'EMAIL_MWS3_SUPPORT', 'mws-support@uis.cam.ac.uk'))
             return self.form_invalid(form)
-        preallocated_site.start_date = datetime.date.today()
-        preallocated_site.name = siteform.name
-        preallocated_site.description = siteform.description
-        preallocated_site.email = siteform.email
-        preallocated_site.disabled = False
-        preallocated_site.preallocated = False
-        preallocated_site.full_clean()
-        preallocated_site.save()
         # Save user that requested the site
         preallocated_site.users.add(self.request.user)
         if preallocated_site.email:
             email_confirmation(preallocated_site)
         LOGGER.info(str(self.request.user.username) + " requested a new server '" + str(preallocated_site.name) + "'")
         preallocated_site.production_service.power_on()
-        check_num_preallocated_sites.delay()
         return redirect(preallocated_site)
 
     def dispatch(self, *args, **kwargs):